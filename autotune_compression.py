@@ -0,0 +1,218 @@
+import argparse
+import copy
+import json
+import statistics
+import time
+from typing import Iterator, NamedTuple, Optional
+
+import pyarrow as pa
+from loguru import logger
+from pyarrow import parquet as pq
+
+from lambdas.common import (
+    COMPRESSION,
+    COMPRESSION_LEVELS,
+    _compress_to_bytes,
+    _get_arrow_table,
+    _read_arrow_stream,
+    get_arrow_type_overrides,
+    get_storage,
+    list_keys,
+)
+from lambdas.profiles import DEFAULT_STORES, PROFILES_KEY, validate_profiles
+
+
+# Levels tried for each codec of arrow files, the full zstd range is far too large to
+# sweep. Parquet files are always written with the codec's default level.
+CANDIDATE_LEVELS = {
+    "zst": [-5, -1, 1, 3, 6, 9, 12, 15, 19, 22],
+    "br": list(COMPRESSION_LEVELS["br"]),
+    "gz": list(COMPRESSION_LEVELS["gz"]),
+}
+# The time that is minimised, i.e. conversion (lambda) cost or read latency.
+OBJECTIVES = ["encode", "decode"]
+# The store whose profiles are tuned for each file format.
+FORMAT_STORES = {"arrow": "dataclient", "parquet": "athena"}
+
+
+class Result(NamedTuple):
+    codec: str
+    level: Optional[int]
+    size: int
+    encode_s: float
+    decode_s: float
+
+    def dominates(self, other: "Result") -> bool:
+        """Whether this is as small and fast as the other, and better in some way."""
+        this = (self.size, self.encode_s, self.decode_s)
+        that = (other.size, other.encode_s, other.decode_s)
+        return this != that and all(a <= b for a, b in zip(this, that))
+
+
+def sample_table(collection: str, dataset: str, n_files: int) -> pa.Table:
+    """Loads `n_files` source files, spread evenly over the dataset's history."""
+    keys = sorted(list_keys(collection, dataset))
+    step = max(1, len(keys) // n_files)
+    sample = keys[::step][:n_files]
+    overrides = get_arrow_type_overrides(collection, dataset)
+    return _get_arrow_table(sample, type_overrides=overrides)
+
+
+def candidates(
+    file_format: str, codecs: list[str]
+) -> Iterator[tuple[str, Optional[int]]]:
+    for codec in codecs:
+        levels = CANDIDATE_LEVELS.get(codec) if file_format == "arrow" else None
+        for level in levels or [None]:
+            yield codec, level
+
+
+def measure(
+    table: pa.Table,
+    file_format: str,
+    codec: str,
+    level: Optional[int] = None,
+    repeats: int = 3,
+) -> Result:
+    """Encodes and decodes the table like the converter and its readers do, taking the
+    median time of the repeats.
+    """
+    to_parquet = file_format == "parquet"
+    encode, decode = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        data = _compress_to_bytes(table, codec, level=level, to_parquet=to_parquet)
+        encode.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        if to_parquet:
+            pq.read_table(pa.BufferReader(data))
+        else:
+            _read_arrow_stream(pa.BufferReader(data), codec)
+        decode.append(time.perf_counter() - start)
+
+    encode_s, decode_s = statistics.median(encode), statistics.median(decode)
+    return Result(codec, level, len(data), encode_s, decode_s)
+
+
+def pareto_front(results: list[Result]) -> list[Result]:
+    """The results that aren't dominated by any other result."""
+    return [r for r in results if not any(o.dominates(r) for o in results)]
+
+
+def recommend(results: list[Result], objective: str, tolerance: float) -> Result:
+    """The Pareto-optimal result with the lowest encode or decode time (depending on the
+    objective) that is at most `tolerance` (eg. 0.02 for 2%) larger than the smallest.
+    """
+    front = pareto_front(results)
+    smallest = min(r.size for r in front)
+    within = [r for r in front if r.size <= smallest * (1 + tolerance)]
+    return min(within, key=lambda r: (getattr(r, f"{objective}_s"), r.size))
+
+
+def load_profiles(key: str = PROFILES_KEY) -> tuple[dict, Optional[str]]:
+    """The profiles document and its etag, or the default stores if there's none yet."""
+    try:
+        obj = get_storage().get_object(key)
+    except FileNotFoundError:
+        return {"version": 0, "stores": copy.deepcopy(DEFAULT_STORES)}, None
+    return json.load(obj.body), obj.etag
+
+
+def get_store(document: dict, file_format: str) -> dict:
+    dest_store = FORMAT_STORES[file_format]
+    return next(s for s in document["stores"] if s["dest_store"] == dest_store)
+
+
+def record_profile(
+    collection: str,
+    dataset: str,
+    file_format: str,
+    result: Result,
+    key: str = PROFILES_KEY,
+) -> int:
+    """Sets the dataset's level (arrow) or codec (parquet) in its own profile of the
+    format's live store, and writes the next version of the profiles document, which
+    is conditional on it not having been changed since. Returns the new version.
+    """
+    document, etag = load_profiles(key)
+    store = get_store(document, file_format)
+    if file_format == "arrow":
+        if result.codec != store["compression"]:
+            raise ValueError(f"The live arrow store only uses '{store['compression']}'")
+        settings = {"compression_level": result.level}
+    else:
+        settings = {"compression": result.codec}
+
+    name = f"{collection}/{dataset}"
+    profiles = store.setdefault("profiles", [])
+    profile = next((p for p in profiles if p["datasets"] == [name]), None)
+    if profile is None:
+        # ahead of any pattern that also matches the dataset
+        profiles.insert(0, {"datasets": [name], **settings})
+    else:
+        profile.update(settings)
+
+    document["version"] += 1
+    validate_profiles(document)
+    data = json.dumps(document, indent=2).encode()
+    get_storage().put(key, data, if_match=etag, if_none_match=etag is None)
+    return document["version"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the size, encode and decode time of a dataset's sample "
+        "with each codec/level, and recommends the fastest Pareto-optimal setting that "
+        "is within a tolerance of the smallest size."
+    )
+    parser.add_argument("dataset", help="'<collection>/<dataset>', eg. 'pjm/load'")
+    parser.add_argument("--format", choices=list(FORMAT_STORES), default="arrow")
+    parser.add_argument("--codecs", nargs="+", choices=COMPRESSION, default=COMPRESSION)
+    parser.add_argument("--objective", choices=OBJECTIVES, default="encode")
+    parser.add_argument("--tolerance", type=float, default=0.02)
+    parser.add_argument("--sample", type=int, default=10, help="number of source files")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="record the recommendation in the dataset's profile of the live store, "
+        "arrow stores are only tuned for their codec",
+    )
+    args = parser.parse_args()
+    collection, dataset = args.dataset.split("/")
+
+    codecs = args.codecs
+    if args.record and args.format == "arrow":
+        codecs = [get_store(load_profiles()[0], "arrow")["compression"]]
+
+    # the converter logs memory usage for every encode
+    logger.disable("lambdas")
+    table = sample_table(collection, dataset, args.sample)
+    raw_size = table.nbytes
+    print(f"Sampled {len(table)} rows ({raw_size / 1e6:.1f}MB) of '{args.dataset}'")
+
+    results = []
+    for codec, level in candidates(args.format, codecs):
+        results.append(measure(table, args.format, codec, level, args.repeats))
+
+    front = pareto_front(results)
+    best = recommend(results, args.objective, args.tolerance)
+    header = f"{'codec':<6}{'level':>7}{'ratio':>8}{'encode (ms)':>13}"
+    print(f"\n  {header}{'decode (ms)':>13}")
+    for r in sorted(results, key=lambda r: r.size):
+        mark = ">" if r == best else "*" if r in front else " "
+        level = "-" if r.level is None else r.level
+        print(
+            f"{mark} {r.codec:<6}{level:>7}{raw_size / r.size:>8.2f}"
+            f"{r.encode_s * 1000:>13.1f}{r.decode_s * 1000:>13.1f}"
+        )
+    print("\n* Pareto-optimal, > recommended")
+
+    if args.record:
+        version = record_profile(collection, dataset, args.format, best)
+        print(f"Recorded in the profiles, version {version}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+
+HANDLERS = [
+    "lambdas.prod_listener",
+    "lambdas.request_generator",
+    "lambdas.request_handler",
+]
+HEAVY_MODULES = ["boto3", "pyarrow", "pandas", "psutil", "pydantic"]
+
+# Imports the module in a fresh interpreter, like a lambda cold start, printing the
+# import time (s), peak RSS (KiB) and the heavy modules that were imported.
+_SNIPPET = """
+import resource, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(elapsed, rss, ",".join(heavy))
+"""
+
+
+def measure(module: str) -> tuple[float, int, str]:
+    code = _SNIPPET.format(module=module, heavy=HEAVY_MODULES)
+    env = {"AWS_DEFAULT_REGION": "us-east-1", **os.environ}
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        check=True,
+        env=env,
+        text=True,
+    ).stdout.split()
+    return float(out[0]), int(out[1]), out[2] if len(out) > 2 else ""
+
+
+def top_imports(module: str, n: int) -> list[tuple[int, str]]:
+    """Returns the `n` slowest imported packages (cumulative us) via `-X importtime`."""
+    env = {"AWS_DEFAULT_REGION": "us-east-1", **os.environ}
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        check=True,
+        env=env,
+        text=True,
+    ).stderr
+    imports: dict[str, int] = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        name = name.strip()
+        # a package's cumulative time includes its submodules
+        if cumulative.strip().isdigit() and "." not in name:
+            imports[name] = max(imports.get(name, 0), int(cumulative))
+    for name in ("lambdas", "site", "encodings"):
+        imports.pop(name, None)
+    return sorted(((t, m) for m, t in imports.items()), reverse=True)[:n]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the cold start import cost of each lambda handler."
+    )
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=0, help="show the N slowest imports")
+    parser.add_argument("handlers", nargs="*", default=HANDLERS)
+    args = parser.parse_args()
+
+    print(f"{'handler':<28}{'import (ms)':>12}{'peak rss (MB)':>15}  heavy modules")
+    for module in args.handlers:
+        runs = [measure(module) for _ in range(args.runs)]
+        elapsed = statistics.median(r[0] for r in runs) * 1000
+        rss = max(r[1] for r in runs) / 1024
+        print(f"{module:<28}{elapsed:>12.0f}{rss:>15.0f}  {runs[0][2] or '-'}")
+        for cumulative, name in top_imports(module, args.top):
+            print(f"    {name:<40}{cumulative / 1000:>8.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
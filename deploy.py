@@ -1,4 +1,5 @@
 import json
+import os
 from datetime import datetime, timezone
 from pathlib import Path
 
@@ -24,6 +25,9 @@ STACK_NAME = "S3DBConverter"
 S3DB_BUCKET = "invenia-datafeeds-output"
 S3DB_BUCKET_PREFIX = "version5/aurora/gz/"
 S3DB_BUCKET_SNS = "arn:aws:sns:us-east-1:516256908252:invenia-datafeeds-output-topic-BucketTopic-AHM26GG3AE5J"  # noqa
+# The role in the account of the Glue catalog managed by the CLI, the prod listener
+# only syncs the athena store's tables if it's set.
+GLUE_CATALOG_ROLE_ARN = os.environ.get("GLUE_CATALOG_ROLE_ARN", "")
 
 
 def main():
@@ -62,6 +66,10 @@ def create_stack(stackname, bucket, key):
             {"ParameterKey": "S3DBProdPrefix", "ParameterValue": S3DB_BUCKET_PREFIX},
             {"ParameterKey": "S3DBBucketSNS", "ParameterValue": S3DB_BUCKET_SNS},
             {"ParameterKey": "S3DBBucketSNSFilter", "ParameterValue": sns_filter()},
+            {
+                "ParameterKey": "GlueCatalogRoleArn",
+                "ParameterValue": GLUE_CATALOG_ROLE_ARN,
+            },
         ],
         "Capabilities": ["CAPABILITY_NAMED_IAM"],
     }
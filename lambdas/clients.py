@@ -0,0 +1,78 @@
+import os
+from typing import Optional
+
+import boto3
+
+from lambdas.config import STORAGE_URI
+from lambdas.storage import BOTO3_LOCK, Storage, storage_from_uri
+
+
+# Clients are created on first use rather than at import time (holding `BOTO3_LOCK`,
+# they may be first used by several threads at once), and then reused across
+# invocations of a warm lambda function.
+SQS_CLIENT = None
+LAMBDA_CLIENT = None
+GLUE_CLIENT = None
+STORAGE: Optional[Storage] = None
+
+
+def get_sqs_client():
+    global SQS_CLIENT
+    if SQS_CLIENT is None:
+        with BOTO3_LOCK:
+            if SQS_CLIENT is None:
+                SQS_CLIENT = boto3.client("sqs")
+    return SQS_CLIENT
+
+
+def get_lambda_client():
+    global LAMBDA_CLIENT
+    if LAMBDA_CLIENT is None:
+        with BOTO3_LOCK:
+            if LAMBDA_CLIENT is None:
+                LAMBDA_CLIENT = boto3.client("lambda")
+    return LAMBDA_CLIENT
+
+
+def get_glue_client():
+    """The Glue client of the athena store's catalog, which may be in another account,
+    in which case `GLUE_CATALOG_ROLE_ARN` is assumed to access it.
+    """
+    global GLUE_CLIENT
+    role_arn = os.environ.get("GLUE_CATALOG_ROLE_ARN")
+    if role_arn:
+        # assumed role credentials expire, but catalog syncs are rare, so simply get
+        # new ones every time
+        with BOTO3_LOCK:
+            sts = boto3.client("sts")
+        resp = sts.assume_role(RoleArn=role_arn, RoleSessionName="s3dbconverter")
+        credentials = resp["Credentials"]
+        with BOTO3_LOCK:
+            return boto3.client(
+                "glue",
+                aws_access_key_id=credentials["AccessKeyId"],
+                aws_secret_access_key=credentials["SecretAccessKey"],
+                aws_session_token=credentials["SessionToken"],
+            )
+    if GLUE_CLIENT is None:
+        with BOTO3_LOCK:
+            if GLUE_CLIENT is None:
+                GLUE_CLIENT = boto3.client("glue")
+    return GLUE_CLIENT
+
+
+def get_storage() -> Storage:
+    global STORAGE
+    if STORAGE is None:
+        with BOTO3_LOCK:
+            if STORAGE is None:
+                STORAGE = storage_from_uri(STORAGE_URI)
+    return STORAGE
+
+
+def refresh_clients():
+    global STORAGE, SQS_CLIENT, LAMBDA_CLIENT, GLUE_CLIENT
+    STORAGE = None
+    SQS_CLIENT = None
+    LAMBDA_CLIENT = None
+    GLUE_CLIENT = None
@@ -1,120 +1,73 @@
 import concurrent.futures
+import functools
 import gzip
+import hashlib
 import io
-import json
 import os
+import uuid
+import zlib
 from datetime import datetime, timezone
-from itertools import groupby, islice
-from typing import Iterable, Iterator, Optional
+from typing import Callable, Iterator, NamedTuple, Optional
 
-import boto3
-import psutil
+import numpy as np
 import pyarrow as pa
-from boto3.s3.transfer import TransferConfig
+import pyarrow.compute as pc
 from loguru import logger
 from pyarrow import csv, parquet as pq
 
-
-# non-versioned bucket
-SOURCE_BUCKET = "invenia-datafeeds-output"
-SOURCE_PREFIX = "version5/aurora/gz/"
-
-COMPRESSION = ["br", "gz", "lz4", "zst", "sz"]
-COMPRESSION_LEVELS = {
-    # Higher values are slower and have higher compression ratios.
-    "zst": range(-131072, 22 + 1),  # min: -131072, max: 22, default: 1
-    "br": range(0, 11 + 1),  # min: 0, max: 11, pyarrow default = 8
-    # Higher levels use more RAM but are faster and have higher compression ratios.
-    "gz": range(1, 9 + 1),  # min: 1, max: 9, pyarrow default = 9
-}
-COMPRESSION_LEVELS_DEFAULTS = {
-    "zst": 22,
-    "br": 9,
-    "gz": 9,
-}
-_PYARROW_ARG_TRANSLATION = {
-    "br": "brotli",
-    "gz": "gzip",
-    "sz": "snappy",
-    "zst": "zstd",
-}
-
-DEST_STORES = ["athena", "dataclient"]
-FILE_FORMATS = ["arrow", "parquet"]
-# Partition key and partition projections configs used in Athena
-PARTITIONS = {
-    "hour": {
-        # We use python format, cuz we're running python
-        "format": "%Y-%m-%d %H:%M:%S",
-        # Athena uses java date format
-        "projection_format": "yyyy-MM-dd HH:mm:ss",
-        "type": "timestamp",
-        "unit": "HOURS",
-    },
-    "day": {
-        "format": "%Y-%m-%d",
-        "projection_format": "yyyy-MM-dd",
-        "type": "date",
-        "unit": "DAYS",
-    },
-    "month": {
-        "format": "%Y-%m-%d",
-        "projection_format": "yyyy-MM-dd",
-        "type": "date",
-        "unit": "MONTHS",
-    },
-    "year": {
-        "format": "%Y-%m-%d",
-        "projection_format": "yyyy-MM-dd",
-        "type": "date",
-        "unit": "YEARS",
-    },
-}
-gen_partition_key = lambda partition_size: f"{partition_size}_partition"  # type: ignore
-
-SQS_CLIENT = boto3.client("sqs")
-S3_CLIENT = boto3.client("s3")
-# Default multi-part config:
-# https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/s3.html#module-boto3.s3.inject
-S3_CONFIG = TransferConfig()
-
-
-def refresh_clients():
-    global S3_CLIENT, SQS_CLIENT
-    S3_CLIENT = boto3.client("s3")
-    SQS_CLIENT = boto3.client("sqs")
-
-
-def list_collections() -> list[str]:
-    coll_prefixes = _s3_list(SOURCE_BUCKET, SOURCE_PREFIX, dirs_only=True)
-    return [c.split("/")[-2] for c in coll_prefixes]
-
-
-def list_datasets(collection: str) -> list[str]:
-    prefix = os.path.join(SOURCE_PREFIX, collection, "")
-    ds_prefixes = _s3_list(SOURCE_BUCKET, prefix, dirs_only=True)
-    return [d.split("/")[-2] for d in ds_prefixes]
-
-
-def list_keys(collection: str, dataset: str) -> Iterator[str]:
-    prefix = os.path.join(SOURCE_PREFIX, collection, dataset, "")
-    yield from (i for i in _s3_list(SOURCE_BUCKET, prefix) if i.endswith(".csv.gz"))
-
-
-def gen_metadata_key(collection: str, dataset: str) -> str:
-    return os.path.join(SOURCE_PREFIX, collection, dataset, "METADATA.json")
-
-
-def get_dataset_pkeys(collection: str, dataset: str) -> list[str]:
-    key = gen_metadata_key(collection, dataset)
-    meta = json.load(S3_CLIENT.get_object(Bucket=SOURCE_BUCKET, Key=key)["Body"])
-    return meta["superkey"]
-
-
-def get_s3db_type_map(collection: str, dataset: str) -> dict[str, str]:
-    key = gen_metadata_key(collection, dataset)
-    meta = json.load(S3_CLIENT.get_object(Bucket=SOURCE_BUCKET, Key=key)["Body"])
-    return meta["type_map"]
+from lambdas import manifest
+from lambdas.clients import get_sqs_client, get_storage, refresh_clients  # noqa: F401
+from lambdas.config import (  # noqa: F401
+    _PYARROW_ARG_TRANSLATION,
+    BUCKET_PARTITION_KEY,
+    COMPRESSION,
+    COMPRESSION_LEVELS,
+    COMPRESSION_LEVELS_DEFAULTS,
+    DEST_STORES,
+    FILE_FORMATS,
+    MAX_BUCKET_COUNT,
+    PARTITIONS,
+    ROLLUP_AGGREGATIONS,
+    SOURCE_BUCKET,
+    SOURCE_PREFIX,
+    STORAGE_URI,
+    gen_partition_key,
+    gen_rollup_dataset,
+    parse_rollup_dataset,
+)
+from lambdas.manifest import manifest_entry
+from lambdas.pipeline import pipelined
+from lambdas.s3db import (  # noqa: F401
+    batch_items,
+    ceil_dt,
+    copy_metadata_file,
+    extract_datetime,
+    floor_dt,
+    gen_metadata_key,
+    get_bucket_column,
+    get_dataset_pkeys,
+    get_first_key,
+    get_metadata,
+    get_rollup_columns,
+    get_s3db_type_map,
+    group_s3keys_by_partition,
+    list_collections,
+    list_datasets,
+    list_keys,
+    to_utc,
+)
+
+
+# The configs, clients and source data helpers above live in lightweight modules, so
+# that handlers which don't convert data don't import pyarrow, but are re-exported here.
+
+# Loaded source tables are spilled here when staging to disk, see `_stage_table`.
+# Lambda functions can be given up to 10GB of ephemeral storage in /tmp.
+STAGING_DIR = os.environ.get("STAGING_DIR", "/tmp/s3db-staging")
+# String columns are dictionary-encoded when the ratio of distinct values to rows in a
+# sample of the column is below this, see `dictionary_encode_strings`.
+DICTIONARY_MAX_RATIO = float(os.environ.get("DICTIONARY_MAX_RATIO", 0.5))
+DICTIONARY_SAMPLE_ROWS = 10_000
 
 
 def get_arrow_type_overrides(collection: str, dataset: str) -> dict:
@@ -127,20 +80,23 @@ def get_arrow_type_overrides(collection: str, dataset: str) -> dict:
     return overrides
 
 
-def extract_datetime(s3_key: str) -> datetime:
-    filename = s3_key.rsplit("/", 1)[-1]
-    ts = int(filename.split(".")[0])
-    return datetime.fromtimestamp(ts, timezone.utc)
+class Partition(NamedTuple):
+    file_start: int
+    coll: str
+    ds: str
+    table: pa.Table
+    source_etags: list[str]
 
 
-def copy_metadata_file(collection: str, dataset: str, dest_prefix: str):
-    key = gen_metadata_key(collection, dataset)
-    desk_key = os.path.join(dest_prefix, key.removeprefix(SOURCE_PREFIX))
-    S3_CLIENT.copy_object(
-        Bucket=SOURCE_BUCKET,
-        Key=desk_key,
-        CopySource={"Bucket": SOURCE_BUCKET, "Key": key},
-    )
+class ConvertedFile(NamedTuple):
+    key: str
+    # None if the dest file is unchanged and doesn't have to be uploaded
+    data: Optional[bytes]
+    coll: str
+    ds: str
+    # the dest file's manifest entry
+    stats: Optional[dict]
+    fingerprint: str
 
 
 def convert_data(
@@ -151,65 +107,347 @@ def convert_data(
     file_format: str,
     compression: str,
     level: Optional[int] = None,
-) -> Iterator[tuple[str, bytes]]:
-    for ts, coll, ds, table in load_as_partitions(source_keys, partition_size):
-        logger.info(f"Loaded partition {ts} for {coll}.{ds} with {len(table)} rows")
-
-        if dest_store == "athena":
-            if file_format != "parquet":
-                raise Exception(
-                    f"Only parquet is supported for Athena, found {file_format}"
-                )
-            data = _compress_to_bytes(table, compression, to_parquet=True)
-            key = _gen_athena_key(ts, coll, ds, dest_prefix, partition_size)
-        else:
-            to_parquet = file_format == "parquet"
-            data = _compress_to_bytes(
-                table, compression, level=level, to_parquet=to_parquet
+    skip_unchanged: bool = False,
+    stage_to_disk: bool = False,
+    source_prefix: str = SOURCE_PREFIX,
+    dictionary_encode: bool = False,
+    bucket_count: Optional[int] = None,
+    rollups: Optional[list[dict]] = None,
+    row_group_size: Optional[int] = None,
+) -> Iterator[ConvertedFile]:
+    """Converts the source files into dest files, yielding the dest key and data.
+    Loading and encoding runs as a pipeline in background threads, so that the next
+    partitions are loaded and encoded while the caller uploads the previous ones.
+
+    With `skip_unchanged`, partitions whose fingerprint matches the one stored on the
+    existing dest file aren't encoded, and are yielded without data.
+
+    With `stage_to_disk`, loaded source tables are memory-mapped from local disk rather
+    than held in memory, for partitions that are too large to fit in memory.
+
+    The source files are either S3DB CSV files, or the files of a converted store under
+    `source_prefix`, which are read natively without any CSV parsing.
+
+    With `dictionary_encode`, low-cardinality string columns of arrow files are
+    dictionary-encoded.
+
+    With `bucket_count` (athena only), each partition is further split into hash
+    buckets of the dataset's superkey column, see `superkey_buckets`.
+
+    With `rollups` (athena only), eg. `[{"period": "hour"}]`, each partition is also
+    aggregated per superkey and period into a rollup dataset, see `rollup_table`.
+
+    `row_group_size` is the max number of rows per row group of parquet files.
+    """
+    load = functools.partial(
+        load_partition, partition_size=partition_size, stage_to_disk=stage_to_disk
+    )
+    encode_file = encode = functools.partial(
+        encode_partition,
+        dest_prefix=dest_prefix,
+        dest_store=dest_store,
+        partition_size=partition_size,
+        file_format=file_format,
+        compression=compression,
+        level=level,
+        skip_unchanged=skip_unchanged,
+        dictionary_encode=dictionary_encode,
+        row_group_size=row_group_size,
+    )
+    if bucket_count:
+        encode = functools.partial(
+            encode_buckets, bucket_count=bucket_count, encode=encode
+        )
+    if rollups:
+        # rollups are small, so they aren't bucketed
+        encode = functools.partial(
+            encode_rollups, rollups=rollups, encode=encode, encode_rollup=encode_file
+        )
+    groups = group_s3keys_by_partition(source_keys, partition_size, source_prefix)
+    yield from pipelined(groups, load, encode)
+
+
+def encode_partition(
+    partition: Partition,
+    dest_prefix: str,
+    dest_store: str,
+    partition_size: str,
+    file_format: str,
+    compression: str,
+    level: Optional[int] = None,
+    skip_unchanged: bool = False,
+    dictionary_encode: bool = False,
+    bucket: Optional[int] = None,
+    row_group_size: Optional[int] = None,
+) -> ConvertedFile:
+    ts, coll, ds, table, source_etags = partition
+    logger.info(f"Loaded partition {ts} for {coll}.{ds} with {len(table)} rows")
+
+    if dest_store == "athena":
+        if file_format != "parquet":
+            raise Exception(
+                f"Only parquet is supported for Athena, found {file_format}"
             )
-            key = _gen_s3db_key(ts, coll, ds, dest_prefix, file_format, compression)
+        key = _gen_athena_key(ts, coll, ds, dest_prefix, partition_size, bucket)
+        # the compression level isn't used for parquet files
+        level = None
+    elif bucket is not None:
+        raise Exception(f"Bucketing is only supported for Athena, found {dest_store}")
+    else:
+        key = _gen_s3db_key(ts, coll, ds, dest_prefix, file_format, compression)
+
+    # parquet files are already dictionary-encoded by the parquet writer
+    dictionary_encode = dictionary_encode and file_format == "arrow"
+    params: tuple = (dest_store, file_format, compression, level)
+    if dictionary_encode:
+        params += ("dictionary",)
+    # pyarrow defaults to row groups of up to 1Mi rows
+    row_group_size = row_group_size if file_format == "parquet" else None
+    if row_group_size:
+        params += (f"row_group_size={row_group_size}",)
+
+    fp = fingerprint(table, *params)
+    if skip_unchanged:
+        info = get_storage().head(key)
+        if info is not None and info.metadata.get("fingerprint") == fp:
+            logger.info(f"Skipping unchanged file '{key}'")
+            return ConvertedFile(key, None, coll, ds, None, fp)
+
+    if dictionary_encode:
+        table = dictionary_encode_strings(table)
+
+    to_parquet = file_format == "parquet"
+    data = _compress_to_bytes(
+        table,
+        compression,
+        level=level,
+        to_parquet=to_parquet,
+        row_group_size=row_group_size,
+    )
+    stats = manifest_entry(key, ts, table, data, source_etags)
+    return ConvertedFile(key, data, coll, ds, stats, fp)
+
+
+def encode_buckets(
+    partition: Partition, bucket_count: int, encode: Callable[..., ConvertedFile]
+) -> Iterator[ConvertedFile]:
+    """Splits a partition into hash buckets of the superkey column, encoding each
+    non-empty bucket into its own file.
+    """
+    table = partition.table
+    column = get_bucket_column(partition.coll, partition.ds)
+    if column is None:
+        yield encode(partition)
+        return
+
+    buckets = superkey_buckets(table.column(column), bucket_count)
+    table = table.append_column("__bucket", buckets).sort_by("__bucket")
+    counts = pc.value_counts(table.column("__bucket")).to_pylist()
+    table = table.drop(["__bucket"])
+
+    offset = 0
+    for count in sorted(counts, key=lambda c: c["values"]):
+        rows = table.slice(offset, count["counts"])
+        offset += count["counts"]
+        yield encode(partition._replace(table=rows), bucket=count["values"])
+
+
+def encode_rollups(
+    partition: Partition,
+    rollups: list[dict],
+    encode: Callable,
+    encode_rollup: Callable[..., ConvertedFile],
+) -> Iterator[ConvertedFile]:
+    """Encodes a partition, followed by each of its rollups into the partition's file
+    of the rollup dataset.
+    """
+    outputs = encode(partition)
+    yield from [outputs] if isinstance(outputs, ConvertedFile) else outputs
+
+    for rollup in rollups:
+        period = rollup["period"]
+        aggregations = rollup.get("aggregations") or ROLLUP_AGGREGATIONS
+        table = rollup_table(
+            partition.table, partition.coll, partition.ds, period, aggregations
+        )
+        ds = gen_rollup_dataset(partition.ds, period)
+        yield encode_rollup(partition._replace(ds=ds, table=table))
+
+
+def rollup_table(
+    table: pa.Table, collection: str, dataset: str, period: str, aggregations: list[str]
+) -> pa.Table:
+    """Aggregates the numeric value columns of a table per superkey and period, eg. the
+    hourly min/max/mean/count/last price per node, with columns as described by
+    `get_rollup_columns`. 'last' is the last non-null value by 'target_start', then
+    'release_date', i.e. the latest release of the period's last interval.
+    """
+    keys, type_map = get_rollup_columns(collection, dataset, aggregations)
+    order = [c for c in ("target_start", "release_date") if c in table.column_names]
+    table = table.sort_by([(c, "ascending") for c in order])
+
+    start = pc.cast(table.column("target_start"), pa.timestamp("s"))
+    start = pc.cast(pc.floor_temporal(start, unit=period), pa.int64())
+    table = table.set_column(
+        table.column_names.index("target_start"), "target_start", start
+    )
+
+    group_keys = keys + ["target_start"]
+    aggs = []
+    for name in type_map:
+        if name not in group_keys:
+            column, agg = name.rsplit("_", 1)
+            aggs.append((column, agg))
+    # single-threaded grouping keeps the row order, as required by 'last'
+    result = table.group_by(group_keys, use_threads=False).aggregate(aggs)
+    # aggregated columns are named `<col>_<agg>` by pyarrow
+    result = result.select(list(type_map))
+    return result.sort_by([(c, "ascending") for c in group_keys])
+
+
+def superkey_buckets(column: pa.ChunkedArray, bucket_count: int) -> pa.Array:
+    """Hash buckets of a column's values, which are reproducible in Athena SQL, i.e.
+    `abs(<col>) % <n>` for integers and `crc32(to_utf8(<col>)) % <n>` for strings.
+    Nulls are put in bucket 0.
+    """
+    if pa.types.is_integer(column.type):
+        values = pc.fill_null(column, 0).to_numpy()
+        return pa.array(np.abs(values) % bucket_count, pa.int32())
+    elif pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        # only hash each distinct value once
+        encoded = column.combine_chunks().dictionary_encode()
+        hashes = [
+            zlib.crc32(v.encode()) % bucket_count
+            for v in encoded.dictionary.to_pylist()
+        ]
+        indices = pc.fill_null(encoded.indices, -1).to_numpy()
+        return pa.array(np.append(hashes, 0)[indices], pa.int32())
+    raise ValueError(f"Can't bucket column of type {column.type}")
+
+
+def dictionary_encode_strings(table: pa.Table) -> pa.Table:
+    """Dictionary-encodes the string columns with few distinct values, eg. node names,
+    going by a sample of each column. All batches of a column share the same
+    dictionary, as an IPC stream can only hold a single dictionary per column.
+    """
+    columns = []
+    for column in table.columns:
+        if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+            sample = column.slice(0, DICTIONARY_SAMPLE_ROWS)
+            distinct = pc.count_distinct(sample, mode="all").as_py()
+            if len(sample) and distinct / len(sample) <= DICTIONARY_MAX_RATIO:
+                column = column.dictionary_encode()
+        columns.append(column)
+
+    schema = pa.schema(
+        [f.with_type(c.type) for f, c in zip(table.schema, columns)],
+        metadata=table.schema.metadata,
+    )
+    return pa.Table.from_arrays(columns, schema=schema).unify_dictionaries()
 
-        yield key, data
+
+def fingerprint(table: pa.Table, *params) -> str:
+    """Hashes a table's content along with the params used to encode it, such that a
+    dest file only has to be rewritten if its fingerprint changes.
+    """
+    sink = _HashSink()
+    # the IPC stream is written in chunks to the hash, rather than into memory
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write(table)
+    sink.hash.update(repr(params).encode())
+    return sink.hash.hexdigest()
+
+
+class _HashSink:
+    def __init__(self):
+        self.hash = hashlib.sha256()
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.hash.update(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
 
 
 def load_as_partitions(
     source_keys: list[str], partition_size: str
-) -> Iterator[tuple[int, str, str, pa.Table]]:
-    for gk, s3keys in group_s3keys_by_partition(source_keys, partition_size):
-        coll, ds, file_start = gk
+) -> Iterator[Partition]:
+    for group in group_s3keys_by_partition(source_keys, partition_size):
+        yield from load_partition(group, partition_size)
+
+
+def load_partition(
+    group: tuple[tuple[str, str, int], list[str]],
+    partition_size: str,
+    stage_to_disk: bool = False,
+) -> Iterator[Partition]:
+    (coll, ds, file_start), s3keys = group
+    type_overrides = None
+    if any(k.endswith(".csv.gz") for k in s3keys):
         type_overrides = get_arrow_type_overrides(coll, ds)
-        table = _get_arrow_table(s3keys, type_overrides=type_overrides)
-        logger.info(f"Loaded table for {coll}.{ds} with {len(table)} rows")
-
-        # for hourly partitions, we'll have to further split the file/table
-        if partition_size == "hour":
-            schema = table.schema
-            # convert to pandas to use DF.groupby
-            table = table.to_pandas()
-            key_fn = lambda ts: ts - (ts % 3600)  # round down hour
-            table["pk"] = list(map(key_fn, table.target_start))
-            grouped = table.groupby("pk")
-            for file_key, df in grouped:
-                t = pa.Table.from_pandas(df, schema)
-                yield file_key, coll, ds, t
-        else:
-            yield file_start, coll, ds, table
+    etags: list[str] = []
+    table = _get_arrow_table(
+        s3keys, type_overrides=type_overrides, etags=etags, stage_to_disk=stage_to_disk
+    )
+    logger.info(f"Loaded table for {coll}.{ds} with {len(table)} rows")
+
+    # for hourly partitions, we'll have to further split the file/table
+    if partition_size == "hour":
+        schema = table.schema
+        # convert to pandas to use DF.groupby
+        table = table.to_pandas()
+        key_fn = lambda ts: ts - (ts % 3600)  # round down hour
+        table["pk"] = list(map(key_fn, table.target_start))
+        grouped = table.groupby("pk")
+        for file_key, df in grouped:
+            t = pa.Table.from_pandas(df, schema)
+            yield Partition(file_key, coll, ds, t, etags)
+    else:
+        yield Partition(file_start, coll, ds, table, etags)
 
 
-def _get_arrow_table(source_keys: list[str], type_overrides=None) -> pa.Table:
+def _get_arrow_table(
+    source_keys: list[str],
+    type_overrides=None,
+    etags: Optional[list[str]] = None,
+    stage_to_disk: bool = False,
+) -> pa.Table:
+    """Loads and merges the source files, the source files' etags are appended to
+    `etags` if provided. With `stage_to_disk`, each source table is staged on local
+    disk as soon as it's parsed, so the merged table is memory-mapped.
+
+    Source files may also be converted files, i.e. parquet or compressed arrow files,
+    which are read as is (the type overrides only apply to CSV files).
+    """
     opts = csv.ConvertOptions(column_types=type_overrides) if type_overrides else None
 
     def download(i, k):
-        data = S3_CLIENT.get_object(Bucket=SOURCE_BUCKET, Key=k)["Body"]
-        table = csv.read_csv(gzip.open(data), convert_options=opts)
+        obj = get_storage().get_object(k)
+        if k.endswith(".csv.gz"):
+            table = csv.read_csv(gzip.open(obj.body), convert_options=opts)
+        elif _file_format(k) == "parquet":
+            table = pq.read_table(obj.body)
+        else:
+            table = _read_arrow_stream(obj.body, k.rsplit(".", 1)[-1])
+        if stage_to_disk:
+            table = _stage_table(table)
         show_memory(f"loaded table {i}")
-        return table
+        return table, obj.etag
 
     # for large datasets such as caiso prices, aws lambda hits max memory (10gb)
     # at around 250 files/days, so we probably can't use lambda to batch yearly files.
     with concurrent.futures.ThreadPoolExecutor(10) as executor:
         idx = range(1, len(source_keys) + 1)
-        tables = [r for r in executor.map(download, idx, source_keys)]
+        results = [r for r in executor.map(download, idx, source_keys)]
+
+    tables = [table for table, _ in results]
+    if etags is not None:
+        etags.extend(etag for _, etag in results)
 
     table = pa.concat_tables(tables, promote=True)
 
@@ -221,17 +459,67 @@ def _get_arrow_table(source_keys: list[str], type_overrides=None) -> pa.Table:
     return table
 
 
+def _stage_table(table: pa.Table) -> pa.Table:
+    """Writes a table to an uncompressed Arrow IPC file and memory-maps it back, such
+    that its buffers are backed by the page cache, which the OS can evict under memory
+    pressure, rather than by process memory. The file is unlinked straight away, its
+    disk space is freed once the table is garbage collected.
+    """
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    path = os.path.join(STAGING_DIR, f"{uuid.uuid4()}.arrow")
+    try:
+        with pa.OSFile(path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        # zero-copy, the table's buffers point into the memory map
+        return pa.ipc.open_file(pa.memory_map(path)).read_all()
+    finally:
+        os.remove(path)
+
+
+def _file_format(key: str) -> str:
+    # i.e. '<ts>.parquet' (athena) or '<ts>.<format>.<compression>' (dataclient)
+    return key.rsplit("/", 1)[-1].split(".")[1]
+
+
+def _read_arrow_stream(source: pa.NativeFile, compression: str) -> pa.Table:
+    # Dataclient arrow files are IPC streams compressed as a whole.
+    codec = _PYARROW_ARG_TRANSLATION.get(compression, compression)
+    if codec == "snappy":
+        # snappy doesn't support streaming decompression, but the data is prefixed with
+        # its uncompressed size, which is needed for a one-shot decompression
+        buf = source.read_buffer()
+        data = pa.Codec(codec).decompress(buf, _snappy_size(buf))
+        return pa.ipc.open_stream(data).read_all()
+    with pa.CompressedInputStream(source, codec) as stream:
+        return pa.ipc.open_stream(stream).read_all()
+
+
+def _snappy_size(buf: pa.Buffer) -> int:
+    # a little-endian base-128 varint
+    size, shift = 0, 0
+    for byte in memoryview(buf)[:10]:
+        size |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    return size
+
+
 def _compress_to_bytes(
     table: pa.Table,
     compression: str,
     level: Optional[int] = None,
     to_parquet: bool = False,
+    row_group_size: Optional[int] = None,
 ) -> bytes:
     sink = io.BytesIO()
     codec_key = _PYARROW_ARG_TRANSLATION.get(compression, compression)
 
     if to_parquet:
-        pq.write_table(table, sink, compression=codec_key)
+        pq.write_table(
+            table, sink, compression=codec_key, row_group_size=row_group_size
+        )
         data = sink.getvalue()
 
     else:
@@ -248,35 +536,36 @@ def _compress_to_bytes(
     return data
 
 
-def batch_items(itr: Iterable, chunk_size: int):
-    itr = iter(itr)
-    chunk = list(islice(itr, chunk_size))
-    while chunk:
-        yield chunk
-        chunk = list(islice(itr, chunk_size))
+def upload_file(key: str, data: bytes, fingerprint: Optional[str] = None):
+    metadata = {"fingerprint": fingerprint} if fingerprint else None
+    get_storage().put(key, data, metadata=metadata)
 
 
-def _s3_list(bucket: str, prefix: str, dirs_only: bool = False) -> Iterator[str]:
-    pg = S3_CLIENT.get_paginator("list_objects_v2")
-    arg = {"Bucket": bucket, "Prefix": prefix}
-    if dirs_only:
-        arg["Delimiter"] = "/"
-        yield from (
-            i["Prefix"] for p in pg.paginate(**arg) for i in p.get("CommonPrefixes", ())
-        )
-    else:
-        yield from (i["Key"] for p in pg.paginate(**arg) for i in p.get("Contents", ()))
+def delete_stale_files(dest_prefix: str, keys: set[str]):
+    """Deletes the files in the athena partitions of the keys that weren't (re)written,
+    eg. the buckets of a previous bucket count, or of a partition written before
+    bucketing was enabled or disabled.
+    """
+    partitions = set()
+    for key in keys:
+        coll, ds, partition = key.removeprefix(dest_prefix).split("/")[:3]
+        partitions.add(os.path.join(dest_prefix, coll, ds, partition, ""))
+    stale = [
+        k for p in sorted(partitions) for k in get_storage().list(p) if k not in keys
+    ]
+    if stale:
+        logger.info(f"Deleting {len(stale)} stale files, eg. '{stale[0]}'")
+        get_storage().delete(stale)
 
 
-def s3_multi_p_upload(bucket: str, s3_key: str, file_obj):
-    extra_args = {"ACL": "bucket-owner-full-control"}
-    S3_CLIENT.upload_fileobj(
-        Bucket=bucket,
-        Key=s3_key,
-        Fileobj=file_obj,
-        Config=S3_CONFIG,
-        ExtraArgs=extra_args,
-    )
+def update_manifest(collection: str, dataset: str, dest_prefix: str, entries: list):
+    dataset_prefix = os.path.join(dest_prefix, collection, dataset, "")
+    manifest.append_entries(get_storage(), dataset_prefix, entries)
+
+
+def read_manifest(collection: str, dataset: str, dest_prefix: str) -> pa.Table:
+    dataset_prefix = os.path.join(dest_prefix, collection, dataset, "")
+    return manifest.read_manifest(get_storage(), dataset_prefix)
 
 
 def _gen_s3db_key(
@@ -293,7 +582,12 @@ def _gen_s3db_key(
 
 
 def _gen_athena_key(
-    file_start: int, coll: str, ds: str, dest_prefix: str, partition_size: str
+    file_start: int,
+    coll: str,
+    ds: str,
+    dest_prefix: str,
+    partition_size: str,
+    bucket: Optional[int] = None,
 ) -> str:
     # Although Athena partition projection allows any format, use a format that is
     # with the date or timestamp data type in Presto such that querying partitions using
@@ -301,37 +595,15 @@ def _gen_athena_key(
     dt_fmt = PARTITIONS[partition_size]["format"]
     partition_val = datetime.fromtimestamp(file_start, timezone.utc).strftime(dt_fmt)
     partition_key = gen_partition_key(partition_size)
-    filename = f"{partition_key}={partition_val}/{file_start}.parquet"
-    return os.path.join(dest_prefix, coll, ds, filename)
-
-
-def group_s3keys_by_partition(
-    source_keys: list[str], partition_size: str
-) -> Iterator[tuple[tuple[str, str, int], list[str]]]:
-    def gk_func(key: str) -> tuple[str, str, int]:
-        coll, ds = key.removeprefix(SOURCE_PREFIX).split("/")[:2]
-        file_start = floor_dt(extract_datetime(key), partition_size)
-        return coll, ds, int(file_start.timestamp())
-
-    source_keys.sort()
-    for gk, keys in groupby(source_keys, key=gk_func):
-        yield gk, list(keys)
-
-
-def floor_dt(dt: datetime, period: str):
-    if period == "hour":
-        return datetime(dt.year, dt.month, dt.day, dt.hour)
-    elif period == "day":
-        return datetime(dt.year, dt.month, dt.day)
-    elif period == "month":
-        return datetime(dt.year, dt.month, 1)
-    elif period == "year":
-        return datetime(dt.year, 1, 1)
-    else:
-        raise Exception(f"invalid period: {period}")
+    partition = f"{partition_key}={partition_val}"
+    if bucket is not None:
+        partition = os.path.join(partition, f"{BUCKET_PARTITION_KEY}={bucket}")
+    return os.path.join(dest_prefix, coll, ds, partition, f"{file_start}.parquet")
 
 
 def show_memory(text: str):
+    import psutil
+
     process = psutil.Process(os.getpid())
     mb = process.memory_info().rss / 1_000_000
     logger.debug(f"RSS: {mb}MB ({text})")
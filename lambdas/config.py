@@ -0,0 +1,86 @@
+import os
+
+
+# Configs shared by all lambda functions and the CLI. Keep this module free of heavy
+# imports, it's loaded on every cold start.
+
+# non-versioned bucket
+SOURCE_BUCKET = "invenia-datafeeds-output"
+SOURCE_PREFIX = "version5/aurora/gz/"
+
+COMPRESSION = ["br", "gz", "lz4", "zst", "sz"]
+COMPRESSION_LEVELS = {
+    # Higher values are slower and have higher compression ratios.
+    "zst": range(-131072, 22 + 1),  # min: -131072, max: 22, default: 1
+    "br": range(0, 11 + 1),  # min: 0, max: 11, pyarrow default = 8
+    # Higher levels use more RAM but are faster and have higher compression ratios.
+    "gz": range(1, 9 + 1),  # min: 1, max: 9, pyarrow default = 9
+}
+COMPRESSION_LEVELS_DEFAULTS = {
+    "zst": 22,
+    "br": 9,
+    "gz": 9,
+}
+_PYARROW_ARG_TRANSLATION = {
+    "br": "brotli",
+    "gz": "gzip",
+    "sz": "snappy",
+    "zst": "zstd",
+}
+
+DEST_STORES = ["athena", "dataclient"]
+FILE_FORMATS = ["arrow", "parquet"]
+# Partition key and partition projections configs used in Athena
+PARTITIONS = {
+    "hour": {
+        # We use python format, cuz we're running python
+        "format": "%Y-%m-%d %H:%M:%S",
+        # Athena uses java date format
+        "projection_format": "yyyy-MM-dd HH:mm:ss",
+        "type": "timestamp",
+        "unit": "HOURS",
+    },
+    "day": {
+        "format": "%Y-%m-%d",
+        "projection_format": "yyyy-MM-dd",
+        "type": "date",
+        "unit": "DAYS",
+    },
+    "month": {
+        "format": "%Y-%m-%d",
+        "projection_format": "yyyy-MM-dd",
+        "type": "date",
+        "unit": "MONTHS",
+    },
+    "year": {
+        "format": "%Y-%m-%d",
+        "projection_format": "yyyy-MM-dd",
+        "type": "date",
+        "unit": "YEARS",
+    },
+}
+gen_partition_key = lambda partition_size: f"{partition_size}_partition"  # type: ignore
+# Optional secondary partition of the athena store, a hash bucket of a superkey column,
+# i.e. 'abs(<col>) % <n>' for int columns and 'crc32(to_utf8(<col>)) % <n>' for strings
+BUCKET_PARTITION_KEY = "superkey_bucket"
+MAX_BUCKET_COUNT = 1024
+
+# Rollups are aggregations of a dataset's value columns per superkey and time period
+# (eg. hourly min/max/mean), written as separate athena datasets next to the dataset.
+ROLLUP_AGGREGATIONS = ["min", "max", "mean", "count", "last"]
+gen_rollup_dataset = lambda ds, period: f"{ds}_rollup_{period}"  # type: ignore
+
+
+def parse_rollup_dataset(name: str):
+    """Returns the (dataset, period) of a rollup dataset, or None for other datasets."""
+    dataset, sep, period = name.rpartition("_rollup_")
+    return (dataset, period) if sep and dataset and period in PARTITIONS else None
+
+
+# All source and dest data is read from / written to this store, which defaults to the
+# S3DB bucket. Point it at a local directory (file://<dir>) to run conversions on
+# local disk, eg. for benchmarks.
+STORAGE_URI = os.environ.get("STORAGE_URI", f"s3://{SOURCE_BUCKET}")
+# Profiles of handler invocations are uploaded here, and used to calibrate backfill
+# estimates, see `lambdas.profiling` and `lambdas.planner`.
+PROFILE_PREFIX = os.environ.get("PROFILE_PREFIX", "version5/s3dbconverter/diagnostics/")
@@ -0,0 +1,206 @@
+from typing import Optional
+
+from lambdas.config import (
+    BUCKET_PARTITION_KEY,
+    PARTITIONS,
+    ROLLUP_AGGREGATIONS,
+    gen_partition_key,
+    parse_rollup_dataset,
+)
+from lambdas.s3db import (
+    extract_datetime,
+    floor_dt,
+    get_bucket_column,
+    get_first_key,
+    get_rollup_columns,
+    get_s3db_type_map,
+)
+
+
+# Glue tables of the athena store, used by the CLI to manage the whole catalog and by
+# the prod listener to sync single tables on S3DB metadata changes. Keep this module
+# free of heavy imports, see `lambdas.config`.
+
+DATA_INPUT_FORMAT = "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat"
+DATA_OUTPUT_FORMAT = "org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat"
+SER_DER_LIB = "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe"
+PARQUET_COMPRESSION = "SNAPPY"
+# This type is different from the PartitionKeyType, it is only used during partition
+# projection, we want it to be always a 'date'
+PARTITION_PROJECTION_TYPE = "date"
+PARTITION_PROJECTION_INTERVAL = "1"
+# Only used if the start of a dataset can't be determined (i.e. it has no files yet)
+PARTITION_PROJECTION_DEFAULT_START = "2010-01-01"
+PARTITION_PROJECTION_END = "NOW+1WEEKS"
+
+# We have no way of knowing if the dataset uses big/small int/float because the S3DB
+# metadata doesn't specify it. Opting for the smaller size during Glue schema creation
+# leads to an error when querying later via Athena.
+# eg: 'GENERIC_INTERNAL_ERROR: Value 2156111684 exceeds MAX_INT'
+GLUE_TYPE_OVERRIDES = {
+    "target_start": "bigint",
+    "target_end": "bigint",
+    "release_date": "bigint",
+    "target_bounds": "tinyint",
+}
+GLUE_TYPE_CONVERSIONS = {
+    "str": "string",
+    "int": "bigint",
+    "float": "double",
+    "bool": "boolean",
+    "timedelta": "double",
+    "datetime": "bigint",
+    "list": "string",
+    "tuple": "string",
+}
+
+
+def get_glue_columns(
+    db: str, table: str, rollups: Optional[list[dict]] = None
+) -> list[dict]:
+    """The Glue columns of a table, from the S3DB type map of its dataset, or of the
+    rollup for rollup tables.
+    """
+    rollup = parse_rollup_dataset(table)
+    if rollup:
+        dataset, period = rollup
+        aggregations = next(
+            (r.get("aggregations") for r in rollups or [] if r["period"] == period),
+            None,
+        )
+        _, s3db_types = get_rollup_columns(
+            db, dataset, aggregations or ROLLUP_AGGREGATIONS
+        )
+    else:
+        s3db_types = get_s3db_type_map(db, table)
+
+    return [
+        {
+            "Name": k,
+            "Type": GLUE_TYPE_OVERRIDES.get(k, GLUE_TYPE_CONVERSIONS.get(v, v)),
+        }
+        for k, v in s3db_types.items()
+    ]
+
+
+def get_projection_range(db: str, table: str, partition_size: str) -> str:
+    """The partition projection range of a table, starting from the partition of
+    the dataset's first file, such that Athena doesn't plan over empty partitions.
+    """
+    # rollups start with the dataset they're aggregated from
+    rollup = parse_rollup_dataset(table)
+    first_key = get_first_key(db, rollup[0] if rollup else table)
+    if first_key is None:
+        start = PARTITION_PROJECTION_DEFAULT_START
+    else:
+        first_partition = floor_dt(extract_datetime(first_key), partition_size)
+        start = first_partition.strftime(PARTITIONS[partition_size]["format"])
+    return f"{start},{PARTITION_PROJECTION_END}"
+
+
+def gen_table_input(
+    db: str,
+    table: str,
+    data_location: str,
+    partition_size: str,
+    bucket_count: Optional[int] = None,
+    rollups: Optional[list[dict]] = None,
+) -> dict:
+    """The Glue `TableInput` of a table in the athena store at `data_location`, eg.
+    's3://<bucket>/version5/athena/parquet/sz/day/'.
+    """
+    partition_key = gen_partition_key(partition_size)
+    partition = PARTITIONS[partition_size]
+    pp_range = get_projection_range(db, table, partition_size)
+    partition_keys = [{"Name": partition_key, "Type": partition["type"]}]
+    parameters = {
+        f"projection.{partition_key}.type": PARTITION_PROJECTION_TYPE,
+        f"projection.{partition_key}.interval.unit": partition["unit"],
+        f"projection.{partition_key}.interval": PARTITION_PROJECTION_INTERVAL,
+        f"projection.{partition_key}.range": pp_range,
+        f"projection.{partition_key}.format": partition["projection_format"],
+        "projection.enabled": "TRUE",
+        "parquet.compression": PARQUET_COMPRESSION,
+    }
+    # rollups are small, so they aren't bucketed
+    bucket_column = (
+        bucket_count
+        and not parse_rollup_dataset(table)
+        and get_bucket_column(db, table)
+    )
+    if bucket_column:
+        partition_keys.append({"Name": BUCKET_PARTITION_KEY, "Type": "int"})
+        parameters.update(
+            {
+                f"projection.{BUCKET_PARTITION_KEY}.type": "integer",
+                f"projection.{BUCKET_PARTITION_KEY}.range": f"0,{bucket_count - 1}",
+                # not used by Athena, documents how to select buckets in queries
+                f"{BUCKET_PARTITION_KEY}.column": bucket_column,
+                f"{BUCKET_PARTITION_KEY}.count": str(bucket_count),
+            }
+        )
+    return {
+        "Name": table,
+        "StorageDescriptor": {
+            "Columns": get_glue_columns(db, table, rollups),
+            "Location": f"{data_location}{db}/{table}",
+            "InputFormat": DATA_INPUT_FORMAT,
+            "OutputFormat": DATA_OUTPUT_FORMAT,
+            # None because we already use parquet columnar compression, which
+            # is specified in the table properties, not here.
+            "Compressed": False,
+            "SerdeInfo": {"SerializationLibrary": SER_DER_LIB},
+        },
+        "PartitionKeys": partition_keys,
+        "TableType": "EXTERNAL_TABLE",
+        "Parameters": parameters,
+    }
+
+
+def get_table_layout(table: dict) -> dict:
+    """The location, columns, partition keys and parameters of a table (or
+    `TableInput`), i.e. everything that depends on S3DB and the store's settings. The
+    partition projection range is left out, it's refreshed separately as datasets grow.
+    """
+    range_keys = {f"projection.{gen_partition_key(p)}.range" for p in PARTITIONS}
+    parameters = table.get("Parameters", {})
+    return {
+        "Location": table["StorageDescriptor"].get("Location"),
+        "Columns": [
+            {"Name": c["Name"], "Type": c["Type"]}
+            for c in table["StorageDescriptor"]["Columns"]
+        ],
+        "PartitionKeys": [
+            {"Name": k["Name"], "Type": k["Type"]}
+            for k in table.get("PartitionKeys", [])
+        ],
+        "Parameters": {k: v for k, v in parameters.items() if k not in range_keys},
+    }
+
+
+def sync_glue_table(glue, db: str, table: str, **kwargs) -> Optional[str]:
+    """Creates a table (and its database) if it doesn't exist, or updates it if its
+    layout (location, columns, partition keys and projection parameters) doesn't
+    match the S3DB type map and the store's settings anymore. Returns the operation,
+    i.e. 'created' or 'updated', or None if the table is already up to date. The kwargs
+    are passed on to `gen_table_input`.
+    """
+    table_input = gen_table_input(db, table, **kwargs)
+    try:
+        current = glue.get_table(DatabaseName=db, Name=table)["Table"]
+    except glue.exceptions.EntityNotFoundException:
+        try:
+            glue.create_database(DatabaseInput={"Name": db})
+        except glue.exceptions.AlreadyExistsException:
+            pass
+        try:
+            glue.create_table(DatabaseName=db, TableInput=table_input)
+            return "created"
+        # created concurrently, eg. by a retried event of the same metadata file
+        except glue.exceptions.AlreadyExistsException:
+            current = glue.get_table(DatabaseName=db, Name=table)["Table"]
+
+    if get_table_layout(current) == get_table_layout(table_input):
+        return None
+    glue.update_table(DatabaseName=db, TableInput=table_input)
+    return "updated"
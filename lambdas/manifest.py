@@ -0,0 +1,159 @@
+import hashlib
+import io
+import os
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from loguru import logger
+from pyarrow import parquet as pq
+
+from lambdas.storage import PreconditionFailed, Storage
+
+
+# Each converted dataset has a manifest describing every dest file, stored alongside the
+# dest files, i.e. '<dest_prefix>/<coll>/<ds>/_manifest.parquet'. Athena ignores files
+# starting with an underscore.
+MANIFEST_FILE = "_manifest.parquet"
+# Concurrent handlers don't update the manifest directly (which would contend on a
+# single object during backfills), instead, each handler writes its entries to a new
+# file in this directory, which are periodically compacted into the manifest.
+MANIFEST_PENDING_DIR = "_manifest/"
+MANIFEST_COMPACTION_THRESHOLD = int(os.environ.get("MANIFEST_COMPACTION_THRESHOLD", 50))
+
+MANIFEST_SCHEMA = pa.schema(
+    [
+        ("key", pa.string()),
+        ("file_start", pa.int64()),
+        ("rows", pa.int64()),
+        ("bytes", pa.int64()),
+        ("min_target_start", pa.int64()),
+        ("max_target_start", pa.int64()),
+        ("min_release_date", pa.int64()),
+        ("max_release_date", pa.int64()),
+        ("schema_hash", pa.string()),
+        ("source_etags", pa.list_(pa.string())),
+        ("converted_at", pa.timestamp("ms", tz="UTC")),
+    ]
+)
+
+
+def manifest_entry(
+    key: str, file_start: int, table: pa.Table, data: bytes, source_etags: list[str]
+) -> dict:
+    entry = {
+        "key": key,
+        "file_start": file_start,
+        "rows": len(table),
+        "bytes": len(data),
+        "schema_hash": schema_hash(table.schema),
+        "source_etags": source_etags,
+        "converted_at": datetime.now(timezone.utc),
+    }
+    for col in ("target_start", "release_date"):
+        min_max: dict = {"min": None, "max": None}
+        if col in table.column_names and len(table):
+            min_max = pc.min_max(table.column(col)).as_py()
+        for stat, val in min_max.items():
+            entry[f"{stat}_{col}"] = None if val is None else int(val)
+    return entry
+
+
+def schema_hash(schema: pa.Schema) -> str:
+    # exclude metadata, eg. pandas metadata is added to hourly partitions
+    return hashlib.sha256(schema.remove_metadata().serialize()).hexdigest()[:16]
+
+
+def append_entries(storage: Storage, dataset_prefix: str, entries: list[dict]):
+    """Records entries for a dataset, compacting the pending entries into the manifest
+    once enough of them have accumulated.
+    """
+    if not entries:
+        return
+
+    table = pa.Table.from_pylist(entries, schema=MANIFEST_SCHEMA)
+    # unique name per write, so pending files are never overwritten and can be safely
+    # deleted once compacted
+    key = os.path.join(dataset_prefix, MANIFEST_PENDING_DIR, f"{uuid.uuid4()}.parquet")
+    storage.put(key, _to_parquet(table))
+
+    pending = list(storage.list(os.path.join(dataset_prefix, MANIFEST_PENDING_DIR)))
+    if len(pending) >= MANIFEST_COMPACTION_THRESHOLD:
+        compact(storage, dataset_prefix, pending)
+
+
+def compact(storage: Storage, dataset_prefix: str, pending: Optional[list[str]] = None):
+    """Merges pending entries into the manifest. This is a no-op if another handler
+    updates the manifest concurrently, the pending files are left for the next run.
+    """
+    if pending is None:
+        pending = list(storage.list(os.path.join(dataset_prefix, MANIFEST_PENDING_DIR)))
+
+    manifest_key = os.path.join(dataset_prefix, MANIFEST_FILE)
+    manifest, etag = _read_manifest(storage, manifest_key)
+    tables = [manifest] if manifest is not None else []
+    try:
+        tables += [pq.read_table(storage.get(k)) for k in pending]
+    except FileNotFoundError:
+        logger.info(f"Manifest '{manifest_key}' is being compacted, skipping...")
+        return
+    if not tables:
+        return
+
+    merged = _dedupe(pa.concat_tables(tables))
+    try:
+        storage.put(
+            manifest_key,
+            _to_parquet(merged),
+            if_match=etag,
+            if_none_match=etag is None,
+        )
+    except PreconditionFailed:
+        logger.info(f"Manifest '{manifest_key}' was updated concurrently, skipping...")
+        return
+
+    storage.delete(pending)
+    logger.info(f"Compacted {len(pending)} pending entries into '{manifest_key}'")
+
+
+def read_manifest(storage: Storage, dataset_prefix: str) -> pa.Table:
+    """Reads all entries of a dataset, including any that aren't compacted yet."""
+    # list pending entries first, anything compacted after that is in the manifest
+    pending = list(storage.list(os.path.join(dataset_prefix, MANIFEST_PENDING_DIR)))
+    manifest, _ = _read_manifest(storage, os.path.join(dataset_prefix, MANIFEST_FILE))
+    tables = [manifest] if manifest is not None else []
+    for key in pending:
+        try:
+            tables.append(pq.read_table(storage.get(key)))
+        except FileNotFoundError:
+            # compacted and deleted since being listed, already in the manifest
+            continue
+    if not tables:
+        return MANIFEST_SCHEMA.empty_table()
+    return _dedupe(pa.concat_tables(tables))
+
+
+def _read_manifest(
+    storage: Storage, key: str
+) -> tuple[Optional[pa.Table], Optional[str]]:
+    try:
+        obj = storage.get_object(key)
+    except FileNotFoundError:
+        return None, None
+    return pq.read_table(obj.body), obj.etag
+
+
+def _dedupe(table: pa.Table) -> pa.Table:
+    # a dest file may be converted multiple times, only keep the latest entry per key
+    table = table.sort_by([("key", "ascending"), ("converted_at", "descending")])
+    keys = table.column("key").to_pylist()
+    keep = [i for i, k in enumerate(keys) if i == 0 or keys[i - 1] != k]
+    return table.take(keep).sort_by("file_start")
+
+
+def _to_parquet(table: pa.Table) -> bytes:
+    sink = io.BytesIO()
+    pq.write_table(table, sink, compression="zstd")
+    return sink.getvalue()
@@ -0,0 +1,42 @@
+import json
+import os
+import time
+from typing import Optional
+
+
+# Metrics are printed in CloudWatch embedded metric format, rather than calling the
+# CloudWatch API, so that emitting them is free and doesn't slow down handlers.
+
+
+def emit_metrics(
+    metrics: dict[str, float],
+    namespace: str = "S3DBConverter",
+    units: Optional[dict[str, str]] = None,
+):
+    """Prints metrics as a CloudWatch embedded metric format log line, which CloudWatch
+    extracts into metrics for the lambda function.
+    """
+    units = units or {}
+    function = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local")
+    definitions = [
+        {
+            "Name": name,
+            "Unit": units.get(name, "Seconds" if "Seconds" in name else "Count"),
+        }
+        for name in metrics
+    ]
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": namespace,
+                    "Dimensions": [["FunctionName"]],
+                    "Metrics": definitions,
+                }
+            ],
+        },
+        "FunctionName": function,
+        **metrics,
+    }
+    print(json.dumps(record), flush=True)
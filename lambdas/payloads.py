@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from lambdas.clients import get_storage
+
+
+# Backfill requests list the source keys of a dest partition, which doesn't fit in an
+# SQS message (max 256KB, also for a whole batch of 10) for large partitions of small
+# source files. Requests are compacted before they're sent, see `compact_request`.
+# Keep this module free of heavy imports, see `lambdas.config`.
+
+# Key lists that don't fit in a request are stored here, by date and the hash of their
+# content, i.e. '<PAYLOAD_PREFIX><date>/<hash>.json'.
+PAYLOAD_PREFIX = os.environ.get("PAYLOAD_PREFIX", "version5/s3dbconverter/payloads/")
+# Payloads are deleted after this many days, i.e. once their requests can't be in the
+# queues (or dead-letter queues, which keep messages for 14 days) anymore.
+PAYLOAD_RETENTION_DAYS = int(os.environ.get("PAYLOAD_RETENTION_DAYS", 15))
+# Max size of a request with its keys inlined, such that a batch of 10 always fits.
+MAX_INLINE_PAYLOAD_BYTES = int(os.environ.get("MAX_INLINE_PAYLOAD_BYTES", 24_000))
+
+S3DB_KEY_SUFFIX = re.compile(r"year=(\d{4})/(\d+)\.csv\.gz")
+
+
+def compact_request(request: dict) -> dict:
+    """Replaces the 's3key_suffixes' of a request with an 's3key_range' if the keys are
+    regularly spaced S3DB files (eg. daily files), and otherwise stores them in S3 and
+    passes an 's3key_suffixes_ref' instead if the request would be too large.
+    """
+    suffixes = request["s3key_suffixes"]
+    request = {k: v for k, v in request.items() if k != "s3key_suffixes"}
+
+    key_range = encode_key_range(suffixes)
+    if key_range is not None:
+        request["s3key_range"] = key_range
+        return request
+
+    request["s3key_suffixes"] = suffixes
+    if len(json.dumps(request)) <= MAX_INLINE_PAYLOAD_BYTES:
+        return request
+
+    data = json.dumps(suffixes).encode()
+    # identical key lists, eg. of retried requests, are only stored once a day
+    date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    key = f"{PAYLOAD_PREFIX}{date}/{hashlib.sha256(data).hexdigest()}.json"
+    if get_storage().head(key) is None:
+        get_storage().put(key, data)
+    del request["s3key_suffixes"]
+    request["s3key_suffixes_ref"] = key
+    return request
+
+
+def delete_expired_payloads():
+    """Deletes the payloads stored more than `PAYLOAD_RETENTION_DAYS` ago."""
+    expired = datetime.now(timezone.utc) - timedelta(days=PAYLOAD_RETENTION_DAYS)
+    get_storage().delete_dated(PAYLOAD_PREFIX, expired.strftime("%Y-%m-%d"))
+
+
+def get_source_keys(request: dict) -> list[str]:
+    """The source keys of a backfill request, compacted or not."""
+    if "s3key_range" in request:
+        suffixes = decode_key_range(request["s3key_range"])
+    elif "s3key_suffixes_ref" in request:
+        suffixes = json.load(get_storage().get(request["s3key_suffixes_ref"]))
+    else:
+        suffixes = request["s3key_suffixes"]
+    return [os.path.join(request["s3key_prefix"], s) for s in suffixes]
+
+
+def encode_key_range(suffixes: list[str]) -> Optional[dict]:
+    """Encodes S3DB key suffixes (eg. 'year=2020/1577836800.csv.gz') with timestamps
+    at a fixed step as `{"start": .., "step": .., "count": ..}`, returns None for any
+    other keys.
+    """
+    matches = [S3DB_KEY_SUFFIX.fullmatch(s) for s in suffixes]
+    if len(suffixes) < 2 or not all(matches):
+        return None
+
+    timestamps = [int(m[2]) for m in matches]  # type: ignore
+    start, step = timestamps[0], timestamps[1] - timestamps[0]
+    key_range = {"start": start, "step": step, "count": len(suffixes)}
+    # also checks that the year partitions are as expected
+    return key_range if decode_key_range(key_range) == suffixes else None
+
+
+def decode_key_range(key_range: dict) -> list[str]:
+    suffixes = []
+    for i in range(key_range["count"]):
+        ts = key_range["start"] + i * key_range["step"]
+        year = datetime.fromtimestamp(ts, tz=timezone.utc).year
+        suffixes.append(f"year={year}/{ts}.csv.gz")
+    return suffixes
@@ -0,0 +1,193 @@
+import os
+import threading
+from collections import deque
+from types import GeneratorType
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+
+# In-flight bytes allowed in the queues of all pipelines, i.e. shared by the records
+# that an invocation processes concurrently, defaults to a quarter of the lambda
+# function's memory.
+PIPELINE_MAX_BYTES = int(
+    os.environ.get(
+        "PIPELINE_MAX_BYTES",
+        int(os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", 2048)) * 1024**2 // 4,
+    )
+)
+PIPELINE_MAX_ITEMS = int(os.environ.get("PIPELINE_MAX_ITEMS", 2))
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+class _PipelineStopped(Exception):
+    pass
+
+
+class ByteBudget:
+    """The bytes in flight in the queues of one or more pipelines."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, nbytes: int, force: bool = False) -> bool:
+        with self._lock:
+            if not force and self.used + nbytes > self.max_bytes:
+                return False
+            self.used += nbytes
+            return True
+
+    def release(self, nbytes: int):
+        with self._lock:
+            self.used -= nbytes
+
+
+# shared by all pipelines of the process, see `PIPELINE_MAX_BYTES`
+PIPELINE_BUDGET = ByteBudget(PIPELINE_MAX_BYTES)
+
+
+class BoundedQueue:
+    """A FIFO queue bounded by item count, whose items' bytes are taken from a budget.
+    A put blocks while the queue is full or the budget is used up, unless the queue is
+    empty, so that a single item larger than the budget can still make progress
+    through the pipeline (and pipelines sharing a budget can't starve each other).
+    """
+
+    def __init__(self, max_items: int, budget: ByteBudget, stop: threading.Event):
+        self.max_items = max_items
+        self.budget = budget
+        self._stop = stop
+        self._items: deque = deque()
+        self._cond = threading.Condition()
+
+    def _try_put(self, nbytes: int) -> bool:
+        if not self._items:
+            return self.budget.acquire(nbytes, force=True)
+        return len(self._items) < self.max_items and self.budget.acquire(nbytes)
+
+    def put(self, item: Any, nbytes: int = 0):
+        with self._cond:
+            # other queues of the budget don't notify this one, hence the timeout
+            while not self._stop.is_set() and not self._try_put(nbytes):
+                self._cond.wait(0.1)
+            if self._stop.is_set():
+                raise _PipelineStopped()
+            self._items.append((item, nbytes))
+            self._cond.notify_all()
+
+    def get(self) -> Any:
+        with self._cond:
+            while not self._items and not self._stop.is_set():
+                self._cond.wait(0.1)
+            if not self._items:
+                raise _PipelineStopped()
+            item, nbytes = self._items.popleft()
+            self.budget.release(nbytes)
+            self._cond.notify_all()
+            return item
+
+    def clear(self):
+        """Drops the remaining items of a stopped pipeline, returning their bytes."""
+        with self._cond:
+            self.budget.release(sum(nbytes for _, nbytes in self._items))
+            self._items.clear()
+
+
+def nbytes(item: Any) -> int:
+    """Estimates the in-memory size of a pipeline item."""
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        return len(item)
+    if isinstance(item, (tuple, list)):
+        return sum(nbytes(i) for i in item)
+    return getattr(item, "nbytes", 0)
+
+
+def pipelined(
+    source: Iterable,
+    *stages: Callable,
+    max_items: int = PIPELINE_MAX_ITEMS,
+    max_bytes: Optional[int] = None,
+) -> Iterator:
+    """Runs the source iterator and each stage in its own thread, connected by bounded
+    queues, such that stages overlap across items. Outputs of the last stage are yielded
+    to the caller, which acts as the final stage of the pipeline.
+
+    Stages either return a single output, or are generator functions yielding any number
+    of outputs per input (eg. splitting a daily table into hourly partitions).
+
+    An exception raised by the source or any stage stops the pipeline and is re-raised
+    to the caller.
+
+    The queues' items are bounded by `PIPELINE_BUDGET`, which is shared by concurrent
+    pipelines, or by a budget of `max_bytes` of the pipeline's own.
+    """
+    stop = threading.Event()
+    budget = PIPELINE_BUDGET if max_bytes is None else ByteBudget(max_bytes)
+    queues = [BoundedQueue(max_items, budget, stop) for _ in range(len(stages) + 1)]
+
+    def put_all(outputs: Iterable, q: BoundedQueue):
+        for out in outputs:
+            q.put(out, nbytes(out))
+
+    def run_source(q_out: BoundedQueue):
+        try:
+            try:
+                put_all(source, q_out)
+                q_out.put(_DONE)
+            except _PipelineStopped:
+                raise
+            except BaseException as e:
+                q_out.put(_Failure(e))
+        except _PipelineStopped:
+            pass
+
+    def run_stage(stage: Callable, q_in: BoundedQueue, q_out: BoundedQueue):
+        try:
+            while True:
+                item = q_in.get()
+                if item is _DONE or isinstance(item, _Failure):
+                    q_out.put(item)
+                    break
+                try:
+                    result = stage(item)
+                    put_all(
+                        result if isinstance(result, GeneratorType) else [result], q_out
+                    )
+                except _PipelineStopped:
+                    raise
+                except BaseException as e:
+                    q_out.put(_Failure(e))
+                    break
+        except _PipelineStopped:
+            pass
+
+    threads = [threading.Thread(target=run_source, args=(queues[0],), daemon=True)]
+    for stage, q_in, q_out in zip(stages, queues, queues[1:]):
+        threads.append(
+            threading.Thread(target=run_stage, args=(stage, q_in, q_out), daemon=True)
+        )
+
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.exc
+            yield item
+    finally:
+        # also triggered when the caller stops consuming early, unblocks all stages
+        stop.set()
+        for t in threads:
+            t.join()
+        for q in queues:
+            q.clear()
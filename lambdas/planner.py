@@ -0,0 +1,218 @@
+import concurrent.futures
+import json
+import math
+import os
+from collections import defaultdict
+from typing import NamedTuple
+
+from lambdas.clients import get_storage
+from lambdas.config import PROFILE_PREFIX
+from lambdas.storage import S3_DOWNLOAD_CONFIG
+
+
+# Estimates of the cost of backfill requests, for dry runs of the request generator.
+# Memory usage and duration scale with the size of a request's source files, at rates
+# calibrated from the profiles of recent handler invocations (see `lambdas.profiling`)
+# of requests with similar settings. Keep this module free of heavy imports, see
+# `lambdas.config`.
+
+# The number of most recent profiles that estimates are calibrated from.
+CALIBRATION_SAMPLES = int(os.environ.get("CALIBRATION_SAMPLES", 100))
+# Max number of profile summaries fetched concurrently.
+CALIBRATION_WORKERS = 16
+# The request settings that profiles have to match to be used for calibration, the
+# least significant ones are dropped (from the end) until some profiles match.
+CALIBRATION_SETTINGS = [
+    "stage_to_disk",
+    "converted_source",
+    "file_format",
+    "compression",
+]
+# Memory used by the runtime and libraries, and the duration of an invocation,
+# regardless of the request.
+BASE_MEMORY_MB = 250
+BASE_SECONDS = 1.0
+# Used if no profiles match, gzipped CSVs grow about 10x once parsed, most of which is
+# kept out of process memory when staging to disk.
+DEFAULT_MEMORY_RATIO = {False: 10.0, True: 3.0}
+DEFAULT_SECONDS_PER_MB = 2.0
+
+
+class Calibration(NamedTuple):
+    # peak memory per byte of source files
+    memory_ratio: float
+    seconds_per_mb: float
+    # the number of profiles it's calibrated from, 0 for the defaults
+    samples: int
+
+
+class RequestEstimate(NamedTuple):
+    collection: str
+    dataset: str
+    first_key: str
+    source_keys: int
+    source_bytes: int
+    peak_memory_mb: float
+    seconds: float
+    s3_gets: int
+    s3_puts: int
+    # i.e. the request would run out of memory
+    exceeds_memory: bool
+
+
+class BackfillPlan(NamedTuple):
+    # of the handler function the requests are sent to
+    memory_mb: int
+    calibration: Calibration
+    requests: list[RequestEstimate]
+
+    @property
+    def exceeding_memory(self) -> list[RequestEstimate]:
+        return [r for r in self.requests if r.exceeds_memory]
+
+    def datasets(self) -> list[dict]:
+        """The totals of each dataset's requests."""
+        groups = defaultdict(list)
+        for r in self.requests:
+            groups[(r.collection, r.dataset)].append(r)
+        return [
+            {
+                "collection": coll,
+                "dataset": ds,
+                "requests": len(requests),
+                "source_bytes": sum(r.source_bytes for r in requests),
+                "max_request_bytes": max(r.source_bytes for r in requests),
+                "peak_memory_mb": round(max(r.peak_memory_mb for r in requests)),
+                "lambda_seconds": round(sum(r.seconds for r in requests), 1),
+                "s3_gets": sum(r.s3_gets for r in requests),
+                "s3_puts": sum(r.s3_puts for r in requests),
+                "exceeding_memory": sum(r.exceeds_memory for r in requests),
+            }
+            for (coll, ds), requests in groups.items()
+        ]
+
+    def to_dict(self) -> dict:
+        return {
+            "memory_mb": self.memory_mb,
+            "calibration": self.calibration._asdict(),
+            "datasets": self.datasets(),
+            "exceeding_memory": [r.first_key for r in self.exceeding_memory],
+        }
+
+
+def request_settings(request: dict) -> dict:
+    """The settings of a request (or generator event) that its cost depends on."""
+    return {
+        "stage_to_disk": request.get("stage_to_disk") or False,
+        "converted_source": bool(request.get("source_prefix")),
+        "file_format": request["file_format"],
+        "compression": request["compression"],
+    }
+
+
+def describe_request(request: dict, source_keys: list[str]) -> dict:
+    """The settings and source size of a request, recorded with its profile."""
+    # a listing of the keys' common prefix per partition (eg. '<ds>/year=2021/16')
+    # rather than a HEAD per key, source keys are usually consecutive files
+    keys = set(source_keys)
+    partitions = defaultdict(list)
+    for key in source_keys:
+        partitions[os.path.dirname(key)].append(key)
+    sizes = [
+        n
+        for partition_keys in partitions.values()
+        for k, n in get_storage().list_sizes(os.path.commonprefix(partition_keys))
+        if k in keys
+    ]
+    return {
+        **request_settings(request),
+        "source_keys": len(source_keys),
+        "source_bytes": sum(sizes),
+    }
+
+
+def load_profile_summaries(limit: int = CALIBRATION_SAMPLES) -> list[dict]:
+    """The summaries of the most recent profiles that describe their requests."""
+    # the keys are prefixed by date, only the latest dates are listed
+    storage = get_storage()
+    keys: list[str] = []
+    for date in reversed(list(storage.list(PROFILE_PREFIX, dirs_only=True))):
+        keys = [k for k in storage.list(date) if k.endswith(".json")] + keys
+        if len(keys) >= limit:
+            break
+
+    load = lambda key: json.load(storage.get(key))
+    with concurrent.futures.ThreadPoolExecutor(CALIBRATION_WORKERS) as executor:
+        summaries = list(executor.map(load, keys[-limit:]))
+    return [s for s in summaries if s.get("requests")]
+
+
+def calibrate(summaries: list[dict], settings: dict) -> Calibration:
+    """Fits the memory ratio and duration per MB to the profiles of invocations whose
+    requests all match the settings. The memory ratio is the largest one observed,
+    such that estimates rather flag too many requests than too few.
+    """
+    for n in range(len(CALIBRATION_SETTINGS), 0, -1):
+        keys = CALIBRATION_SETTINGS[:n]
+        samples = []
+        for summary in summaries:
+            requests = summary["requests"]
+            source_bytes = sum(r["source_bytes"] for r in requests)
+            matching = all(r.get(k) == settings[k] for r in requests for k in keys)
+            if matching and source_bytes > 0:
+                samples.append((source_bytes, summary))
+        if samples:
+            break
+    else:
+        memory_ratio = DEFAULT_MEMORY_RATIO[settings["stage_to_disk"]]
+        return Calibration(memory_ratio, DEFAULT_SECONDS_PER_MB, 0)
+
+    memory_ratio = max(s["arrow_peak_bytes"] / b for b, s in samples)
+    seconds = sum(max(0.0, s["duration_s"] - BASE_SECONDS) for _, s in samples)
+    mb = sum(b for b, _ in samples) / 1024**2
+    return Calibration(memory_ratio, seconds / mb, len(samples))
+
+
+def estimate_request(
+    collection: str,
+    dataset: str,
+    request: dict,
+    source_sizes: list[int],
+    calibration: Calibration,
+    memory_mb: int,
+    concurrency: int = 1,
+) -> RequestEstimate:
+    """Estimates a request's peak memory, duration and S3 requests. It exceeds the
+    memory if it wouldn't fit in the handler's memory `concurrency` times, i.e. the
+    number of requests processed concurrently by an invocation.
+    """
+    mb = sum(source_sizes) / 1024**2
+    data_mb = calibration.memory_ratio * mb
+    seconds = BASE_SECONDS + calibration.seconds_per_mb * mb
+
+    # objects larger than the threshold are fetched in ranges, see `S3Storage`
+    threshold = S3_DOWNLOAD_CONFIG.multipart_threshold
+    part_size = S3_DOWNLOAD_CONFIG.multipart_chunksize
+    gets = sum(1 + math.ceil(max(0, s - threshold) / part_size) for s in source_sizes)
+
+    # hour requests split a daily source file, every partition is written as a file
+    # per bucket and rollup, plus the manifest entries
+    partitions = 24 if request["partition_size"] == "hour" else 1
+    files = partitions * (
+        (request.get("bucket_count") or 1) + len(request.get("rollups") or [])
+    )
+    if request.get("skip_unchanged"):
+        gets += files
+
+    return RequestEstimate(
+        collection,
+        dataset,
+        os.path.join(request["s3key_prefix"], request["s3key_suffixes"][0]),
+        len(source_sizes),
+        sum(source_sizes),
+        BASE_MEMORY_MB + data_mb,
+        seconds,
+        gets,
+        files + 1,
+        BASE_MEMORY_MB + concurrency * data_mb > memory_mb,
+    )
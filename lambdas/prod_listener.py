@@ -4,36 +4,26 @@ from urllib.parse import unquote
 
 from loguru import logger
 
-from lambdas.common import SOURCE_PREFIX, SQS_CLIENT, copy_metadata_file
+from lambdas.clients import get_glue_client, get_sqs_client
+from lambdas.config import SOURCE_BUCKET, SOURCE_PREFIX, gen_rollup_dataset
+from lambdas.glue_catalog import sync_glue_table
+from lambdas.profiles import PROFILE_REGISTRY
+from lambdas.s3db import copy_metadata_file
 
 
 SQS_BATCH_SIZE = 10
-
-# define file conversion jobs here, currently only day-partitions are
-# supported for live conversions
-LIVE_STORES = [
-    {
-        "dest_store": "dataclient",
-        "dest_prefix": "version5/arrow/zst_lv22/day/",
-        "partition_size": "day",
-        "file_format": "arrow",
-        "compression": "zst",
-        "compression_level": 22,
-    },
-    {
-        "dest_store": "athena",
-        "dest_prefix": "version5/athena/parquet/sz/day/",
-        "partition_size": "day",
-        "file_format": "parquet",
-        "compression": "sz",
-    },
-]
+# Keeps the Glue tables of the athena store in sync with S3DB metadata changes, see
+# `sync_glue_tables`. The CLI can still be used to reconcile the whole catalog. Off by
+# default, the stack only enables it along with the role of the catalog's account.
+GLUE_CATALOG_SYNC = os.environ.get("GLUE_CATALOG_SYNC", "false").lower() == "true"
 
 
 def lambda_handler(event, context):
     """Prod listener function
     This lambda function receives new file and updated file events from the prod S3DB
-    bucket + prefix. File conversion requests are generated based on these live events.
+    bucket + prefix. File conversion requests are generated based on these live events,
+    for each of the live stores with the dataset's conversion profile, see
+    `lambdas.profiles`.
     """
 
     logger.info(event)
@@ -46,17 +36,55 @@ def lambda_handler(event, context):
 
         coll, ds, _ = s3_key.removeprefix(SOURCE_PREFIX).split("/", 2)
 
-        for dest in LIVE_STORES:
+        for dest in PROFILE_REGISTRY.resolve(coll, ds):
             dest_store = dest["dest_store"]
             # if it's a metadata file, just copy it directly
             if s3_key.endswith("METADATA.json") and dest_store == "dataclient":
                 logger.info(f"Copying over metadata file '{s3_key}'")
                 copy_metadata_file(coll, ds, dest["dest_prefix"])
 
+            # new datasets or type map changes, metadata files aren't converted
+            elif s3_key.endswith("METADATA.json"):
+                if dest_store == "athena" and GLUE_CATALOG_SYNC:
+                    sync_glue_tables(coll, ds, dest)
+
             # trigger a conversion job
             else:
                 logger.info(f"Triggering Conversion job for '{s3_key}'")
-                SQS_CLIENT.send_message(
-                    QueueUrl=os.environ["SINGLE_JOB_SQS_URL"],
-                    MessageBody=json.dumps({"s3_key": s3_key, **dest}),
+                request = {
+                    "s3_key": s3_key,
+                    # rewritten source files often don't change all partitions
+                    "skip_unchanged": True,
+                    # to measure the latency until the converted output is available
+                    "source_event_time": s3_event.get("eventTime"),
+                    **dest,
+                }
+                # live requests have their own queue and handler, so that they aren't
+                # queued up behind backfills
+                get_sqs_client().send_message(
+                    QueueUrl=os.environ["LIVE_CONVERSION_SQS_URL"],
+                    MessageBody=json.dumps(request),
                 )
+
+
+def sync_glue_tables(collection: str, dataset: str, dest: dict):
+    """Creates or updates the Glue tables of a dataset (and its rollups) in the athena
+    store, i.e. only the tables whose metadata changed rather than the whole catalog.
+    """
+    tables = [dataset]
+    tables += [
+        gen_rollup_dataset(dataset, r["period"]) for r in dest.get("rollups", [])
+    ]
+    # assumes the catalog role (if any) once for all tables
+    glue = get_glue_client()
+    for table in tables:
+        operation = sync_glue_table(
+            glue,
+            collection,
+            table,
+            data_location=f"s3://{SOURCE_BUCKET}/{dest['dest_prefix']}",
+            partition_size=dest["partition_size"],
+            bucket_count=dest.get("bucket_count"),
+            rollups=dest.get("rollups"),
+        )
+        logger.info(f"Glue table '{collection}.{table}': {operation or 'up to date'}")
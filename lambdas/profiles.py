@@ -0,0 +1,227 @@
+import copy
+import fnmatch
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+from loguru import logger
+
+from lambdas.clients import get_storage
+from lambdas.config import (
+    COMPRESSION,
+    COMPRESSION_LEVELS,
+    DEST_STORES,
+    FILE_FORMATS,
+    MAX_BUCKET_COUNT,
+    PARTITIONS,
+    ROLLUP_AGGREGATIONS,
+)
+
+
+# The live stores and their per-dataset conversion profiles are configured in a JSON
+# document in S3, so that they can be tuned without a stack update, eg.
+# {
+#   "version": 2,
+#   "stores": [
+#     {
+#       "dest_store": "dataclient",
+#       "dest_prefix": "version5/arrow/zst_lv22/day/",
+#       ...
+#       "profiles": [{"datasets": ["miso/*_price"], "compression_level": 3}]
+#     }
+#   ]
+# }
+# Each dataset ('<collection>/<dataset>') gets the settings of the first profile with a
+# matching pattern, on top of the store's settings. Keep this module free of heavy
+# imports, see `lambdas.config`.
+PROFILES_KEY = os.environ.get("PROFILES_KEY", "version5/s3dbconverter/profiles.json")
+# The document is re-read at most this often, if its etag changed.
+PROFILES_TTL_SECONDS = int(os.environ.get("PROFILES_TTL_SECONDS", 300))
+
+# Used until a profiles document is created.
+DEFAULT_STORES = [
+    {
+        "dest_store": "dataclient",
+        "dest_prefix": "version5/arrow/zst_lv22/day/",
+        "partition_size": "day",
+        "file_format": "arrow",
+        "compression": "zst",
+        "compression_level": 22,
+    },
+    {
+        "dest_store": "athena",
+        "dest_prefix": "version5/athena/parquet/sz/day/",
+        "partition_size": "day",
+        "file_format": "parquet",
+        "compression": "sz",
+    },
+]
+
+# The partition sizes supported by live stores.
+LIVE_PARTITIONS = ["hour", "day"]
+
+# The settings that profiles may override. A store's prefix, format and partition size
+# determine its layout, which has to be the same for all datasets, as does the codec
+# of dataclient stores, which is part of the file extensions. The athena store's
+# `bucket_count` and `rollups` determine the layout of its Glue tables, which are only
+# synced on S3DB metadata changes, so they're also set per store, and the catalog is
+# repaired with the CLI when they change.
+PROFILE_SETTINGS = {
+    "compression",
+    "compression_level",
+    "row_group_size",
+    "skip_unchanged",
+    "stage_to_disk",
+    "dictionary_encode",
+}
+
+
+class ProfileRegistry:
+    """The live stores and conversion profiles, loaded from the profiles document and
+    cached. If the document is updated with invalid settings, the previous version is
+    kept in use.
+    """
+
+    def __init__(self, key: str = PROFILES_KEY, ttl: float = PROFILES_TTL_SECONDS):
+        self.key = key
+        self.ttl = ttl
+        self.version: Optional[int] = None
+        self._stores: list[dict] = DEFAULT_STORES
+        self._etag: Optional[str] = None
+        self._checked = -float("inf")
+        self._lock = threading.Lock()
+
+    @property
+    def stores(self) -> list[dict]:
+        with self._lock:
+            if time.monotonic() - self._checked >= self.ttl:
+                self._refresh()
+        return self._stores
+
+    def resolve(self, collection: str, dataset: str) -> list[dict]:
+        """The settings of each live store for a dataset, i.e. the store's settings and
+        those of the first matching profile.
+        """
+        name = f"{collection}/{dataset}"
+        resolved = []
+        for store in self.stores:
+            settings = {k: v for k, v in store.items() if k != "profiles"}
+            for profile in store.get("profiles", []):
+                if any(fnmatch.fnmatchcase(name, p) for p in profile["datasets"]):
+                    overrides = {k: v for k, v in profile.items() if k != "datasets"}
+                    settings.update(copy.deepcopy(overrides))
+                    break
+            resolved.append(settings)
+        return resolved
+
+    def _refresh(self):
+        self._checked = time.monotonic()
+        info = get_storage().head(self.key)
+        if info is None:
+            if self._etag is not None:
+                logger.warning(
+                    f"Profiles '{self.key}' were deleted, using the defaults"
+                )
+                self._stores = DEFAULT_STORES
+                self._etag = None
+                self.version = None
+            return
+        if info.etag == self._etag:
+            return
+
+        obj = get_storage().get_object(self.key)
+        try:
+            document = json.load(obj.body)
+            validate_profiles(document)
+        except Exception as e:
+            current = f"v{self.version}" if self.version else "the defaults"
+            logger.error(f"Invalid profiles '{self.key}', keeping {current}: {e}")
+            self._etag = obj.etag
+            return
+
+        self._stores = document["stores"]
+        self._etag = obj.etag
+        self.version = document["version"]
+        logger.info(f"Loaded conversion profiles v{self.version} from '{self.key}'")
+
+
+def validate_profiles(document: dict):
+    """Raises a ValueError if the profiles document is invalid."""
+    if not isinstance(document.get("version"), int):
+        raise ValueError("Missing or invalid 'version'")
+    stores = document.get("stores")
+    if not stores:
+        raise ValueError("Missing 'stores'")
+    # eg. the CLI looks up the athena store's settings for its Glue tables
+    dest_stores = sorted(s.get("dest_store") for s in stores)
+    if dest_stores != sorted(DEST_STORES):
+        raise ValueError(f"Expected a store for each of {DEST_STORES}: {dest_stores}")
+
+    for store in stores:
+        required = ["dest_store", "dest_prefix", "partition_size", "file_format"]
+        missing = [k for k in required + ["compression"] if k not in store]
+        if missing:
+            raise ValueError(f"Missing store setting(s): {missing}")
+        if store["file_format"] not in FILE_FORMATS:
+            raise ValueError(f"Invalid file_format {store['file_format']}")
+        if store["partition_size"] not in PARTITIONS:
+            raise ValueError(f"Invalid partition_size {store['partition_size']}")
+        # a live conversion only converts a single daily source file, which would
+        # replace any larger partition with a single day's data
+        if store["partition_size"] not in LIVE_PARTITIONS:
+            raise ValueError(
+                f"Invalid partition_size {store['partition_size']}, live stores only "
+                f"support {LIVE_PARTITIONS}"
+            )
+        # the Glue tables of the athena store are parquet tables
+        if store["dest_store"] == "athena" and store["file_format"] != "parquet":
+            raise ValueError("The athena store's file_format has to be parquet")
+        validate_settings(store)
+
+        for profile in store.get("profiles", []):
+            if not profile.get("datasets"):
+                raise ValueError(f"Profile without 'datasets' patterns: {profile}")
+            settings = {k: v for k, v in profile.items() if k != "datasets"}
+            invalid = settings.keys() - PROFILE_SETTINGS
+            if invalid:
+                raise ValueError(f"Invalid profile setting(s): {invalid}")
+            if "compression" in settings and store["dest_store"] != "athena":
+                raise ValueError("The compression can only be overridden for athena")
+            validate_settings({**store, **settings})
+
+
+def validate_settings(settings: dict):
+    codec = settings["compression"]
+    level = settings.get("compression_level")
+    if codec not in COMPRESSION:
+        raise ValueError(f"Invalid compression {codec}")
+    if level is not None and level not in COMPRESSION_LEVELS.get(codec, []):
+        raise ValueError(f"Invalid compression level {level} for {codec}")
+    row_group_size = settings.get("row_group_size")
+    if row_group_size is not None and row_group_size <= 0:
+        raise ValueError(f"Invalid row_group_size {row_group_size}")
+    bucket_count = settings.get("bucket_count")
+    if bucket_count is not None and not 1 < bucket_count <= MAX_BUCKET_COUNT:
+        raise ValueError(f"Invalid bucket_count {bucket_count}")
+    athena = settings["dest_store"] == "athena"
+    if bucket_count is not None and not athena:
+        raise ValueError("Bucketing is only supported for athena")
+
+    sizes = list(PARTITIONS)
+    for rollup in settings.get("rollups") or []:
+        if not athena:
+            raise ValueError("Rollups are only supported for athena")
+        period = rollup.get("period")
+        if period not in sizes or (
+            sizes.index(period) > sizes.index(settings["partition_size"])
+        ):
+            raise ValueError(f"Invalid rollup period {period}")
+        invalid = set(rollup.get("aggregations", [])) - set(ROLLUP_AGGREGATIONS)
+        if invalid:
+            raise ValueError(f"Invalid rollup aggregation(s): {invalid}")
+
+
+# shared by all invocations of a warm lambda function
+PROFILE_REGISTRY = ProfileRegistry()
@@ -0,0 +1,108 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import pyarrow as pa
+from loguru import logger
+
+from lambdas.clients import get_storage
+from lambdas.config import PROFILE_PREFIX
+
+
+# Opt-in profiling of handler invocations, see `SamplingProfiler`. Enabled for every
+# invocation with PROFILE_HANDLER=true, or for invocations of requests with
+# `"profile": true`. Profiles are uploaded to
+# '<PROFILE_PREFIX><date>/<request id>.folded' (and '.json' for the summary).
+PROFILE_HANDLER = os.environ.get("PROFILE_HANDLER", "false").lower() == "true"
+PROFILE_INTERVAL_S = float(os.environ.get("PROFILE_INTERVAL_S", 0.01))
+# Profiles are deleted after this many days, calibrations only use the latest ones.
+PROFILE_RETENTION_DAYS = int(os.environ.get("PROFILE_RETENTION_DAYS", 30))
+
+
+class SamplingProfiler:
+    """A wall-clock sampling profiler, which periodically records the stacks of all
+    threads (i.e. also the pipeline's load and encode threads) and the bytes allocated
+    by the Arrow memory pool. Stacks are written in the collapsed format of
+    flamegraph.pl, which is also supported by eg. speedscope.
+    """
+
+    def __init__(self, interval: Optional[float] = None):
+        self.interval = interval or PROFILE_INTERVAL_S
+        self.stacks: Counter = Counter()
+        # (seconds since start, bytes allocated by arrow)
+        self.memory: list[tuple[float, int]] = []
+        # the settings and source sizes of the profiled requests, used to calibrate
+        # backfill estimates, see `lambdas.planner.describe_request`
+        self.requests: list[dict] = []
+        self.started = 0.0
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "SamplingProfiler":
+        self.started = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.duration = time.monotonic() - self.started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample(exclude=threading.get_ident())
+
+    def sample(self, exclude: Optional[int] = None):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == exclude:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                stack.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[";".join(reversed(stack))] += 1
+        elapsed = round(time.monotonic() - self.started, 3)
+        self.memory.append((elapsed, pa.total_allocated_bytes()))
+
+    def folded(self) -> str:
+        return "\n".join(f"{stack} {n}" for stack, n in self.stacks.most_common())
+
+    def summary(self) -> dict:
+        return {
+            "duration_s": round(self.duration, 3),
+            "interval_s": self.interval,
+            "samples": len(self.memory),
+            "arrow_peak_bytes": max((m for _, m in self.memory), default=0),
+            # the peak of the process, i.e. also of previous invocations
+            "arrow_pool_max_bytes": pa.default_memory_pool().max_memory(),
+            "arrow_allocated_bytes": self.memory,
+            "requests": self.requests,
+        }
+
+
+def upload_profile(profiler: SamplingProfiler, name: str) -> str:
+    """Uploads the stacks and summary of a profile, returning their key prefix. Expired
+    profiles are deleted along the way.
+    """
+    now = datetime.now(timezone.utc)
+    prefix = f"{PROFILE_PREFIX}{now:%Y-%m-%d}/{name}"
+    get_storage().put(f"{prefix}.folded", profiler.folded().encode())
+    get_storage().put(f"{prefix}.json", json.dumps(profiler.summary()).encode())
+    logger.info(f"Uploaded profile to '{prefix}.folded'")
+
+    expired = now - timedelta(days=PROFILE_RETENTION_DAYS)
+    get_storage().delete_dated(PROFILE_PREFIX, f"{expired:%Y-%m-%d}")
+    return prefix
@@ -0,0 +1,219 @@
+import concurrent.futures
+import hashlib
+import os
+import threading
+import uuid
+from datetime import datetime, timezone
+from typing import Callable, Optional, Union
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as pads
+from loguru import logger
+from pyarrow import fs as pafs
+
+from lambdas.common import (
+    PARTITIONS,
+    _file_format,
+    _read_arrow_stream,
+    extract_datetime,
+    floor_dt,
+    get_storage,
+)
+from lambdas.manifest import read_manifest
+from lambdas.storage import Storage
+
+
+READ_CONCURRENCY = int(os.environ.get("READ_CONCURRENCY", 16))
+CACHE_MAX_BYTES = int(os.environ.get("READER_CACHE_MAX_BYTES", 10 * 1024**3))
+
+Timestamp = Union[datetime, int]
+
+
+class FileCache:
+    """An LRU cache of dest files on local disk, eg. for repeatedly reading the same
+    time slices from a notebook. Files are evicted once the total size of the cache
+    exceeds `max_bytes`, the least recently read files first.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = CACHE_MAX_BYTES):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key: str, version: str = "") -> str:
+        # the version (i.e. the conversion time) invalidates files that are reconverted
+        name = hashlib.sha256(f"{key}:{version}".encode()).hexdigest()[:32]
+        return os.path.join(self.directory, name)
+
+    def get(self, key: str, version: str, fetch: Callable[[], bytes]) -> str:
+        """Returns the path of the cached file, fetching it on a cache miss."""
+        path = self.path(key, version)
+        try:
+            # mark as recently used
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+        data = fetch()
+        # write atomically, so concurrent readers never see a partial file
+        tmp_path = f"{path}.{uuid.uuid4()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return path
+
+    def evict(self):
+        with self._lock:
+            files = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+def read(
+    collection: str,
+    dataset: str,
+    start: Timestamp,
+    end: Timestamp,
+    columns: Optional[list[str]] = None,
+    dest_prefix: str = "",
+    filter: Optional[pc.Expression] = None,
+    storage: Optional[Storage] = None,
+    cache: Optional[FileCache] = None,
+    concurrency: int = READ_CONCURRENCY,
+) -> pa.Table:
+    """Reads the rows of a converted dataset with `start <= target_start < end` from
+    either the 'athena' or 'dataclient' dest store.
+
+    Only the files overlapping the time range are read, using the partition keys and
+    filenames, along with the target_start ranges recorded in the dataset's manifest.
+    Parquet files are read via `pyarrow.dataset`, which only decodes the selected
+    `columns` and skips row groups using their statistics. An optional `filter`
+    expression is applied on top of the time range, eg. `pc.field("node_id") == 1`.
+    """
+    storage = storage or get_storage()
+    start_ts, end_ts = _to_timestamp(start), _to_timestamp(end)
+    dataset_prefix = os.path.join(dest_prefix, collection, dataset, "")
+
+    keys = list_files(storage, dataset_prefix, start_ts, end_ts, concurrency)
+    entries = {e["key"]: e for e in read_manifest(storage, dataset_prefix).to_pylist()}
+    keys = [k for k in keys if _overlaps(entries.get(k), start_ts, end_ts)]
+    logger.info(f"Reading {len(keys)} files from '{dataset_prefix}'")
+    if not keys:
+        return pa.table({})
+
+    expr = (pc.field("target_start") >= start_ts) & (pc.field("target_start") < end_ts)
+    if filter is not None:
+        expr = expr & filter
+
+    # fetch files into the cache up front, so that they're read from local disk
+    paths = {}
+    if cache is not None:
+        versions = {k: str(entries.get(k, {}).get("converted_at", "")) for k in keys}
+
+        def fetch(key: str) -> str:
+            download = lambda: storage.get(key).read_buffer().to_pybytes()
+            return cache.get(key, versions[key], download)  # type: ignore
+
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            paths = dict(zip(keys, executor.map(fetch, keys)))
+
+    parquet_keys = [k for k in keys if _file_format(k) == "parquet"]
+    arrow_keys = [k for k in keys if _file_format(k) == "arrow"]
+    tables = []
+
+    if parquet_keys:
+        if cache is not None:
+            fs: pafs.FileSystem = pafs.LocalFileSystem()
+            sources = [paths[k] for k in parquet_keys]
+        else:
+            fs = storage.filesystem
+            sources = [storage.fs_path(k) for k in parquet_keys]
+        data = pads.dataset(sources, format="parquet", filesystem=fs)
+        tables.append(data.to_table(columns=columns, filter=expr, use_threads=True))
+
+    if arrow_keys:
+
+        def read_arrow(key: str) -> pa.Table:
+            if cache is not None:
+                source: pa.NativeFile = pa.memory_map(paths[key])
+            else:
+                source = storage.get(key)
+            table = _read_arrow_stream(source, key.rsplit(".", 1)[-1])
+            return pads.dataset(table).to_table(columns=columns, filter=expr)
+
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            tables.extend(executor.map(read_arrow, arrow_keys))
+
+    if cache is not None:
+        cache.evict()
+
+    return pa.concat_tables(tables, promote=True)
+
+
+def list_files(
+    storage: Storage,
+    dataset_prefix: str,
+    start_ts: int,
+    end_ts: int,
+    concurrency: int = READ_CONCURRENCY,
+) -> list[str]:
+    """Lists the dest files of a dataset that may contain rows within the time range,
+    pruning partitions by their partition key, i.e. 'year=' for the 'dataclient' dest
+    store or '<partition_size>_partition=' for the 'athena' dest store.
+    """
+    start_dt = datetime.fromtimestamp(start_ts, timezone.utc)
+    end_dt = datetime.fromtimestamp(end_ts, timezone.utc)
+
+    def in_range(prefix: str) -> bool:
+        name, _, value = prefix.rstrip("/").rpartition("/")[-1].partition("=")
+        if name == "year":
+            return start_dt.year <= int(value) <= end_dt.year
+        partition_size = name.removesuffix("_partition")
+        if partition_size not in PARTITIONS:
+            return False
+        fmt = PARTITIONS[partition_size]["format"]
+        partition_start = datetime.strptime(value, fmt).replace(tzinfo=timezone.utc)
+        floor_start = floor_dt(start_dt, partition_size).replace(tzinfo=timezone.utc)
+        return floor_start <= partition_start < end_dt
+
+    prefixes = [p for p in storage.list(dataset_prefix, dirs_only=True) if in_range(p)]
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        listed = executor.map(lambda p: list(storage.list(p)), prefixes)
+        keys = [k for ks in listed for k in ks]
+
+    files = sorted((int(extract_datetime(k).timestamp()), k) for k in keys)
+    # Each file holds rows from its file start until the next file's start, so the
+    # first files are the last ones that start at or before the start of the range.
+    # There are multiple files per file start if partitions are split into buckets.
+    first_start = max((ts for ts, _ in files if ts <= start_ts), default=0)
+    return [k for ts, k in files if first_start <= ts < end_ts]
+
+
+def _overlaps(entry: Optional[dict], start_ts: int, end_ts: int) -> bool:
+    # files converted before manifests existed can't be pruned any further
+    if entry is None or entry["min_target_start"] is None:
+        return True
+    return entry["max_target_start"] >= start_ts and entry["min_target_start"] < end_ts
+
+
+def _to_timestamp(dt: Timestamp) -> int:
+    if isinstance(dt, datetime):
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return int(dt.timestamp())
+    return int(dt)
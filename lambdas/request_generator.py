@@ -1,60 +1,265 @@
 import json
 import os
+import time
+from datetime import datetime
 from typing import Any, Optional
 
 from loguru import logger
 from pydantic import BaseModel, validator
 
-from lambdas.common import (
+from lambdas.clients import get_lambda_client, get_sqs_client, get_storage
+from lambdas.config import (
     COMPRESSION,
     COMPRESSION_LEVELS,
     DEST_STORES,
     FILE_FORMATS,
+    MAX_BUCKET_COUNT,
     PARTITIONS,
+    ROLLUP_AGGREGATIONS,
     SOURCE_PREFIX,
-    SQS_CLIENT,
+)
+from lambdas.payloads import compact_request, delete_expired_payloads
+from lambdas.planner import (
+    BackfillPlan,
+    Calibration,
+    calibrate,
+    estimate_request,
+    load_profile_summaries,
+    request_settings,
+)
+from lambdas.s3db import (
     batch_items,
+    ceil_dt,
     copy_metadata_file,
+    extract_datetime,
+    floor_dt,
     group_s3keys_by_partition,
     list_collections,
     list_datasets,
+    list_key_sizes,
     list_keys,
+    to_utc,
 )
+from lambdas.storage import PreconditionFailed
 
 
 SQS_BATCH_SIZE = 10
+# Progress of each backfill is checkpointed here, so that backfills that don't fit in a
+# single invocation can be continued by another one.
+CHECKPOINT_PREFIX = os.environ.get(
+    "CHECKPOINT_PREFIX", "version5/s3dbconverter/checkpoints/"
+)
+# The function checkpoints and re-invokes itself once it has less time than this left,
+# on top of the time its slowest SQS batch took.
+CHECKPOINT_MARGIN_MS = int(os.environ.get("CHECKPOINT_MARGIN_MS", 60_000))
+# Done checkpoints are kept for this long, for async retries of the invocation that
+# created them (which lambda retries for up to 6 hours), and deleted afterwards.
+CHECKPOINT_RETENTION_S = int(os.environ.get("CHECKPOINT_RETENTION_S", 24 * 3600))
+# The memory of the handler functions, and the number of requests that single-file
+# invocations process concurrently, used to flag requests in dry runs.
+SINGLE_JOB_MEMORY_MB = int(os.environ.get("SINGLE_JOB_MEMORY_MB", 2048))
+SINGLE_JOB_RECORD_CONCURRENCY = int(os.environ.get("SINGLE_JOB_RECORD_CONCURRENCY", 1))
+BATCH_JOB_MEMORY_MB = int(os.environ.get("BATCH_JOB_MEMORY_MB", 10240))
 
 
 def lambda_handler(event, context):
     """Request Handler Function
     Receives backfill requests and generates file conversion jobs, before sending them
     off to the request handler function via SQS queues.
+
+    The cursor (dataset and last enqueued source key) is checkpointed after each SQS
+    batch, and once the invocation nears its timeout, the function re-invokes itself
+    with `{"checkpoint_key": ...}` to continue from the cursor. Retried invocations
+    also continue from the cursor. Partitions are enqueued at least once, a batch that
+    was sent but not checkpointed yet (eg. due to a crash) is sent again on resume,
+    which is safe since conversions are idempotent, i.e. rewrite the same dest files.
+
+    With `"dry_run": true`, nothing is enqueued, and the estimated cost of the backfill
+    is returned instead, see `plan_backfill`.
     """
     logger.info(event)
-    event = RequestGeneratorEvent(**event)
 
-    for coll, dss in event.datasets.items():
-        for ds in dss:
-            if event.partition_size in ("hour", "day"):
-                sqs_url = os.environ["SINGLE_JOB_SQS_URL"]
-            else:
-                sqs_url = os.environ["BATCH_JOB_SQS_URL"]
-
-            if event.dest_store == "dataclient":
-                logger.info(f"Copying over metadata file for '{coll}.{ds}'")
-                copy_metadata_file(coll, ds, event.dest_prefix)
-
-            items = list(generate_requests(coll, ds, event))
-            logger.info(f"Submitting {len(items)} requests for '{coll}-{ds}'...")
-
-            for batch in batch_items(items, SQS_BATCH_SIZE):
-                SQS_CLIENT.send_message_batch(
-                    QueueUrl=sqs_url,
-                    Entries=[
-                        {"Id": str(i), "MessageBody": json.dumps(k)}
-                        for i, k in enumerate(batch)
-                    ],
-                )
+    if event.get("dry_run"):
+        return plan_backfill(RequestGeneratorEvent(**event)).to_dict()
+
+    if "checkpoint_key" in event:
+        checkpoint = Checkpoint.load(event["checkpoint_key"])
+    else:
+        # validate the event before creating the checkpoint, async retries of the same
+        # invocation have the same request id, and so resume from the same checkpoint
+        RequestGeneratorEvent(**event)
+        key = os.path.join(CHECKPOINT_PREFIX, f"{context.aws_request_id}.json")
+        checkpoint = Checkpoint.create(key, event)
+
+    if checkpoint.done:
+        logger.info(f"Backfill '{checkpoint.key}' is already done")
+        return
+
+    try:
+        finished = generate_and_submit(checkpoint, context)
+    except PreconditionFailed:
+        # the checkpoint is owned by another invocation, i.e. a stale retry
+        logger.warning(f"Checkpoint '{checkpoint.key}' was updated, stopping...")
+        return
+
+    if finished:
+        checkpoint.commit(done=True, finished_at=time.time())
+        logger.info(f"Backfill '{checkpoint.key}' is done")
+        delete_expired_checkpoints()
+        delete_expired_payloads()
+    else:
+        logger.info(f"Running out of time, continuing from '{checkpoint.cursor}'...")
+        get_lambda_client().invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType="Event",
+            Payload=json.dumps({"checkpoint_key": checkpoint.key}),
+        )
+
+
+def generate_and_submit(checkpoint: "Checkpoint", context) -> bool:
+    """Enqueues the requests after the checkpoint's cursor, returns False if the
+    invocation ran out of time before all requests were enqueued.
+    """
+    event = RequestGeneratorEvent(**checkpoint.event)
+    if event.partition_size in ("hour", "day"):
+        sqs_url = os.environ["SINGLE_JOB_SQS_URL"]
+    else:
+        sqs_url = os.environ["BATCH_JOB_SQS_URL"]
+
+    datasets = [(coll, ds) for coll, dss in event.datasets.items() for ds in dss]
+    cursor = checkpoint.cursor
+    if cursor is not None:
+        datasets = datasets[datasets.index((cursor["collection"], cursor["dataset"])) :]
+
+    # the time left has to cover the margin plus the slowest batch so far, i.e. the
+    # time between two checks, which includes listing a dataset's source keys
+    slowest_ms = 0
+    remaining_ms = None
+    for coll, ds in datasets:
+        last_key = None
+        if cursor is not None and (coll, ds) == (
+            cursor["collection"],
+            cursor["dataset"],
+        ):
+            last_key = cursor["last_key"]
+
+        if event.dest_store == "dataclient" and last_key is None:
+            logger.info(f"Copying over metadata file for '{coll}.{ds}'")
+            copy_metadata_file(coll, ds, event.dest_prefix)
+
+        logger.info(f"Submitting requests for '{coll}-{ds}' after '{last_key}'...")
+        requests = generate_requests(coll, ds, event, after=last_key)
+        batches = batch_items(requests, SQS_BATCH_SIZE)
+        while True:
+            previous_ms = remaining_ms
+            remaining_ms = context.get_remaining_time_in_millis()
+            if previous_ms is not None:
+                slowest_ms = max(slowest_ms, previous_ms - remaining_ms)
+            if remaining_ms < CHECKPOINT_MARGIN_MS + slowest_ms:
+                return False
+
+            batch = next(batches, None)
+            if batch is None:
+                break
+            resp = get_sqs_client().send_message_batch(
+                QueueUrl=sqs_url,
+                Entries=[
+                    {"Id": str(i), "MessageBody": json.dumps(compact_request(k))}
+                    for i, k in enumerate(batch)
+                ],
+            )
+            if resp.get("Failed"):
+                raise Exception(f"Failed to submit requests: {resp['Failed']}")
+
+            last = batch[-1]
+            last_key = os.path.join(last["s3key_prefix"], last["s3key_suffixes"][-1])
+            checkpoint.commit(
+                cursor={"collection": coll, "dataset": ds, "last_key": last_key}
+            )
+
+    return True
+
+
+def delete_expired_checkpoints():
+    """Deletes the checkpoints of backfills that finished more than
+    `CHECKPOINT_RETENTION_S` ago.
+    """
+    expired = []
+    for key in get_storage().list(CHECKPOINT_PREFIX):
+        finished_at = Checkpoint.load(key).state.get("finished_at")
+        if finished_at and time.time() - finished_at > CHECKPOINT_RETENTION_S:
+            expired.append(key)
+    if expired:
+        logger.info(f"Deleting {len(expired)} expired checkpoints")
+        get_storage().delete(expired)
+
+
+class Checkpoint:
+    """The progress of a backfill, i.e. the generator event and a cursor pointing at the
+    last enqueued source key. Updates are conditional on the etag, so that a checkpoint
+    is only advanced by a single invocation.
+    """
+
+    def __init__(self, key: str, state: dict, etag: Optional[str]):
+        self.key = key
+        self.state = state
+        self.etag = etag
+
+    @property
+    def event(self) -> dict:
+        return self.state["event"]
+
+    @property
+    def cursor(self) -> Optional[dict]:
+        return self.state.get("cursor")
+
+    @property
+    def done(self) -> bool:
+        return self.state.get("done", False)
+
+    @classmethod
+    def load(cls, key: str) -> "Checkpoint":
+        obj = get_storage().get_object(key)
+        return cls(key, json.load(obj.body), obj.etag)
+
+    @classmethod
+    def create(cls, key: str, event: dict) -> "Checkpoint":
+        checkpoint = cls(key, {"event": event}, None)
+        try:
+            checkpoint.commit()
+        except PreconditionFailed:
+            return cls.load(key)
+        return checkpoint
+
+    def commit(self, **changes):
+        state = {**self.state, **changes}
+        # the etag of the written checkpoint, rather than of whatever is there by now
+        self.etag = get_storage().put(
+            self.key,
+            json.dumps(state).encode(),
+            if_match=self.etag,
+            if_none_match=self.etag is None,
+        )
+        self.state = state
+
+
+class Rollup(BaseModel):
+    # the time period aggregated over, eg. 'hour'
+    period: str
+    aggregations: list[str] = ROLLUP_AGGREGATIONS
+
+    @validator("period")
+    def valid_period(cls, v):
+        if v not in PARTITIONS.keys():
+            raise ValueError(f"Invalid rollup period {v}")
+        return v
+
+    @validator("aggregations")
+    def valid_aggregations(cls, v):
+        invalid = set(v) - set(ROLLUP_AGGREGATIONS)
+        if not v or invalid:
+            raise ValueError(f"Invalid rollup aggregation(s): {invalid or v}")
+        return v
 
 
 # main purpose of this is to validate user inputs
@@ -67,6 +272,24 @@ class RequestGeneratorEvent(BaseModel):
     dest_store: str = "dataclient"
     file_format: str = "arrow"
     n_files: Optional[int] = None
+    # only converts source files within [start, end), widened to whole partitions
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    # skip rewriting dest files that wouldn't change, eg. when rerunning a backfill
+    skip_unchanged: bool = False
+    # memory-map loaded source data from local disk, eg. for large year partitions
+    stage_to_disk: bool = False
+    # converts from an existing converted store (eg. the live athena store) rather than
+    # the S3DB CSV files, which is much cheaper for re-encoding or re-partitioning
+    source_prefix: Optional[str] = None
+    # dictionary-encodes low-cardinality string columns of arrow files
+    dictionary_encode: bool = False
+    # splits athena partitions into hash buckets of the superkey
+    bucket_count: Optional[int] = None
+    # also writes aggregations per superkey and period into rollup datasets
+    rollups: Optional[list[Rollup]] = None
+    # uploads a profile of each handler invocation, see `lambdas.profiling`
+    profile: bool = False
 
     @validator("datasets")
     def datasets_exist(cls, v):
@@ -87,6 +310,16 @@ class RequestGeneratorEvent(BaseModel):
             raise ValueError(f"Invalid dest prefix: {v}")
         return v
 
+    @validator("source_prefix")
+    def valid_source_prefix(cls, v, values, **kwargs):
+        if v is None or v == SOURCE_PREFIX:
+            return None
+        if not v.endswith("/") or v.startswith(SOURCE_PREFIX):
+            raise ValueError(f"Invalid source prefix: {v}")
+        if v == values.get("dest_prefix"):
+            raise ValueError(f"Invalid source prefix, same as dest prefix: {v}")
+        return v
+
     @validator("compression")
     def valid_compression(cls, v):
         if v not in COMPRESSION:
@@ -118,6 +351,47 @@ class RequestGeneratorEvent(BaseModel):
             raise ValueError(f"Invalid file_format {v}")
         return v
 
+    @validator("bucket_count")
+    def valid_bucket_count(cls, v, values, **kwargs):
+        if v is None:
+            return v
+        if values.get("dest_store") != "athena":
+            raise ValueError("Bucketing is only supported for the athena dest_store")
+        if not 1 < v <= MAX_BUCKET_COUNT:
+            raise ValueError(f"Invalid bucket_count '{v}', max: {MAX_BUCKET_COUNT}")
+        return v
+
+    @validator("rollups")
+    def valid_rollups(cls, v, values, **kwargs):
+        if not v:
+            return None
+        if values.get("dest_store") != "athena":
+            raise ValueError("Rollups are only supported for the athena dest_store")
+        # each period has to be within a single partition
+        sizes = list(PARTITIONS)
+        partition_size = values.get("partition_size", "day")
+        for rollup in v:
+            if sizes.index(rollup.period) > sizes.index(partition_size):
+                raise ValueError(
+                    f"Invalid rollup period '{rollup.period}', can't be larger than "
+                    f"the partition size '{partition_size}'"
+                )
+        return v
+
+    @validator("start", "end", pre=True)
+    def parse_datetime(cls, v):
+        # also accepts dates, eg. '2021-06-01'
+        return datetime.fromisoformat(v) if isinstance(v, str) else v
+
+    @validator("start", "end")
+    def valid_time_range(cls, v, values, field, **kwargs):
+        if v is None:
+            return v
+        v = to_utc(v)
+        if field.name == "end" and values.get("start") and v <= values["start"]:
+            raise ValueError(f"Invalid time range, end '{v}' must be after start.")
+        return v
+
     @validator("n_files")
     def valid_n_filest(cls, v):
         if v is not None and v <= 0:
@@ -125,17 +399,50 @@ class RequestGeneratorEvent(BaseModel):
         return v
 
 
-def generate_requests(collection: str, dataset: str, event: RequestGeneratorEvent):
-    s3_keys = sorted(list_keys(collection, dataset))
+def generate_requests(
+    collection: str,
+    dataset: str,
+    event: RequestGeneratorEvent,
+    after: Optional[str] = None,
+):
+    """Generates a request per dest partition, only for source keys after the `after`
+    key if given, i.e. when continuing from a checkpoint.
+    """
+    start, end = partition_range(event.start, event.end, event.partition_size)
+    list_start = start
+    if after is not None and not event.n_files:
+        # no need to list years before the cursor, unless selecting the latest files
+        after_dt = extract_datetime(after)
+        list_start = max(start, after_dt) if start else after_dt
+
+    source_prefix = event.source_prefix or SOURCE_PREFIX
+    s3_keys = sorted(list_keys(collection, dataset, list_start, end, source_prefix))
     logger.info(f"Found {len(s3_keys)} s3 keys for '{collection}.{dataset}'")
 
+    if s3_keys and event.source_prefix:
+        source_partition = source_partition_size(s3_keys[0], source_prefix)
+        sizes = list(PARTITIONS)
+        # hourly partitions are split by 'target_start', others are merged files
+        if sizes.index(event.partition_size) < sizes.index(source_partition) and (
+            event.partition_size != "hour"
+        ):
+            raise ValueError(
+                f"Can't convert '{source_partition}' partitions from '{source_prefix}' "
+                f"into smaller '{event.partition_size}' partitions"
+            )
+
     if event.n_files:
         s3_keys = s3_keys[-event.n_files :]
         logger.info(f"Selected latest {event.n_files} keys")
 
-    prefix = os.path.join(SOURCE_PREFIX, collection, dataset, "")
+    if after is not None:
+        # keys are sorted, and a cursor always points at the end of a partition
+        s3_keys = [k for k in s3_keys if k > after]
 
-    for gk, keys in group_s3keys_by_partition(s3_keys, event.partition_size):
+    prefix = os.path.join(source_prefix, collection, dataset, "")
+    groups = group_s3keys_by_partition(s3_keys, event.partition_size, source_prefix)
+
+    for gk, keys in groups:
         # remove the prefix to reduce payload size
         keys = [k.removeprefix(prefix) for k in keys]
         request: dict[str, Any] = {
@@ -149,5 +456,85 @@ def generate_requests(collection: str, dataset: str, event: RequestGeneratorEven
         }
         if event.compression_level is not None:
             request["compression_level"] = event.compression_level
+        if event.skip_unchanged:
+            request["skip_unchanged"] = True
+        if event.stage_to_disk:
+            request["stage_to_disk"] = True
+        if event.source_prefix:
+            request["source_prefix"] = event.source_prefix
+        if event.dictionary_encode:
+            request["dictionary_encode"] = True
+        if event.bucket_count:
+            request["bucket_count"] = event.bucket_count
+        if event.rollups:
+            request["rollups"] = [r.dict() for r in event.rollups]
+        if event.profile:
+            request["profile"] = True
 
         yield request
+
+
+def plan_backfill(
+    event: RequestGeneratorEvent, calibration: Optional[Calibration] = None
+) -> BackfillPlan:
+    """Estimates the cost of every request of a backfill without enqueuing any, i.e. a
+    dry run. Estimates are calibrated from recent profiles, unless a calibration is
+    given, see `lambdas.planner`.
+    """
+    if event.partition_size in ("hour", "day"):
+        memory_mb, concurrency = SINGLE_JOB_MEMORY_MB, SINGLE_JOB_RECORD_CONCURRENCY
+    else:
+        memory_mb, concurrency = BATCH_JOB_MEMORY_MB, 1
+    if calibration is None:
+        settings = request_settings(event.dict())
+        calibration = calibrate(load_profile_summaries(), settings)
+
+    # only the partitions within the time range are listed, as by `generate_requests`
+    start, end = partition_range(event.start, event.end, event.partition_size)
+    source_prefix = event.source_prefix or SOURCE_PREFIX
+    estimates = []
+    for coll, dss in event.datasets.items():
+        for ds in dss:
+            prefix = os.path.join(source_prefix, coll, ds, "")
+            sizes = dict(list_key_sizes(coll, ds, start, end, source_prefix))
+            for request in generate_requests(coll, ds, event):
+                source_sizes = [sizes[prefix + s] for s in request["s3key_suffixes"]]
+                estimate = estimate_request(
+                    coll,
+                    ds,
+                    request,
+                    source_sizes,
+                    calibration,
+                    memory_mb,
+                    concurrency,
+                )
+                estimates.append(estimate)
+    return BackfillPlan(memory_mb, calibration, estimates)
+
+
+def source_partition_size(key: str, source_prefix: str) -> str:
+    """The partition size of a converted store, taken from the athena partition key in
+    the key, or the dataclient store's prefix, eg. 'version5/arrow/zst_lv22/day/'.
+    Defaults to the S3DB source data's daily partition.
+    """
+    for part in key.removeprefix(source_prefix).split("/"):
+        name = part.partition("=")[0]
+        if name.endswith("_partition"):
+            return name.removesuffix("_partition")
+    last = source_prefix.rstrip("/").rsplit("/", 1)[-1]
+    return last if last in PARTITIONS else "day"
+
+
+def partition_range(
+    start: Optional[datetime], end: Optional[datetime], partition_size: str
+) -> tuple[Optional[datetime], Optional[datetime]]:
+    """Widens a time range to whole dest partitions, so that partial partitions (eg. a
+    month starting mid-month) don't overwrite existing complete ones. Source files are
+    daily, so the range is at least widened to whole days.
+    """
+    period = "day" if partition_size == "hour" else partition_size
+    if start is not None:
+        start = to_utc(floor_dt(start, period))
+    if end is not None:
+        end = to_utc(ceil_dt(end, period))
+    return start, end
@@ -1,11 +1,30 @@
-import io
+import concurrent.futures
+import contextlib
 import json
 import os
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
 from urllib.parse import unquote
 
 from loguru import logger
 
-from lambdas.common import SOURCE_BUCKET, convert_data, s3_multi_p_upload
+from lambdas.common import (
+    SOURCE_PREFIX,
+    convert_data,
+    delete_stale_files,
+    update_manifest,
+    upload_file,
+)
+from lambdas.metrics import emit_metrics
+from lambdas.payloads import get_source_keys
+from lambdas.planner import describe_request
+from lambdas.profiling import PROFILE_HANDLER, SamplingProfiler, upload_profile
+from lambdas.throttle import S3_RATE_LIMITER
+
+
+# Max number of SQS records processed concurrently within a single invocation.
+RECORD_CONCURRENCY = int(os.environ.get("RECORD_CONCURRENCY", 4))
 
 
 def lambda_handler(event, context):
@@ -18,39 +37,137 @@ def lambda_handler(event, context):
     - Batch file requests: Merges multiple source files and converts them into a single
       dest file. The payload countains multiple source s3 key.
 
-    Note that this code is shared by both the single-request and batch-reqeust lambda
-    functions, using 2 separate lambda functions for different memory requirements.
+    Note that this code is shared by the live, single-request and batch-reqeust lambda
+    functions, using separate lambda functions for different memory and concurrency
+    requirements.
+
+    Records in a batch are processed concurrently, failed records are reported back via
+    'batchItemFailures' such that only those are retried.
+
+    Invocations are profiled if PROFILE_HANDLER is set or any request has
+    `"profile": true`, see `lambdas.profiling`.
     """
     logger.info(event)
 
-    for message in event["Records"]:
-        event = json.loads(unquote(message["body"]))
-
-        compression = event["compression"]
-        level = event.get("compression_level")
-        dest_prefix = event["dest_prefix"]
-        dest_store = event["dest_store"]
-        partition_size = event["partition_size"]
-        file_format = event["file_format"]
-
-        # live events
-        if "s3_key" in event:
-            s3keys = [event["s3_key"]]
-
-        # backfill requests
-        else:
-            s3key_prefix = event["s3key_prefix"]
-            s3key_suffixes = event["s3key_suffixes"]
-            s3keys = [os.path.join(s3key_prefix, i) for i in s3key_suffixes]
-
-        for dest_key, data in convert_data(
-            s3keys,
-            dest_prefix,
-            dest_store,
-            partition_size,
-            file_format,
-            compression,
-            level=level,
-        ):
-            logger.info(f"Uploading file '{dest_key}'...")
-            s3_multi_p_upload(SOURCE_BUCKET, dest_key, io.BytesIO(data))
+    records = event["Records"]
+    profile = PROFILE_HANDLER or any(is_profiled(r) for r in records)
+    profiler = SamplingProfiler() if profile else contextlib.nullcontext()
+
+    n_workers = max(1, min(RECORD_CONCURRENCY, len(records)))
+    with profiler, concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+        futures = [executor.submit(process_record, r) for r in records]
+
+    # Only failed records are returned to the queue for retries, this requires the
+    # event source mapping to be configured with 'ReportBatchItemFailures'.
+    failures = []
+    for record, future in zip(records, futures):
+        exc = future.exception()
+        if exc is not None:
+            logger.opt(exception=exc).error(f"Failed to process record: {record}")
+            failures.append({"itemIdentifier": record.get("messageId")})
+
+    if isinstance(profiler, SamplingProfiler):
+        name = context.aws_request_id if context is not None else str(uuid.uuid4())
+        try:
+            # the requests' sizes calibrate the estimates of backfill dry runs, only
+            # those of processed records, failed ones may not even parse
+            for record, future in zip(records, futures):
+                if future.exception() is None:
+                    event = parse_record(record)
+                    request = describe_request(event, source_keys(event))
+                    profiler.requests.append(request)
+            upload_profile(profiler, name)
+        except Exception:
+            # profiling is best-effort, the records have been processed already
+            logger.exception("Failed to upload profile")
+
+    S3_RATE_LIMITER.emit_metrics()
+    return {"batchItemFailures": failures}
+
+
+def parse_record(message: dict) -> dict:
+    return json.loads(unquote(message["body"]))
+
+
+def is_profiled(message: dict) -> bool:
+    # malformed records are reported as failures by `process_record`, not here
+    try:
+        return bool(parse_record(message).get("profile"))
+    except Exception:
+        return False
+
+
+def process_record(message: dict):
+    event = parse_record(message)
+
+    compression = event["compression"]
+    level = event.get("compression_level")
+    dest_prefix = event["dest_prefix"]
+    dest_store = event["dest_store"]
+    partition_size = event["partition_size"]
+    file_format = event["file_format"]
+    skip_unchanged = event.get("skip_unchanged", False)
+    stage_to_disk = event.get("stage_to_disk", False)
+    dictionary_encode = event.get("dictionary_encode", False)
+    bucket_count = event.get("bucket_count")
+    rollups = event.get("rollups")
+    row_group_size = event.get("row_group_size")
+    # backfills may convert from an already converted store rather than S3DB
+    source_prefix = event.get("source_prefix", SOURCE_PREFIX)
+
+    s3keys = source_keys(event)
+
+    entries = defaultdict(list)
+    # including unchanged files, which are still current
+    dest_keys = set()
+    for output in convert_data(
+        s3keys,
+        dest_prefix,
+        dest_store,
+        partition_size,
+        file_format,
+        compression,
+        level=level,
+        skip_unchanged=skip_unchanged,
+        stage_to_disk=stage_to_disk,
+        source_prefix=source_prefix,
+        dictionary_encode=dictionary_encode,
+        bucket_count=bucket_count,
+        rollups=rollups,
+        row_group_size=row_group_size,
+    ):
+        dest_keys.add(output.key)
+        if output.data is None:
+            continue
+        logger.info(f"Uploading file '{output.key}'...")
+        upload_file(output.key, output.data, output.fingerprint)
+        entries[(output.coll, output.ds)].append(output.stats)
+
+    # the files of a partition depend on the bucket count, and empty buckets aren't
+    # written at all
+    if dest_store == "athena":
+        delete_stale_files(dest_prefix, dest_keys)
+
+    for (coll, ds), stats in entries.items():
+        update_manifest(coll, ds, dest_prefix, stats)
+
+    # live requests, time from the source file being created to the output being
+    # available, i.e. the freshness of the converted data
+    if event.get("source_event_time"):
+        created = parse_event_time(event["source_event_time"])
+        latency = datetime.now(timezone.utc) - created
+        emit_metrics({"LiveConversionLatencySeconds": latency.total_seconds()})
+
+
+def source_keys(event: dict) -> list[str]:
+    # live events
+    if "s3_key" in event:
+        return [event["s3_key"]]
+
+    # backfill requests, the source keys may be compacted, see `compact_request`
+    return get_source_keys(event)
+
+
+def parse_event_time(event_time: str) -> datetime:
+    # S3 event times are in UTC, eg. '2021-06-15T20:00:00.123Z'
+    return datetime.fromisoformat(event_time.replace("Z", "+00:00"))
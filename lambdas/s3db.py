@@ -0,0 +1,218 @@
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from itertools import groupby, islice
+from typing import Iterable, Iterator, Optional
+
+from lambdas.clients import get_storage
+from lambdas.config import ROLLUP_AGGREGATIONS, SOURCE_PREFIX
+
+
+# Helpers for the S3DB source data, used by all lambda functions. Keep this module free
+# of heavy imports (eg. pyarrow), see `lambdas.config`.
+
+TIME_COLUMNS = ("target_start", "target_end", "release_date", "target_bounds")
+
+
+def list_collections() -> list[str]:
+    coll_prefixes = get_storage().list(SOURCE_PREFIX, dirs_only=True)
+    return [c.split("/")[-2] for c in coll_prefixes]
+
+
+def list_datasets(collection: str) -> list[str]:
+    prefix = os.path.join(SOURCE_PREFIX, collection, "")
+    ds_prefixes = get_storage().list(prefix, dirs_only=True)
+    return [d.split("/")[-2] for d in ds_prefixes]
+
+
+def list_keys(
+    collection: str,
+    dataset: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    source_prefix: str = SOURCE_PREFIX,
+) -> Iterator[str]:
+    """Lists the dataset's source keys, optionally only those with a file timestamp
+    within `[start, end)`. Partitions outside of the range aren't listed at all.
+
+    Keys are listed from the S3DB source data by default, or from a converted store
+    (i.e. the 'dataclient' or 'athena' dest stores) if `source_prefix` is given.
+    """
+    sizes = list_key_sizes(collection, dataset, start, end, source_prefix)
+    yield from (key for key, _ in sizes)
+
+
+def list_key_sizes(
+    collection: str,
+    dataset: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    source_prefix: str = SOURCE_PREFIX,
+) -> Iterator[tuple[str, int]]:
+    """The keys of `list_keys` along with their sizes, from the same listings."""
+    prefix = os.path.join(source_prefix, collection, dataset, "")
+    storage = get_storage()
+    if start is None and end is None:
+        yield from (
+            (k, n)
+            for k, n in storage.list_sizes(prefix)
+            if is_data_key(k, source_prefix)
+        )
+        return
+
+    start = to_utc(start) if start else None
+    end = to_utc(end) if end else None
+    for partition_prefix in storage.list(prefix, dirs_only=True):
+        # i.e. 'year=2021' for S3DB and dataclient, '<size>_partition=2021-06-01' for
+        # athena, both of which start with the year
+        name, _, value = partition_prefix.rstrip("/").rsplit("/", 1)[-1].partition("=")
+        if not (name == "year" or name.endswith("_partition")):
+            continue
+        year = int(value[:4])
+        if (start and year < start.year) or (end and year > end.year):
+            continue
+        for key, size in storage.list_sizes(partition_prefix):
+            if not is_data_key(key, source_prefix):
+                continue
+            dt = extract_datetime(key)
+            if (start is None or dt >= start) and (end is None or dt < end):
+                yield key, size
+
+
+def is_data_key(key: str, source_prefix: str = SOURCE_PREFIX) -> bool:
+    if source_prefix == SOURCE_PREFIX:
+        return key.endswith(".csv.gz")
+    # converted files are named by their file start, unlike the manifest files
+    filename = key.rsplit("/", 1)[-1]
+    return (
+        "/_" not in key.removeprefix(source_prefix) and filename.split(".")[0].isdigit()
+    )
+
+
+def get_first_key(collection: str, dataset: str) -> Optional[str]:
+    """Finds the dataset's earliest source key, only listing the earliest (non-empty)
+    year prefix. Filenames are timestamps, so the first key of a year is its earliest.
+    """
+    prefix = os.path.join(SOURCE_PREFIX, collection, dataset, "")
+    for year_prefix in get_storage().list(prefix, dirs_only=True):
+        keys = (k for k in get_storage().list(year_prefix) if k.endswith(".csv.gz"))
+        first = next(keys, None)
+        if first is not None:
+            return first
+    return None
+
+
+def gen_metadata_key(collection: str, dataset: str) -> str:
+    return os.path.join(SOURCE_PREFIX, collection, dataset, "METADATA.json")
+
+
+def get_metadata(collection: str, dataset: str) -> dict:
+    key = gen_metadata_key(collection, dataset)
+    return json.load(get_storage().get(key))
+
+
+def get_dataset_pkeys(collection: str, dataset: str) -> list[str]:
+    return get_metadata(collection, dataset)["superkey"]
+
+
+def get_bucket_column(collection: str, dataset: str) -> Optional[str]:
+    """The superkey column used for hash bucketing, i.e. the first superkey column that
+    isn't a time column, eg. 'node_id'. Datasets without one aren't bucketed.
+    """
+    for column in get_dataset_pkeys(collection, dataset):
+        if column not in TIME_COLUMNS:
+            return column
+    return None
+
+
+def get_rollup_columns(
+    collection: str, dataset: str, aggregations: list[str] = ROLLUP_AGGREGATIONS
+) -> tuple[list[str], dict[str, str]]:
+    """The columns of a dataset's rollups, i.e. its non-time superkey columns, which
+    rows are grouped by, and the S3DB type map of the rollup, which consists of the
+    group columns, the period's 'target_start' and `<col>_<aggregation>` columns for
+    each numeric value column.
+    """
+    metadata = get_metadata(collection, dataset)
+    types = metadata["type_map"]
+    keys = [k for k in metadata["superkey"] if k not in TIME_COLUMNS]
+    type_map = {k: types[k] for k in keys}
+    type_map["target_start"] = "int"
+    for col in metadata.get("value_key", []):
+        if types.get(col) not in ("int", "float"):
+            continue
+        for agg in aggregations:
+            agg_type = {"mean": "float", "count": "int"}.get(agg, types[col])
+            type_map[f"{col}_{agg}"] = agg_type
+    return keys, type_map
+
+
+def get_s3db_type_map(collection: str, dataset: str) -> dict[str, str]:
+    return get_metadata(collection, dataset)["type_map"]
+
+
+def extract_datetime(s3_key: str) -> datetime:
+    filename = s3_key.rsplit("/", 1)[-1]
+    ts = int(filename.split(".")[0])
+    return datetime.fromtimestamp(ts, timezone.utc)
+
+
+def to_utc(dt: datetime) -> datetime:
+    # naive datetimes are assumed to be in UTC, like the S3DB timestamps
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def copy_metadata_file(collection: str, dataset: str, dest_prefix: str):
+    key = gen_metadata_key(collection, dataset)
+    desk_key = os.path.join(dest_prefix, key.removeprefix(SOURCE_PREFIX))
+    get_storage().copy(key, desk_key)
+
+
+def batch_items(itr: Iterable, chunk_size: int):
+    itr = iter(itr)
+    chunk = list(islice(itr, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(itr, chunk_size))
+
+
+def group_s3keys_by_partition(
+    source_keys: list[str], partition_size: str, source_prefix: str = SOURCE_PREFIX
+) -> Iterator[tuple[tuple[str, str, int], list[str]]]:
+    def gk_func(key: str) -> tuple[str, str, int]:
+        coll, ds = key.removeprefix(source_prefix).split("/")[:2]
+        file_start = floor_dt(extract_datetime(key), partition_size)
+        return coll, ds, int(file_start.timestamp())
+
+    source_keys.sort()
+    for gk, keys in groupby(source_keys, key=gk_func):
+        yield gk, list(keys)
+
+
+def floor_dt(dt: datetime, period: str):
+    if period == "hour":
+        return datetime(dt.year, dt.month, dt.day, dt.hour)
+    elif period == "day":
+        return datetime(dt.year, dt.month, dt.day)
+    elif period == "month":
+        return datetime(dt.year, dt.month, 1)
+    elif period == "year":
+        return datetime(dt.year, 1, 1)
+    else:
+        raise Exception(f"invalid period: {period}")
+
+
+def ceil_dt(dt: datetime, period: str):
+    floored = floor_dt(dt, period)
+    if floored == dt.replace(tzinfo=None):
+        return floored
+    elif period == "hour":
+        return floored + timedelta(hours=1)
+    elif period == "day":
+        return floored + timedelta(days=1)
+    elif period == "month":
+        return datetime(dt.year + dt.month // 12, dt.month % 12 + 1, 1)
+    else:
+        return datetime(dt.year + 1, 1, 1)
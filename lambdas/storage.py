@@ -0,0 +1,473 @@
+import concurrent.futures
+import io
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Iterable, Iterator, NamedTuple, Optional
+from urllib.parse import urlparse
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from lambdas.throttle import S3_RATE_LIMITER, S3RateLimiter
+
+
+# pyarrow is imported on first use, it isn't needed by handlers that only list or copy
+# objects, eg. the prod listener
+if TYPE_CHECKING:
+    import pyarrow as pa
+    from pyarrow import fs as pafs
+
+
+# Creating boto3 clients from the default session isn't thread-safe, eg. the record,
+# pipeline and download threads of a handler may all create their clients at once, so
+# all clients are created holding this lock.
+BOTO3_LOCK = threading.Lock()
+
+# Default multi-part config:
+# https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/s3.html#module-boto3.s3.inject
+S3_CONFIG = TransferConfig()
+# Download config for source objects. Objects larger than the threshold are fetched
+# using concurrent byte-range GETs of `multipart_chunksize` bytes each, so that a single
+# large file isn't limited to the throughput of a single connection.
+S3_DOWNLOAD_CONFIG = TransferConfig(
+    multipart_threshold=int(os.environ.get("S3_DOWNLOAD_THRESHOLD", 32 * 1024**2)),
+    multipart_chunksize=int(os.environ.get("S3_DOWNLOAD_PART_SIZE", 16 * 1024**2)),
+    max_concurrency=int(os.environ.get("S3_DOWNLOAD_CONCURRENCY", 8)),
+)
+# A single client (and its connection pool) is shared by all download threads, so the
+# pool must be large enough for concurrent files x concurrent ranges per file.
+# Throttled requests are retried with jittered exponential backoff, and the adaptive
+# mode also slows down the client's request rate after throttles, on top of the
+# per-prefix rate limits of `S3_RATE_LIMITER`.
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 128)),
+    tcp_keepalive=True,
+    retries={
+        "mode": os.environ.get("S3_RETRY_MODE", "adaptive"),
+        "max_attempts": int(os.environ.get("S3_MAX_ATTEMPTS", 10)),
+    },
+)
+
+
+class StoredObject(NamedTuple):
+    body: "pa.NativeFile"
+    etag: str
+
+
+class ObjectInfo(NamedTuple):
+    size: int
+    etag: str
+    # user-defined metadata, i.e. 'x-amz-meta-*' headers for S3
+    metadata: dict[str, str]
+
+
+class PreconditionFailed(Exception):
+    """Raised when a conditional write fails because the object has changed."""
+
+
+class DeleteFailed(Exception):
+    """Raised when some objects couldn't be deleted, eg. for lack of permissions."""
+
+
+class Storage(ABC):
+    """An object store holding both the source and dest data, addressed using S3-style
+    keys relative to the store's root (i.e. the bucket).
+    """
+
+    @abstractmethod
+    def list(self, prefix: str, dirs_only: bool = False) -> Iterator[str]:
+        """Lists keys starting with the prefix in lexicographical order, or only the
+        immediate 'sub-directories' (ending with '/') if `dirs_only` is set.
+        """
+
+    @abstractmethod
+    def list_sizes(self, prefix: str) -> Iterator[tuple[str, int]]:
+        """Lists keys starting with the prefix along with their sizes, like `list`."""
+
+    @abstractmethod
+    def get_object(self, key: str) -> StoredObject:
+        """Reads an object into a zero-copy, file-like Arrow buffer, along with its
+        etag. Raises a FileNotFoundError if the object doesn't exist.
+        """
+
+    def get(self, key: str) -> "pa.NativeFile":
+        return self.get_object(key).body
+
+    @abstractmethod
+    def head(self, key: str) -> Optional[ObjectInfo]:
+        """Returns an object's size, etag and metadata, or None if it doesn't exist."""
+
+    @abstractmethod
+    def put(
+        self,
+        key: str,
+        data: bytes,
+        if_match: Optional[str] = None,
+        if_none_match: bool = False,
+        metadata: Optional[dict[str, str]] = None,
+    ) -> Optional[str]:
+        """Writes an object, replacing any existing object and its metadata.
+        For conditional writes, `if_match` is the expected etag of the current object
+        and `if_none_match` requires that no object exists, a PreconditionFailed is
+        raised if the condition doesn't hold.
+
+        Returns the etag of the written object for conditional writes, such that it
+        can be updated again without reading it back in between.
+        """
+
+    @abstractmethod
+    def copy(self, source_key: str, dest_key: str):
+        pass
+
+    @abstractmethod
+    def delete(self, keys: Iterable[str]):
+        pass
+
+    def delete_dated(self, prefix: str, before: str):
+        """Deletes the objects under the dated 'sub-directories' of the prefix (eg.
+        '<prefix>2021-06-01/') whose date is before the given one, eg. '2021-07-01'.
+        """
+        for dated in self.list(prefix, dirs_only=True):
+            if dated.removeprefix(prefix).rstrip("/") < before:
+                self.delete(list(self.list(dated)))
+
+    @property
+    @abstractmethod
+    def filesystem(self) -> "pafs.FileSystem":
+        """A native Arrow filesystem for the store, eg. for use with pyarrow.dataset"""
+
+    @abstractmethod
+    def fs_path(self, key: str) -> str:
+        """Translates a key into a path for `filesystem`."""
+
+
+class S3Storage(Storage):
+    def __init__(
+        self,
+        bucket: str,
+        download_config: TransferConfig = S3_DOWNLOAD_CONFIG,
+        upload_config: TransferConfig = S3_CONFIG,
+        rate_limiter: Optional[S3RateLimiter] = S3_RATE_LIMITER,
+    ):
+        self.bucket = bucket
+        self.download_config = download_config
+        self.upload_config = upload_config
+        self.rate_limiter = rate_limiter
+        self._client = None
+        self._filesystem = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # created lazily, boto3 clients are thread-safe and shared by all threads
+        if self._client is None:
+            with BOTO3_LOCK:
+                if self._client is None:
+                    client = boto3.client("s3", config=S3_CLIENT_CONFIG)
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.register(client)
+                    self._client = client
+        return self._client
+
+    @property
+    def filesystem(self) -> "pafs.FileSystem":
+        if self._filesystem is None:
+            with self._lock:
+                if self._filesystem is None:
+                    from pyarrow import fs as pafs
+
+                    region = pafs.resolve_s3_region(self.bucket)
+                    self._filesystem = pafs.S3FileSystem(region=region)
+        return self._filesystem
+
+    def fs_path(self, key: str) -> str:
+        return f"{self.bucket}/{key}"
+
+    def list(self, prefix: str, dirs_only: bool = False) -> Iterator[str]:
+        pg = self.client.get_paginator("list_objects_v2")
+        arg = {"Bucket": self.bucket, "Prefix": prefix}
+        if dirs_only:
+            arg["Delimiter"] = "/"
+            yield from (
+                i["Prefix"]
+                for p in pg.paginate(**arg)
+                for i in p.get("CommonPrefixes", ())
+            )
+        else:
+            yield from (
+                i["Key"] for p in pg.paginate(**arg) for i in p.get("Contents", ())
+            )
+
+    def list_sizes(self, prefix: str) -> Iterator[tuple[str, int]]:
+        pg = self.client.get_paginator("list_objects_v2")
+        for page in pg.paginate(Bucket=self.bucket, Prefix=prefix):
+            yield from ((i["Key"], i["Size"]) for i in page.get("Contents", ()))
+
+    def get_object(self, key: str) -> StoredObject:
+        """Downloads an S3 object into memory.
+        The first request fetches up to `multipart_threshold` bytes, which covers most
+        objects in a single GET. For larger objects, the remaining bytes are fetched
+        using concurrent byte-range GETs written directly into a preallocated buffer.
+        """
+        import pyarrow as pa
+
+        config = self.download_config
+        try:
+            first = self.client.get_object(
+                Bucket=self.bucket,
+                Key=key,
+                Range=f"bytes=0-{config.multipart_threshold - 1}",
+            )
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(f"s3://{self.bucket}/{key}")
+
+        etag = first["ETag"]
+        head = first["Body"].read()
+        # The object size is only available via the content range for partial responses.
+        size = int(first.get("ContentRange", f"/{len(head)}").rsplit("/", 1)[-1])
+
+        if size <= len(head):
+            return StoredObject(pa.BufferReader(head), etag)
+
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        view[: len(head)] = head
+
+        def download_range(start: int):
+            end = min(start + config.multipart_chunksize, size) - 1
+            # fail instead of mixing ranges if the object is overwritten mid-download
+            resp = self.client.get_object(
+                Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=etag
+            )
+            view[start : end + 1] = resp["Body"].read()
+
+        starts = range(len(head), size, config.multipart_chunksize)
+        with concurrent.futures.ThreadPoolExecutor(config.max_concurrency) as executor:
+            # consume the results to raise exceptions from any failed download
+            list(executor.map(download_range, starts))
+
+        return StoredObject(pa.BufferReader(pa.py_buffer(buffer)), etag)
+
+    def head(self, key: str) -> Optional[ObjectInfo]:
+        try:
+            resp = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return ObjectInfo(resp["ContentLength"], resp["ETag"], resp.get("Metadata", {}))
+
+    def put(
+        self,
+        key: str,
+        data: bytes,
+        if_match: Optional[str] = None,
+        if_none_match: bool = False,
+        metadata: Optional[dict[str, str]] = None,
+    ) -> Optional[str]:
+        extra_args: dict = {"ACL": "bucket-owner-full-control"}
+        if metadata:
+            extra_args["Metadata"] = metadata
+
+        if if_match is None and not if_none_match:
+            self.client.upload_fileobj(
+                Bucket=self.bucket,
+                Key=key,
+                Fileobj=io.BytesIO(data),
+                Config=self.upload_config,
+                ExtraArgs=extra_args,
+            )
+            # multi-part uploads don't return the etag
+            return None
+
+        # conditional writes are only supported by single-part uploads
+        if if_match is not None:
+            extra_args["IfMatch"] = if_match
+        if if_none_match:
+            extra_args["IfNoneMatch"] = "*"
+        try:
+            resp = self.client.put_object(
+                Bucket=self.bucket, Key=key, Body=data, **extra_args
+            )
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in ("PreconditionFailed", "ConditionalRequestConflict"):
+                raise PreconditionFailed(f"s3://{self.bucket}/{key}") from e
+            raise
+        return resp["ETag"]
+
+    def copy(self, source_key: str, dest_key: str):
+        self.client.copy_object(
+            Bucket=self.bucket,
+            Key=dest_key,
+            CopySource={"Bucket": self.bucket, "Key": source_key},
+        )
+
+    def delete(self, keys: Iterable[str]):
+        keys = sorted(keys)
+        # max 1000 keys per request
+        for i in range(0, len(keys), 1000):
+            objects = [{"Key": k} for k in keys[i : i + 1000]]
+            resp = self.client.delete_objects(
+                Bucket=self.bucket, Delete={"Objects": objects, "Quiet": True}
+            )
+            # quiet deletes only report the keys that failed, without raising
+            if errors := resp.get("Errors"):
+                e = errors[0]
+                raise DeleteFailed(
+                    f"{len(errors)} objects in s3://{self.bucket} couldn't be "
+                    f"deleted, eg. {e['Key']}: {e['Code']} {e.get('Message', '')}"
+                )
+
+
+class LocalStorage(Storage):
+    """A store on the local filesystem that mirrors the bucket's key layout under the
+    root directory, eg. for running conversions against local disk or in tests.
+    """
+
+    # object metadata is stored as json files under this directory, which is excluded
+    # from listings
+    METADATA_DIR = ".metadata"
+
+    def __init__(self, root: str):
+        from pyarrow import fs as pafs
+
+        self.root = os.path.abspath(root)
+        self._filesystem = pafs.LocalFileSystem()
+        # serializes conditional writes within the process
+        self._lock = threading.Lock()
+
+    @property
+    def filesystem(self) -> "pafs.FileSystem":
+        return self._filesystem
+
+    def fs_path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def list(self, prefix: str, dirs_only: bool = False) -> Iterator[str]:
+        from pyarrow import fs as pafs
+
+        # like S3, the prefix doesn't have to end at a directory boundary
+        base_dir = self.fs_path(prefix.rpartition("/")[0])
+        selector = pafs.FileSelector(
+            base_dir, allow_not_found=True, recursive=not dirs_only
+        )
+        file_type = pafs.FileType.Directory if dirs_only else pafs.FileType.File
+        suffix = "/" if dirs_only else ""
+        keys = (
+            os.path.relpath(info.path, self.root) + suffix
+            for info in self._filesystem.get_file_info(selector)
+            if info.type == file_type
+        )
+        metadata_prefix = os.path.join(self.METADATA_DIR, "")
+        yield from sorted(
+            k
+            for k in keys
+            if k.startswith(prefix) and not k.startswith(metadata_prefix)
+        )
+
+    def list_sizes(self, prefix: str) -> Iterator[tuple[str, int]]:
+        for key in self.list(prefix):
+            yield key, os.path.getsize(self.fs_path(key))
+
+    def _metadata_path(self, key: str) -> str:
+        return os.path.join(self.root, self.METADATA_DIR, f"{key}.json")
+
+    def _etag(self, key: str) -> Optional[str]:
+        try:
+            stat = os.stat(self.fs_path(key))
+        except FileNotFoundError:
+            return None
+        return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    def get_object(self, key: str) -> StoredObject:
+        import pyarrow as pa
+
+        etag = self._etag(key)
+        return StoredObject(pa.memory_map(self.fs_path(key)), etag or "")
+
+    def head(self, key: str) -> Optional[ObjectInfo]:
+        etag = self._etag(key)
+        if etag is None:
+            return None
+        try:
+            with open(self._metadata_path(key)) as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            metadata = {}
+        return ObjectInfo(os.path.getsize(self.fs_path(key)), etag, metadata)
+
+    def put(
+        self,
+        key: str,
+        data: bytes,
+        if_match: Optional[str] = None,
+        if_none_match: bool = False,
+        metadata: Optional[dict[str, str]] = None,
+    ) -> Optional[str]:
+        with self._lock:
+            etag = self._etag(key)
+            if (if_match is not None and etag != if_match) or (
+                if_none_match and etag is not None
+            ):
+                raise PreconditionFailed(self.fs_path(key))
+
+            path = self.fs_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # don't infer a compression from the file extension, data is written as is
+            with self._filesystem.open_output_stream(path, compression=None) as f:
+                f.write(data)
+            self._put_metadata(key, metadata)
+            return self._etag(key)
+
+    def _put_metadata(self, key: str, metadata: Optional[dict[str, str]]):
+        path = self._metadata_path(key)
+        if not metadata:
+            self._remove(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(metadata, f)
+
+    def copy(self, source_key: str, dest_key: str):
+        dest = self.fs_path(dest_key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        self._filesystem.copy_file(self.fs_path(source_key), dest)
+        # like S3, metadata is copied along with the object
+        info = self.head(source_key)
+        self._put_metadata(dest_key, info.metadata if info else None)
+
+    def delete(self, keys: Iterable[str]):
+        for key in keys:
+            self._remove(self.fs_path(key))
+            self._remove(self._metadata_path(key))
+            # like S3, there are no empty 'sub-directories'
+            parent = os.path.dirname(self.fs_path(key))
+            while parent.startswith(os.path.join(self.root, "")):
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def storage_from_uri(uri: str) -> Storage:
+    """Creates a store from a URI, i.e. 's3://<bucket>' or 'file://<root dir>'."""
+    parsed = urlparse(uri)
+    if parsed.scheme == "s3":
+        return S3Storage(parsed.netloc)
+    elif parsed.scheme in ("file", ""):
+        return LocalStorage(parsed.netloc + parsed.path)
+    else:
+        raise ValueError(f"Unsupported storage URI: {uri}")
@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from collections import defaultdict
+
+from lambdas.metrics import emit_metrics
+
+
+# Client-side rate limiting for S3. S3 scales request rates per prefix (3500 writes and
+# 5500 reads per second), and exceeding them returns 503 SlowDown. With many concurrent
+# handlers downloading from the same dataset, retrying immediately only makes it worse,
+# so requests are paced per prefix, and the pace is halved whenever S3 pushes back.
+S3_READ_RATE = float(os.environ.get("S3_READ_RATE", 550))
+S3_WRITE_RATE = float(os.environ.get("S3_WRITE_RATE", 350))
+# rates never go below this fraction of the configured rate
+MIN_RATE_FRACTION = 0.05
+# fraction of the configured rate recovered per successful request after a throttle
+RECOVERY_FRACTION = 0.01
+# bound on the number of tracked prefixes, idle ones are dropped past this
+MAX_PREFIXES = 10_000
+
+WRITE_OPERATIONS = {
+    "AbortMultipartUpload",
+    "CompleteMultipartUpload",
+    "CopyObject",
+    "CreateMultipartUpload",
+    "DeleteObject",
+    "DeleteObjects",
+    "PutObject",
+    "UploadPart",
+}
+THROTTLE_CODES = {"SlowDown", "503", "ServiceUnavailable", "RequestLimitExceeded"}
+
+
+class TokenBucket:
+    """A thread-safe token bucket with a rate that is cut multiplicatively when
+    throttled and recovers additively on success (AIMD).
+    """
+
+    def __init__(self, rate: float):
+        self.max_rate = rate
+        self.rate = rate
+        # allow bursts of up to a second's worth of requests
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Takes a token, blocking until one is available. Returns the time waited."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # tokens may go negative, later callers then wait for the debt to be repaid
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(
+                    self.max_rate, self.rate + self.max_rate * RECOVERY_FRACTION
+                )
+
+    @property
+    def idle(self) -> bool:
+        return self.rate == self.max_rate and self.tokens >= self.rate
+
+
+class S3RateLimiter:
+    """Paces the S3 requests of all registered clients using a token bucket per prefix
+    (the key's 'directory') for reads and writes each, and counts throttled responses.
+    """
+
+    def __init__(
+        self, read_rate: float = S3_READ_RATE, write_rate: float = S3_WRITE_RATE
+    ):
+        self.read_rate = read_rate
+        self.write_rate = write_rate
+        self._buckets: dict[tuple[str, bool], TokenBucket] = {}
+        self._lock = threading.Lock()
+        self.metrics: dict[str, float] = defaultdict(float)
+
+    def register(self, client):
+        """Hooks the limiter into a boto3 s3 client."""
+        events = client.meta.events
+        events.register("before-parameter-build.s3", self._before_call)
+        events.register("needs-retry.s3", self._after_attempt)
+
+    def bucket(self, prefix: str, write: bool) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get((prefix, write))
+            if bucket is None:
+                if len(self._buckets) >= MAX_PREFIXES:
+                    self._buckets = {
+                        k: v for k, v in self._buckets.items() if not v.idle
+                    }
+                rate = self.write_rate if write else self.read_rate
+                bucket = self._buckets[(prefix, write)] = TokenBucket(rate)
+            return bucket
+
+    def _before_call(self, params, model, context, **kwargs):
+        key = params.get("Key") or params.get("Prefix") or ""
+        prefix = f"{params.get('Bucket')}/{key.rpartition('/')[0]}"
+        write = model.name in WRITE_OPERATIONS
+        # passed on to the response handler via the request context
+        context["rate_limit"] = (prefix, write)
+        waited = self.bucket(prefix, write).acquire()
+        with self._lock:
+            self.metrics["S3Requests"] += 1
+            self.metrics["S3ThrottleWaitSeconds"] += waited
+
+    def _after_attempt(self, request_dict, response, **kwargs):
+        rate_limit = request_dict.get("context", {}).get("rate_limit")
+        if rate_limit is None or response is None:
+            return
+        http_response, parsed = response
+        code = parsed.get("Error", {}).get("Code")
+        bucket = self.bucket(*rate_limit)
+        if http_response.status_code == 503 or code in THROTTLE_CODES:
+            bucket.throttled()
+            with self._lock:
+                self.metrics["S3SlowDowns"] += 1
+        else:
+            bucket.succeeded()
+
+    def emit_metrics(self, namespace: str = "S3DBConverter"):
+        """Logs and resets the metrics in CloudWatch embedded metric format."""
+        with self._lock:
+            metrics, self.metrics = self.metrics, defaultdict(float)
+        if not metrics:
+            return
+        emit_metrics(metrics, namespace)
+
+
+# shared by all clients and threads in the process
+S3_RATE_LIMITER = S3RateLimiter()
@@ -1,7 +1,11 @@
+import argparse
+import concurrent.futures
 import json
 import os
 import sys
+from datetime import datetime
 from enum import Enum
+from typing import Optional
 
 import boto3
 from loguru import logger
@@ -16,15 +20,19 @@ from lambdas.common import (
     COMPRESSION_LEVELS_DEFAULTS,
     DEST_STORES,
     FILE_FORMATS,
+    MAX_BUCKET_COUNT,
     PARTITIONS,
     SOURCE_BUCKET,
     SOURCE_PREFIX,
+    batch_items,
     gen_partition_key,
-    get_s3db_type_map,
+    gen_rollup_dataset,
     list_collections,
     list_datasets,
+    parse_rollup_dataset,
 )
-from lambdas.prod_listener import LIVE_STORES
+from lambdas.glue_catalog import gen_table_input, get_projection_range, get_table_layout
+from lambdas.profiles import PROFILE_REGISTRY
 
 
 CLI_VERSION = "1.0.0"
@@ -41,28 +49,20 @@ ACCOUNTS = {
     },
 }
 
-# Glue Catalog/Table and Athena Configs
+# Glue Catalog/Table and Athena Configs, the tables' location and partition size are
+# those of the live athena store, see `get_athena_store`
 ATHENA_DEFAULT_ACCOUNT = "services"
-DATA_INPUT_FORMAT = "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat"
-DATA_OUTPUT_FORMAT = "org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat"
-SER_DER_LIB = "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe"
-DATA_LOCATION = "s3://invenia-datafeeds-output/version5/athena/parquet/sz/day/"
-PARQUET_COMPRESSION = "SNAPPY"
-PARTITION_SIZE = "day"
-PARTITION_KEY = gen_partition_key(PARTITION_SIZE)
-PARTITION_TYPE = PARTITIONS[PARTITION_SIZE]["type"]
-# This type is different from the PartitionKeyType above, it is only
-# used during partition projection, we want it to be always a 'date'
-PARTITION_PROJECTION_TYPE = "date"
-PARTITION_PROJECTION_FORMAT = PARTITIONS[PARTITION_SIZE]["projection_format"]
-PARTITION_PROJECTION_UNIT = PARTITIONS[PARTITION_SIZE]["unit"]
-PARTITION_PROJECTION_INTERVAL = "1"
-PARTITION_PROJECTION_END = "NOW+1WEEKS"
+# Glue allows deleting up to 100 tables per request
+GLUE_BATCH_DELETE_SIZE = 100
+# Max number of concurrent S3/Glue requests when scanning or repairing the catalog
+CATALOG_WORKERS = 16
 
 
 class GlueOptions(str, Enum):
     CREATE = "Check for New S3DB Datasets"
     REPAIR = "Check/Repair Table Schemas"
+    REPAIR_ALL = "Check/Repair Table Schemas (repair all, non-interactive)"
+    REFRESH_RANGES = "Refresh Partition Projection Ranges"
     DELETE_DATABASE = "Delete Databases"
     DELETE_TABLE = "Delete Tables"
     BACK = "BACK"
@@ -72,6 +72,7 @@ class GlueOptions(str, Enum):
 class BackfillRange(str, Enum):
     ALL = "All files"
     LATEST_N = "Latest N files"
+    TIME_RANGE = "Time range"
 
 
 class Options(str, Enum):
@@ -81,6 +82,26 @@ class Options(str, Enum):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="S3DB CLI")
+    parser.add_argument(
+        "--repair-glue",
+        action="store_true",
+        help="Non-interactively create missing Glue tables and repair all table "
+        "schemas, then exit.",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        help="AWS profile of the Glue catalog account, only used with --repair-glue. "
+        f"Defaults to the {ATHENA_DEFAULT_ACCOUNT} account admin role.",
+    )
+    args = parser.parse_args()
+
+    if args.repair_glue:
+        api = API(STACK_NAME, athena_account_profile=args.profile)
+        sync_glue_catalog(api)
+        sys.exit(0)
+
     print_welcome()
 
     aws_id = boto3.client("sts").get_caller_identity()["Account"]
@@ -208,7 +229,19 @@ class API:
         datasets,
         compression_level=None,
         n_files=None,
+        start=None,
+        end=None,
+        stage_to_disk=False,
+        source_prefix=None,
+        dictionary_encode=False,
+        bucket_count=None,
+        rollups=None,
+        profile=False,
+        dry_run=False,
     ):
+        """Triggers a backfill, or with `dry_run` returns its estimated cost instead,
+        see `lambdas.request_generator.plan_backfill`.
+        """
         event = {
             "dest_store": dest_store,
             "dest_prefix": dest_prefix,
@@ -223,6 +256,42 @@ class API:
         if n_files:
             event["n_files"] = n_files
 
+        if start:
+            event["start"] = start.isoformat()
+
+        if end:
+            event["end"] = end.isoformat()
+
+        if stage_to_disk:
+            event["stage_to_disk"] = True
+
+        if source_prefix:
+            event["source_prefix"] = source_prefix
+
+        if dictionary_encode:
+            event["dictionary_encode"] = True
+
+        if bucket_count:
+            event["bucket_count"] = bucket_count
+
+        if rollups:
+            event["rollups"] = rollups
+
+        if profile:
+            event["profile"] = True
+
+        if dry_run:
+            event["dry_run"] = True
+            resp = self.lmb.invoke(
+                FunctionName=self.stack_outputs["RequestGeneratorFunctionName"],
+                InvocationType="RequestResponse",
+                Payload=json.dumps(event),
+            )
+            payload = json.load(resp["Payload"])
+            if resp.get("FunctionError"):
+                raise Exception(f"Dry run failed: {payload}")
+            return payload
+
         self.lmb.invoke(
             FunctionName=self.stack_outputs["RequestGeneratorFunctionName"],
             InvocationType="Event",
@@ -233,14 +302,67 @@ class API:
         s3db_colls = set(list_collections())
         glue_dbs = set([el["Name"] for el in self.glue.get_databases()["DatabaseList"]])
 
-        available = {db: list_datasets(db) for db in s3db_colls}
-        created = {db: list(self.list_glue_tables(db)) for db in glue_dbs}
+        with concurrent.futures.ThreadPoolExecutor(CATALOG_WORKERS) as executor:
+            available = dict(zip(s3db_colls, executor.map(list_datasets, s3db_colls)))
+            available = {
+                db: [
+                    *ds,
+                    *[
+                        gen_rollup_dataset(d, r["period"])
+                        for d in ds
+                        for r in get_athena_profile(db, d).get("rollups", [])
+                    ],
+                ]
+                for db, ds in available.items()
+            }
+            tables = executor.map(lambda db: list(self.list_glue_tables(db)), glue_dbs)
+            created = dict(zip(glue_dbs, tables))
+
         missing = {
             db: set(available[db]) - set([t["Name"] for t in created.get(db, [])])
             for db in s3db_colls
         }
         return created, missing
 
+    def diff_glue_catalog(self):
+        """Compares the Glue catalog against S3DB and the live athena store's profiles
+        in a single pass, returning the missing tables per database and the outdated
+        tables, i.e. a list of (db, table, expected, current) with the parts of the
+        table layouts that differ, see `get_table_layout`.
+        """
+        created, missing = self.check_glue_catalog()
+        tables = [
+            (db, t) for db, tbls in created.items() if db in missing for t in tbls
+        ]
+
+        def get_expected_layout(db_table):
+            db, table = db_table
+            return get_table_layout(self.gen_table_input(db, table["Name"]))
+
+        # fetch the METADATA.json of all existing tables concurrently
+        with concurrent.futures.ThreadPoolExecutor(CATALOG_WORKERS) as executor:
+            layouts = executor.map(get_expected_layout, tables)
+
+            mismatched = []
+            for (db, table), expected in zip(tables, layouts):
+                current = get_table_layout(table)
+                diff = [k for k in expected if expected[k] != current[k]]
+                if diff:
+                    expected = {k: expected[k] for k in diff}
+                    current = {k: current[k] for k in diff}
+                    mismatched.append((db, table["Name"], expected, current))
+
+        return missing, mismatched
+
+    def create_glue_tables(self, tables, update=False):
+        """Concurrently creates/updates a list of (db, table), returning the failed
+        tables and their errors.
+        """
+        operation = lambda el: self.create_glue_table(*el, update=update)
+        with concurrent.futures.ThreadPoolExecutor(CATALOG_WORKERS) as executor:
+            futures = {el: executor.submit(operation, el) for el in tables}
+        return {el: f.exception() for el, f in futures.items() if f.exception()}
+
     def list_glue_databases(self):
         s3db_colls = set(list_collections())
         glue_dbs = set([el["Name"] for el in self.glue.get_databases()["DatabaseList"]])
@@ -251,36 +373,44 @@ class API:
         for page in paginator.paginate(DatabaseName=db):
             yield from page["TableList"]
 
+    def get_projection_range(self, db, table):
+        return get_projection_range(db, table, get_athena_store()["partition_size"])
+
+    def diff_projection_ranges(self):
+        """Returns a list of (db, table, current range, expected range) for tables
+        where the partition projection range is outdated.
+        """
+        dbs = self.list_glue_databases()
+        with concurrent.futures.ThreadPoolExecutor(CATALOG_WORKERS) as executor:
+            tables = executor.map(lambda db: list(self.list_glue_tables(db)), dbs)
+            tables = [(db, t) for db, tbls in zip(dbs, tables) for t in tbls]
+            expected = executor.map(
+                lambda el: self.get_projection_range(el[0], el[1]["Name"]), tables
+            )
+
+            partition_key = gen_partition_key(get_athena_store()["partition_size"])
+            outdated = []
+            for (db, table), pp_range in zip(tables, expected):
+                key = f"projection.{partition_key}.range"
+                current = table.get("Parameters", {}).get(key)
+                if current != pp_range:
+                    outdated.append((db, table["Name"], current, pp_range))
+
+        return outdated
+
     def create_glue_table(self, db, table, update=False):
         operation = self.glue.update_table if update else self.glue.create_table
-        # TODO: find the start date per dataset dynamically
-        pp_range = f"2010-01-01,{PARTITION_PROJECTION_END}"
-        operation(
-            DatabaseName=db,
-            TableInput={
-                "Name": table,
-                "StorageDescriptor": {
-                    "Columns": self.get_glue_type_map_from_s3db(db, table),
-                    "Location": f"{DATA_LOCATION}{db}/{table}",
-                    "InputFormat": DATA_INPUT_FORMAT,
-                    "OutputFormat": DATA_OUTPUT_FORMAT,
-                    # None because we already use parquet columnar compression, which
-                    # is specified in the table properties, not here.
-                    "Compressed": False,
-                    "SerdeInfo": {"SerializationLibrary": SER_DER_LIB},
-                },
-                "PartitionKeys": [{"Name": PARTITION_KEY, "Type": PARTITION_TYPE}],
-                "TableType": "EXTERNAL_TABLE",
-                "Parameters": {
-                    f"projection.{PARTITION_KEY}.type": PARTITION_PROJECTION_TYPE,
-                    f"projection.{PARTITION_KEY}.interval.unit": PARTITION_PROJECTION_UNIT,  # noqa 501
-                    f"projection.{PARTITION_KEY}.interval": PARTITION_PROJECTION_INTERVAL,  # noqa 501
-                    f"projection.{PARTITION_KEY}.range": pp_range,
-                    f"projection.{PARTITION_KEY}.format": PARTITION_PROJECTION_FORMAT,
-                    "projection.enabled": "TRUE",
-                    "parquet.compression": PARQUET_COMPRESSION,
-                },
-            },
+        operation(DatabaseName=db, TableInput=self.gen_table_input(db, table))
+
+    def gen_table_input(self, db, table):
+        store, profile = get_athena_store(), get_athena_profile(db, table)
+        return gen_table_input(
+            db,
+            table,
+            f"s3://{SOURCE_BUCKET}/{store['dest_prefix']}",
+            store["partition_size"],
+            bucket_count=profile.get("bucket_count"),
+            rollups=profile.get("rollups"),
         )
 
     def create_glue_database(self, db):
@@ -289,36 +419,17 @@ class API:
     def delete_glue_table(self, db, table):
         self.glue.delete_table(DatabaseName=db, Name=table)
 
+    def delete_glue_tables(self, db, tables):
+        for batch in batch_items(tables, GLUE_BATCH_DELETE_SIZE):
+            resp = self.glue.batch_delete_table(DatabaseName=db, TablesToDelete=batch)
+            for err in resp.get("Errors", []):
+                print(
+                    f"Failed to delete '{db}.{err['TableName']}': {err['ErrorDetail']}"
+                )
+
     def delete_glue_database(self, db):
         self.glue.delete_database(Name=db)
 
-    def get_glue_type_map_from_s3db(self, db, table):
-        s3db_types = get_s3db_type_map(db, table)
-        # We have no way of knowing if the dataset uses big/small int/float because
-        # the S3DB metadata doesn't specify it. Opting for the smaller size during
-        # Glue schema creation leads to an error when querying later via Athena.
-        # eg: 'GENERIC_INTERNAL_ERROR: Value 2156111684 exceeds MAX_INT'
-        overrides = {
-            "target_start": "bigint",
-            "target_end": "bigint",
-            "release_date": "bigint",
-            "target_bounds": "tinyint",
-        }
-        conversions = {
-            "str": "string",
-            "int": "bigint",
-            "float": "double",
-            "bool": "boolean",
-            "timedelta": "double",
-            "datetime": "bigint",
-            "list": "string",
-            "tuple": "string",
-        }
-        return [
-            {"Name": k, "Type": overrides.get(k, conversions.get(v, v))}
-            for k, v in s3db_types.items()
-        ]
-
     def _assume_iam_role(
         self,
         role_arn: str,
@@ -342,18 +453,41 @@ class API:
         return sesh, sesh_expiry
 
 
+def get_live_store(dest_store):
+    """The settings of a live store, see `lambdas.profiles`."""
+    return next(s for s in PROFILE_REGISTRY.stores if s["dest_store"] == dest_store)
+
+
+def get_athena_store():
+    """The live athena store, whose location and partition size the Glue tables use,
+    as do the tables synced by the prod listener.
+    """
+    return get_live_store("athena")
+
+
+def get_athena_profile(db, table):
+    """The live athena store's settings for a dataset, or the dataset of a rollup
+    table, eg. its bucket count and rollups, see `lambdas.profiles`.
+    """
+    rollup = parse_rollup_dataset(table)
+    stores = PROFILE_REGISTRY.resolve(db, rollup[0] if rollup else table)
+    return next(s for s in stores if s["dest_store"] == "athena")
+
+
 def print_welcome():
     cprint(Figlet(font="big").renderText("S3DB   CLI"), "blue")
     print(f"\nWelcome to S3DB CLI v{CLI_VERSION}!\n")
     print(" S3DB Source:")
     cprint(f"   s3://{SOURCE_BUCKET}/{SOURCE_PREFIX}", "green")
-    print(f" Live Conversions ({len(LIVE_STORES)}):")
-    for el in LIVE_STORES:
+    live_stores = PROFILE_REGISTRY.stores
+    version = PROFILE_REGISTRY.version or "default"
+    print(f" Live Conversions ({len(live_stores)}, profiles {version}):")
+    for el in live_stores:
         uri = f"s3://{SOURCE_BUCKET}/{el['dest_prefix']}"
         cprint(f"   {uri}  ", "green", end="")
         cprint(f"({el['dest_store']})", "blue")
     print(" Athena Source:")
-    cprint(f"   {DATA_LOCATION}", "green")
+    cprint(f"   s3://{SOURCE_BUCKET}/{get_athena_store()['dest_prefix']}", "green")
     print("")
 
 
@@ -367,6 +501,10 @@ def prompt_backfills(api):
 
     compression = prompt_options("Select compression:", COMPRESSION)
 
+    dictionary_encode = file_fmt == "arrow" and prompt_confirmation(
+        "Dictionary-encode low-cardinality string columns?", default=False
+    )
+
     if dest_store == "dataclient" and compression in COMPRESSION_LEVELS:
         levels = COMPRESSION_LEVELS[compression]
         validate = lambda x: int(x) in levels
@@ -380,7 +518,15 @@ def prompt_backfills(api):
 
     partition = prompt_options("Select dest partition size:", list(PARTITIONS.keys()))
 
-    if partition == "year":
+    stage_to_disk = False
+    if partition in ("month", "year"):
+        stage_to_disk = prompt_confirmation(
+            "Stage source data on local disk to reduce memory usage (recommended for "
+            "large datasets)?",
+            default=partition == "year",
+        )
+
+    if partition == "year" and not stage_to_disk:
         print(
             "WARNING: Partitioning by year will fail for very large datasets such as "
             "CAISO Price Data due to AWS Lambda hitting max memory (10GB)."
@@ -392,6 +538,36 @@ def prompt_backfills(api):
     )
     dest_prefix = os.path.join(dest_prefix, "")
 
+    bucket_count, rollups = None, None
+    if dest_store == "athena":
+        # tables partitioned by 'superkey_bucket' don't see unbucketed files, so this
+        # defaults to the live athena store's bucket count
+        counts = [0, *range(2, MAX_BUCKET_COUNT + 1)]
+        validate = lambda x: x.isdigit() and int(x) in counts
+        default = str(get_athena_store().get("bucket_count") or 0)
+        msg = (
+            "Number of buckets of the first non-time superkey column to split each "
+            f"partition into (0 for none, max {MAX_BUCKET_COUNT}):"
+        )
+        bucket_count = int(prompt_text(msg, default, validate)) or None
+
+        # rollup periods have to fit within a partition
+        periods = list(PARTITIONS)[: list(PARTITIONS).index(partition) + 1]
+        selected = prompt_checkbox(
+            "Select periods to also write rollups (aggregations per superkey) for, if "
+            "any:",
+            periods,
+        )
+        rollups = [{"period": p} for p in selected] or None
+
+    # re-encoding from an existing store skips the CSV parsing of the S3DB source data
+    source_prefix = prompt_text(
+        "Specify source s3 prefix, an existing converted store (eg. "
+        "'version5/athena/parquet/sz/day/'), or leave empty to convert from S3DB:",
+        default="",
+    )
+    source_prefix = os.path.join(source_prefix, "") if source_prefix else None
+
     targets = {}
     collections = list_collections()
     options = [
@@ -421,35 +597,100 @@ def prompt_backfills(api):
         print("No datasets selected...")
 
     else:
-        n_files = prompt_options("Select file range:", [e.value for e in BackfillRange])
-        if n_files == BackfillRange.LATEST_N:
+        n_files, start, end = None, None, None
+        file_range = prompt_options(
+            "Select file range:", [e.value for e in BackfillRange]
+        )
+        if file_range == BackfillRange.LATEST_N:
             n_files = int(prompt_text("Specify number of files:"))
-        else:
-            n_files = None
+        elif file_range == BackfillRange.TIME_RANGE:
+            print(f"Ranges are in UTC and widened to whole '{partition}' partitions.")
+            start = prompt_datetime("Specify start date (inclusive, YYYY-MM-DD):")
+            end = prompt_datetime("Specify end date (exclusive, YYYY-MM-DD):", start)
+
+        profile = prompt_confirmation(
+            "Profile the conversions (uploads a flamegraph-compatible profile of each "
+            "handler invocation to 'version5/s3dbconverter/diagnostics/')?",
+            default=False,
+        )
+
+        options = {
+            "compression_level": compression_level,
+            "n_files": n_files,
+            "start": start,
+            "end": end,
+            "stage_to_disk": stage_to_disk,
+            "source_prefix": source_prefix,
+            "dictionary_encode": dictionary_encode,
+            "bucket_count": bucket_count,
+            "rollups": rollups,
+            "profile": profile,
+        }
+        args = (dest_store, dest_prefix, file_fmt, compression, partition)
+
+        proceed_default = True
+        if prompt_confirmation("Estimate the cost of the backfill first (dry run)?"):
+            print("Planning the backfill... ")
+            plan = api.trigger_lambda(*args, targets, **options, dry_run=True)
+            print_backfill_plan(plan)
+            proceed_default = not plan["exceeding_memory"]
 
         num_datasets = sum([len(v) for v in targets.values()])
         msg = f"Backfilling {num_datasets} datasets. Proceed?"
-        if prompt_confirmation(msg):
+        if prompt_confirmation(msg, default=proceed_default):
             print("Trigerring Request Generator... ")
 
             for coll, ds in targets.items():
                 if ds:
-                    api.trigger_lambda(
-                        dest_store,
-                        dest_prefix,
-                        file_fmt,
-                        compression,
-                        partition,
-                        {coll: ds},
-                        compression_level=compression_level,
-                        n_files=n_files,
-                    )
+                    api.trigger_lambda(*args, {coll: ds}, **options)
 
             print("Done")
         else:
             print("Cancelling...")
 
 
+def print_backfill_plan(plan):
+    calibration = plan["calibration"]
+    if calibration["samples"]:
+        print(f"Estimates calibrated from {calibration['samples']} recent profiles.")
+    else:
+        print("No matching profiles to calibrate from, using default estimates.")
+
+    header = f"{'dataset':<40}{'requests':>9}{'source MB':>11}{'max MB':>8}"
+    print(f"\n{header}{'peak MB':>9}{'GB-s':>10}{'S3 GET':>9}{'S3 PUT':>9}")
+    totals = {"requests": 0, "lambda_seconds": 0.0, "s3_gets": 0, "s3_puts": 0}
+    for ds in plan["datasets"]:
+        gb_seconds = ds["lambda_seconds"] * plan["memory_mb"] / 1024
+        source_mb, max_mb = (
+            ds["source_bytes"] / 2**20,
+            ds["max_request_bytes"] / 2**20,
+        )
+        line = (
+            f"{ds['collection'] + '.' + ds['dataset']:<40}{ds['requests']:>9}"
+            f"{source_mb:>11.1f}{max_mb:>8.1f}"
+            f"{ds['peak_memory_mb']:>9}{gb_seconds:>10.0f}"
+            f"{ds['s3_gets']:>9}{ds['s3_puts']:>9}"
+        )
+        cprint(line, "red" if ds["exceeding_memory"] else None)
+        for k in totals:
+            totals[k] += ds[k]
+
+    hours = totals["lambda_seconds"] / 3600
+    print(
+        f"\nTotal: {totals['requests']} requests, {hours:.1f} lambda hours at "
+        f"{plan['memory_mb']}MB, {totals['s3_gets']} S3 GETs and {totals['s3_puts']} "
+        "S3 PUTs."
+    )
+    exceeding = plan["exceeding_memory"]
+    if exceeding:
+        cprint(
+            f"WARNING: {len(exceeding)} requests will likely run out of memory (eg. "
+            f"from '{exceeding[0]}'), consider staging to disk or smaller partitions.",
+            "red",
+        )
+    print("")
+
+
 def prompt_athena_manager(api):
     while True:
         o = prompt_options("What would you like to do:", [i.value for i in GlueOptions])
@@ -491,10 +732,13 @@ def prompt_athena_manager(api):
             ]
             if tables:
                 to_delete = prompt_checkbox("Select tables:", sorted(tables))
+                by_db: dict[str, list[str]] = {}
                 for el in to_delete:
                     db, tbl = el.split(".")
                     print(f"Deleting Glue Table '{db}.{tbl}'...")
-                    api.delete_glue_table(db, tbl)
+                    by_db.setdefault(db, []).append(tbl)
+                for db, tbls in by_db.items():
+                    api.delete_glue_tables(db, tbls)
             else:
                 print("No tables found!")
 
@@ -510,28 +754,34 @@ def prompt_athena_manager(api):
                 print("No databases found!")
 
         elif o == GlueOptions.REPAIR:
-            for db in api.list_glue_databases():
-                for table in api.list_glue_tables(db):
-                    name = table["Name"]
-                    print(f"Checking '{db}.{name}'... ", end="", flush=True)
-                    s3db_type = {
-                        el["Name"]: el["Type"]
-                        for el in api.get_glue_type_map_from_s3db(db, name)
-                    }
-                    table_type = {
-                        el["Name"]: el["Type"]
-                        for el in table["StorageDescriptor"]["Columns"]
-                    }
-                    if s3db_type != table_type:
-                        print("FAILED - Schema mismatch found!")
-                        print(f"   s3db: {s3db_type}")
-                        print(f"  table: {table_type}")
-                        if prompt_confirmation("Repair Glue Table?"):
-                            print(f"Updating '{db}.{name}'... ", end="", flush=True)
-                            api.create_glue_table(db, name, update=True)
-                            print("done")
-                    else:
-                        print("SUCCESS")
+            print("Checking table schemas... ")
+            _, mismatched = api.diff_glue_catalog()
+            if mismatched:
+                for db, name, expected, current in mismatched:
+                    print(f"FAILED '{db}.{name}' - Schema mismatch found!")
+                    print(f"  expected: {expected}")
+                    print(f"   current: {current}")
+
+                tables = sorted([f"{db}.{name}" for db, name, _, _ in mismatched])
+                to_repair = prompt_checkbox("Select tables to repair:", tables)
+                repair_glue_tables(api, [tuple(el.split(".")) for el in to_repair])
+            else:
+                print("SUCCESS - All table schemas are up to date.")
+
+        elif o == GlueOptions.REPAIR_ALL:
+            sync_glue_catalog(api)
+
+        elif o == GlueOptions.REFRESH_RANGES:
+            print("Checking partition projection ranges... ")
+            outdated = api.diff_projection_ranges()
+            for db, name, current, expected in outdated:
+                print(f"  {db}.{name}: '{current}' -> '{expected}'")
+
+            msg = f"Update {len(outdated)} tables?"
+            if outdated and prompt_confirmation(msg):
+                repair_glue_tables(api, [(db, name) for db, name, _, _ in outdated])
+            elif not outdated:
+                print("SUCCESS - All partition projection ranges are up to date.")
 
         elif o == GlueOptions.BACK:
             break
@@ -544,6 +794,41 @@ def prompt_athena_manager(api):
             raise Exception(f"Unhandled selection: {o}")
 
 
+def sync_glue_catalog(api):
+    """Non-interactively creates all missing tables and repairs all mismatched
+    table schemas.
+    """
+    print("Scanning S3DB and the Glue catalog... ")
+    missing, mismatched = api.diff_glue_catalog()
+
+    existing_dbs = set(api.list_glue_databases())
+    to_create = sorted((db, t) for db, tbls in missing.items() for t in tbls)
+    for db in sorted(set(db for db, _ in to_create) - existing_dbs):
+        print(f"Creating database '{db}'...")
+        api.create_glue_database(db)
+
+    print(f"Creating {len(to_create)} new tables...")
+    failed = api.create_glue_tables(to_create)
+
+    # tables are recreated from S3DB on updates, which also refreshes the ranges
+    to_repair = set((db, name) for db, name, _, _ in mismatched)
+    to_repair.update((db, name) for db, name, _, _ in api.diff_projection_ranges())
+    print(f"Repairing {len(to_repair)} tables with schema or range mismatches...")
+    failed.update(api.create_glue_tables(sorted(to_repair), update=True))
+
+    for (db, table), exc in failed.items():
+        print(f"FAILED '{db}.{table}': {exc}")
+    print("Done")
+
+
+def repair_glue_tables(api, tables):
+    print(f"Updating {len(tables)} tables... ", end="", flush=True)
+    failed = api.create_glue_tables(tables, update=True)
+    print("done")
+    for (db, table), exc in failed.items():
+        print(f"FAILED '{db}.{table}': {exc}")
+
+
 def prompt_text(text, default=None, validate=None) -> str:
     args = {
         "name": "data",
@@ -557,6 +842,17 @@ def prompt_text(text, default=None, validate=None) -> str:
     return prompt([args])["data"]
 
 
+def prompt_datetime(text: str, after: Optional[datetime] = None) -> datetime:
+    def validate(x):
+        try:
+            dt = datetime.fromisoformat(x)
+        except ValueError:
+            return "Invalid date, expected YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS"
+        return after is None or dt > after or f"Must be after {after}"
+
+    return datetime.fromisoformat(prompt_text(text, validate=validate))
+
+
 def prompt_options(text: str, choices: list[str]) -> str:
     args = {
         "name": "data",
@@ -8,6 +8,7 @@ import boto3
 from moto import mock_s3
 
 from lambdas.common import SOURCE_BUCKET, SOURCE_PREFIX, gen_metadata_key
+from lambdas.storage import S3Storage
 
 
 s3 = mock_s3()
@@ -28,8 +29,8 @@ def setup_resources():
     insert_test_data("pjm", "dayahead_price", days=70)
 
 
-def insert_test_data(coll, ds, days=520):
-    s3_client = boto3.client("s3")
+def insert_test_data(coll, ds, days=520, storage=None):
+    storage = storage or S3Storage(SOURCE_BUCKET)
     header = "target_start,target_end,node_id,lmp"
     start = datetime(2020, 1, 1, tzinfo=timezone.utc)
     one_hour = int(timedelta(hours=1).total_seconds())
@@ -51,7 +52,7 @@ def insert_test_data(coll, ds, days=520):
             csv_data = "\n".join(lines)
             f.write(csv_data.encode())
 
-        s3_client.put_object(Bucket=SOURCE_BUCKET, Key=s3_key, Body=stream.getvalue())
+        storage.put(s3_key, stream.getvalue())
 
     metadata = {
         "type_map": {
@@ -65,4 +66,4 @@ def insert_test_data(coll, ds, days=520):
     }
     data = json.dumps(metadata).encode()
     key = gen_metadata_key(coll, ds)
-    s3_client.put_object(Bucket=SOURCE_BUCKET, Key=key, Body=data)
+    storage.put(key, data)
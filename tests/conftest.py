@@ -0,0 +1,23 @@
+import pytest
+
+from lambdas import clients
+from lambdas.storage import LocalStorage
+from tests.aws_setup import insert_test_data
+
+
+@pytest.fixture()
+def local_test_data() -> list[tuple[str, str, int]]:
+    """The (collection, dataset, days) of the S3DB test data in `local_storage`,
+    overridden by test modules (or parametrized by tests) that need any.
+    """
+    return []
+
+
+@pytest.fixture()
+def local_storage(tmp_path, monkeypatch, local_test_data):
+    """A store on local disk that is used in place of the S3 bucket."""
+    storage = LocalStorage(str(tmp_path / "store"))
+    monkeypatch.setattr(clients, "STORAGE", storage)
+    for coll, ds, days in local_test_data:
+        insert_test_data(coll, ds, days=days, storage=storage)
+    yield storage
@@ -0,0 +1,60 @@
+import pytest
+
+from autotune_compression import (
+    Result,
+    candidates,
+    measure,
+    pareto_front,
+    recommend,
+    record_profile,
+    sample_table,
+)
+from lambdas.profiles import ProfileRegistry
+
+
+@pytest.fixture()
+def local_test_data():
+    return [("pjm", "dayahead_price", 30)]
+
+
+def test_recommend():
+    results = [
+        Result("zst", 22, 100, 9.0, 1.0),
+        Result("zst", 9, 101, 2.0, 1.0),
+        Result("zst", 3, 110, 1.0, 1.0),
+        Result("gz", 9, 105, 3.0, 2.0),  # dominated by zst 9
+        Result("lz4", None, 150, 0.5, 0.5),
+    ]
+    assert results[3] not in pareto_front(results)
+    assert len(pareto_front(results)) == 4
+    # the fastest within 2% of the smallest size
+    assert recommend(results, "encode", 0.02) == results[1]
+    assert recommend(results, "encode", 0.0) == results[0]
+    assert recommend(results, "decode", 0.5) == results[4]
+
+
+def test_autotune(local_storage):
+    table = sample_table("pjm", "dayahead_price", 5)
+    assert len(table) == 5 * 24
+
+    assert list(candidates("parquet", ["zst", "sz"])) == [("zst", None), ("sz", None)]
+    results = [
+        measure(table, "arrow", codec, level, repeats=1)
+        for codec, level in [("zst", 1), ("zst", 22), ("lz4", None)]
+    ]
+    assert all(r.size > 0 and r.encode_s > 0 and r.decode_s > 0 for r in results)
+    assert results[1].size <= results[0].size
+
+    # recorded in the dataset's own profile of the live store
+    assert record_profile("pjm", "dayahead_price", "arrow", results[0], "p.json") == 1
+    registry = ProfileRegistry("p.json", ttl=0)
+    dataclient, athena = registry.resolve("pjm", "dayahead_price")
+    assert dataclient["compression_level"] == 1
+    assert registry.resolve("pjm", "load")[0]["compression_level"] == 22
+
+    assert record_profile("pjm", "dayahead_price", "parquet", results[2], "p.json") == 2
+    dataclient, athena = registry.resolve("pjm", "dayahead_price")
+    assert (dataclient["compression_level"], athena["compression"]) == (1, "lz4")
+
+    with pytest.raises(ValueError, match="only uses 'zst'"):
+        record_profile("pjm", "dayahead_price", "arrow", results[2], "p.json")
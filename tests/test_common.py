@@ -0,0 +1,70 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from lambdas import common
+from lambdas.common import (
+    SOURCE_PREFIX,
+    _get_arrow_table,
+    get_first_key,
+    get_storage,
+    list_keys,
+    refresh_clients,
+)
+from tests.aws_setup import mock_start, mock_stop, setup_resources
+
+
+@pytest.fixture()
+def patched_bucket():
+    mock_start()
+    refresh_clients()
+    yield setup_resources()
+    mock_stop()
+
+
+def test_get_first_key(patched_bucket):
+    prefix = f"{SOURCE_PREFIX}pjm/realtime_price/"
+    assert (
+        get_first_key("pjm", "realtime_price") == f"{prefix}year=2020/1577836800.csv.gz"
+    )
+    assert get_first_key("pjm", "no_such_dataset") is None
+
+    # a year prefix without any data files is skipped
+    get_storage().put(f"{prefix}year=2019/README.txt", b"")
+    assert (
+        get_first_key("pjm", "realtime_price") == f"{prefix}year=2020/1577836800.csv.gz"
+    )
+
+
+@pytest.mark.parametrize(
+    "module", ["lambdas.prod_listener", "lambdas.request_generator"]
+)
+def test_slim_handler_imports(module):
+    # handlers that don't convert data mustn't import heavy modules on cold starts
+    code = (
+        f"import sys, {module}; "
+        "heavy = ('pyarrow', 'pandas', 'psutil'); "
+        "print(','.join(m for m in heavy if m in sys.modules))"
+    )
+    env = {**os.environ, "AWS_DEFAULT_REGION": "us-east-1"}
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        check=True,
+        env=env,
+        text=True,
+    )
+    assert result.stdout.strip() == ""
+
+
+def test_get_arrow_table_stage_to_disk(patched_bucket, tmp_path, monkeypatch):
+    monkeypatch.setattr(common, "STAGING_DIR", str(tmp_path))
+    keys = sorted(list_keys("pjm", "dayahead_price"))[:31]
+    table = _get_arrow_table(keys)
+
+    staged = _get_arrow_table(keys, stage_to_disk=True)
+    assert staged.equals(table)
+    # staged files are unlinked once mapped
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from lambdas import payloads
+from lambdas.common import SOURCE_PREFIX, list_keys
+from lambdas.payloads import compact_request, get_source_keys
+from lambdas.request_generator import RequestGeneratorEvent, generate_requests
+
+
+@pytest.fixture()
+def local_test_data():
+    return [("pjm", "realtime_price", 400)]
+
+
+def test_compact_daily_keys(local_storage):
+    coll, ds = "pjm", "realtime_price"
+    attrs = {"datasets": {coll: [ds]}, "dest_prefix": "test/", "compression": "zst"}
+    event = RequestGeneratorEvent(partition_size="year", **attrs)
+    requests = list(generate_requests(coll, ds, event))
+    assert len(requests) == 2
+
+    # daily keys are encoded as a range, also across year partitions
+    compacted = [compact_request(r) for r in requests]
+    assert compacted[0]["s3key_range"] == {
+        "start": 1577836800,
+        "step": 86400,
+        "count": 366,
+    }
+    assert "s3key_suffixes" not in compacted[0]
+    keys = [k for r in compacted for k in get_source_keys(r)]
+    assert keys == sorted(list_keys(coll, ds))
+    assert len(json.dumps(compacted[0])) < 500
+
+
+def test_compact_large_requests(local_storage, monkeypatch):
+    monkeypatch.setattr(payloads, "MAX_INLINE_PAYLOAD_BYTES", 1000)
+    prefix = f"{SOURCE_PREFIX}pjm/realtime_price/"
+    request = {"s3key_prefix": prefix, "compression": "zst"}
+
+    # irregular keys are inlined if they fit
+    suffixes = ["year=2020/1577836800.csv.gz", "year=2020/1577840400.csv.gz"]
+    suffixes.append("year=2020/1577926800.csv.gz")
+    compacted = compact_request({**request, "s3key_suffixes": suffixes})
+    assert compacted == {**request, "s3key_suffixes": suffixes}
+
+    # and otherwise stored in S3
+    suffixes = [f"{i}.arrow" for i in range(200)]
+    compacted = compact_request({**request, "s3key_suffixes": suffixes})
+    assert set(compacted) == {"s3key_prefix", "compression", "s3key_suffixes_ref"}
+    assert compacted["s3key_suffixes_ref"].startswith(payloads.PAYLOAD_PREFIX)
+    assert get_source_keys(compacted) == [prefix + s for s in suffixes]
+
+    # identical key lists are stored once
+    assert compact_request({**request, "s3key_suffixes": suffixes}) == compacted
+
+    # and deleted once their requests can't be retried anymore
+    payloads.delete_expired_payloads()
+    assert get_source_keys(compacted) == [prefix + s for s in suffixes]
+    monkeypatch.setattr(payloads, "PAYLOAD_RETENTION_DAYS", -1)
+    payloads.delete_expired_payloads()
+    assert list(local_storage.list(payloads.PAYLOAD_PREFIX)) == []
@@ -0,0 +1,78 @@
+import threading
+import time
+
+import pytest
+
+from lambdas import pipeline
+from lambdas.pipeline import pipelined
+
+
+def test_pipelined():
+    # outputs are yielded in order, generator stages can yield multiple outputs
+    def split(i):
+        yield from (i, i)
+
+    results = list(pipelined(range(5), split, lambda i: i * 10))
+    assert results == [0, 0, 10, 10, 20, 20, 30, 30, 40, 40]
+
+    # stages overlap, so the total time is closer to the slowest stage than the sum
+    def slow(i):
+        time.sleep(0.1)
+        return i
+
+    start = time.monotonic()
+    assert list(pipelined(range(5), slow, slow, slow)) == list(range(5))
+    assert time.monotonic() - start < 1.5 * 0.1 * 5
+
+    # exceptions in any stage are re-raised to the consumer
+    def fail(i):
+        if i == 3:
+            raise ValueError("bad item")
+        return i
+
+    results = []
+    with pytest.raises(ValueError, match="bad item"):
+        for i in pipelined(range(5), fail):
+            results.append(i)
+    assert results == [0, 1, 2]
+
+
+def test_pipelined_backpressure():
+    n_threads = threading.active_count()
+    produced = []
+
+    def source():
+        for i in range(10):
+            produced.append(i)
+            yield b"x" * 100
+
+    # the queues share 150 bytes, i.e. only hold one 100 byte item at a time each, so
+    # the source can't run ahead
+    items = pipelined(source(), lambda b: b, max_items=10, max_bytes=150)
+    next(items)
+    time.sleep(0.1)
+    # 1 consumed, 1 queued for the consumer, 1 in the stage, 1 queued for the stage,
+    # and the last one blocked in the source
+    assert len(produced) <= 5
+    items.close()
+    # closing the generator early stops all pipeline threads
+    assert threading.active_count() == n_threads
+
+
+def test_pipelined_shared_budget(monkeypatch):
+    budget = pipeline.ByteBudget(150)
+    monkeypatch.setattr(pipeline, "PIPELINE_BUDGET", budget)
+    source = lambda: (b"x" * 100 for _ in range(5))
+
+    # concurrent pipelines (eg. of the records of a batch) share the budget, but still
+    # make progress when it's used up
+    first = pipelined(source(), lambda b: b)
+    second = pipelined(source(), lambda b: b)
+    assert next(first) == next(second) == b"x" * 100
+    time.sleep(0.1)
+    assert budget.used <= 2 * 2 * 100
+    assert len(list(second)) == 4
+
+    # the bytes of queued items are returned when a pipeline stops early
+    first.close()
+    assert budget.used == 0
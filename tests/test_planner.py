@@ -0,0 +1,110 @@
+import json
+
+import pytest
+
+from lambdas.config import PROFILE_PREFIX
+from lambdas.planner import (
+    BASE_SECONDS,
+    DEFAULT_MEMORY_RATIO,
+    calibrate,
+    describe_request,
+    estimate_request,
+    load_profile_summaries,
+    request_settings,
+)
+
+
+def summary(source_bytes, peak_bytes, duration_s, **settings):
+    request = {
+        "stage_to_disk": False,
+        "converted_source": False,
+        "file_format": "arrow",
+        "compression": "zst",
+        "source_bytes": source_bytes,
+        **settings,
+    }
+    return {
+        "requests": [request],
+        "arrow_peak_bytes": peak_bytes,
+        "duration_s": duration_s,
+    }
+
+
+def test_calibrate():
+    settings = request_settings(
+        {"file_format": "arrow", "compression": "zst", "source_prefix": None}
+    )
+    mb = 1024**2
+
+    # defaults without any matching profiles
+    staged = calibrate([summary(mb, mb, 2, stage_to_disk=True)], settings)
+    assert staged.samples == 0
+    assert staged.memory_ratio == DEFAULT_MEMORY_RATIO[False]
+
+    # the largest memory ratio of profiles with exactly matching settings
+    summaries = [
+        summary(mb, 8 * mb, BASE_SECONDS + 1),
+        summary(3 * mb, 12 * mb, BASE_SECONDS + 2),
+        summary(mb, 20 * mb, BASE_SECONDS + 5, compression="gz"),
+    ]
+    calibration = calibrate(summaries, settings)
+    assert calibration.samples == 2
+    assert calibration.memory_ratio == 8
+    assert calibration.seconds_per_mb == pytest.approx(3 / 4)
+
+    # falls back to profiles with other codecs
+    calibration = calibrate(summaries, {**settings, "compression": "br"})
+    assert calibration.samples == 3
+    assert calibration.memory_ratio == 20
+
+
+def test_estimate_request():
+    calibration = calibrate([], {"stage_to_disk": False})
+    request = {
+        "s3key_prefix": "a/b/",
+        "s3key_suffixes": ["year=2020/1.csv.gz"],
+        "partition_size": "hour",
+        "bucket_count": 4,
+        "rollups": [{"period": "hour"}],
+    }
+    estimate = estimate_request("a", "b", request, [1024**2], calibration, 2048)
+    assert estimate.first_key == "a/b/year=2020/1.csv.gz"
+    assert estimate.s3_gets == 1
+    # 24 hourly partitions of 4 buckets and a rollup, and the manifest entries
+    assert estimate.s3_puts == 24 * 5 + 1
+    assert not estimate.exceeds_memory
+
+    # more than fits in memory if processed concurrently with other requests
+    estimate = estimate_request(
+        "a", "b", request, [100 * 1024**2], calibration, 2048, concurrency=2
+    )
+    assert estimate.peak_memory_mb < 2048
+    assert estimate.exceeds_memory
+
+
+def test_load_profile_summaries(local_storage):
+    for i, date in enumerate(["2021-06-01", "2021-06-02", "2021-06-03"]):
+        key = f"{PROFILE_PREFIX}{date}/request-{i}.json"
+        local_storage.put(key, json.dumps(summary(i, i, i)).encode())
+    # without requests, eg. profiles of live conversions
+    key = f"{PROFILE_PREFIX}2021-06-03/request-3.json"
+    local_storage.put(key, b'{"requests": []}')
+
+    summaries = load_profile_summaries(limit=3)
+    assert [s["duration_s"] for s in summaries] == [1, 2]
+    assert load_profile_summaries(limit=1) == []
+
+
+def test_describe_request(local_storage):
+    keys = [
+        "ds/year=2020/10.csv.gz",
+        "ds/year=2020/11.csv.gz",
+        "ds/year=2021/20.csv.gz",
+    ]
+    for key in keys + ["ds/year=2020/12.csv.gz"]:
+        local_storage.put(key, b"abc")
+
+    request = {"file_format": "arrow", "compression": "zst"}
+    description = describe_request(request, keys)
+    assert description["source_keys"] == 3
+    assert description["source_bytes"] == 9
@@ -0,0 +1,91 @@
+import json
+
+import boto3
+import pytest
+from moto import mock_glue
+
+from lambdas import prod_listener
+from lambdas.common import gen_metadata_key, get_metadata, get_storage, refresh_clients
+from lambdas.glue_catalog import sync_glue_table
+from tests.aws_setup import mock_start, mock_stop, setup_resources
+
+
+@pytest.fixture()
+def patched_aws():
+    mock_start()
+    refresh_clients()
+    setup_resources()
+    with mock_glue():
+        yield boto3.client("glue")
+    mock_stop()
+
+
+# a prod listener event for a created/updated S3DB file
+def s3_event(key):
+    message = {"s3": {"object": {"key": key}}, "eventTime": "2021-06-15T20:00:00Z"}
+    return {"Records": [{"body": json.dumps({"Message": json.dumps(message)})}]}
+
+
+def test_metadata_glue_sync(patched_aws, monkeypatch):
+    monkeypatch.setattr(prod_listener, "GLUE_CATALOG_SYNC", True)
+    glue = patched_aws
+    coll, ds = "pjm", "dayahead_price"
+    event = s3_event(gen_metadata_key(coll, ds))
+
+    # new datasets get a table (and database)
+    prod_listener.lambda_handler(event, None)
+    table = glue.get_table(DatabaseName=coll, Name=ds)["Table"]
+    columns = table["StorageDescriptor"]["Columns"]
+    assert [c["Name"] for c in columns] == [
+        "target_start",
+        "target_end",
+        "node_id",
+        "lmp",
+    ]
+    assert table["StorageDescriptor"]["Location"].endswith(f"/day/{coll}/{ds}")
+    assert table["Parameters"]["projection.day_partition.range"].startswith(
+        "2020-01-01,"
+    )
+
+    # type map changes update the table's columns
+    metadata = get_metadata(coll, ds)
+    metadata["type_map"]["congestion"] = "float"
+    get_storage().put(gen_metadata_key(coll, ds), json.dumps(metadata).encode())
+    prod_listener.lambda_handler(event, None)
+    table = glue.get_table(DatabaseName=coll, Name=ds)["Table"]
+    columns = table["StorageDescriptor"]["Columns"]
+    assert columns[-1] == {"Name": "congestion", "Type": "double"}
+
+    # unchanged tables aren't touched
+    get_versions = lambda: glue.get_table_versions(DatabaseName=coll, TableName=ds)
+    versions = get_versions()["TableVersions"]
+    prod_listener.lambda_handler(event, None)
+    assert get_versions()["TableVersions"] == versions
+
+
+def test_sync_glue_table_layout(patched_aws):
+    glue = patched_aws
+    coll, ds = "pjm", "dayahead_price"
+    kwargs = {"data_location": "s3://bucket/athena/", "partition_size": "day"}
+    assert sync_glue_table(glue, coll, ds, **kwargs) == "created"
+    assert sync_glue_table(glue, coll, ds, **kwargs) is None
+
+    # changes of the store's settings change the partition keys and parameters
+    assert sync_glue_table(glue, coll, ds, bucket_count=8, **kwargs) == "updated"
+    table = glue.get_table(DatabaseName=coll, Name=ds)["Table"]
+    assert [k["Name"] for k in table["PartitionKeys"]] == [
+        "day_partition",
+        "superkey_bucket",
+    ]
+    assert sync_glue_table(glue, coll, ds, bucket_count=8, **kwargs) is None
+    assert sync_glue_table(glue, coll, ds, bucket_count=16, **kwargs) == "updated"
+    assert sync_glue_table(glue, coll, ds, **kwargs) == "updated"
+
+    # as do changes of its location, eg. of the store's prefix
+    kwargs["data_location"] = "s3://bucket/athena/v2/"
+    assert sync_glue_table(glue, coll, ds, **kwargs) == "updated"
+    table = glue.get_table(DatabaseName=coll, Name=ds)["Table"]
+    assert (
+        table["StorageDescriptor"]["Location"]
+        == f"{kwargs['data_location']}{coll}/{ds}"
+    )
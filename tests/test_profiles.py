@@ -0,0 +1,109 @@
+import json
+
+import pytest
+
+from lambdas.profiles import DEFAULT_STORES, ProfileRegistry, validate_profiles
+
+
+def put_profiles(storage, version, profiles):
+    dataclient, athena = DEFAULT_STORES
+    document = {
+        "version": version,
+        "stores": [{**dataclient, "profiles": profiles}, athena],
+    }
+    storage.put("profiles.json", json.dumps(document).encode())
+
+
+def test_profile_registry(local_storage):
+    registry = ProfileRegistry("profiles.json", ttl=0)
+    # defaults to the built-in stores until a document is created
+    assert registry.resolve("pjm", "dayahead_price") == DEFAULT_STORES
+    assert registry.version is None
+
+    profiles = [
+        {"datasets": ["pjm/*_price"], "compression_level": 3},
+        {"datasets": ["pjm/*", "miso/load"], "compression_level": 9},
+    ]
+    put_profiles(local_storage, 1, profiles)
+    # the first matching profile wins
+    dataclient, athena = registry.resolve("pjm", "dayahead_price")
+    assert dataclient == {**DEFAULT_STORES[0], "compression_level": 3}
+    assert athena == DEFAULT_STORES[1]
+    assert registry.resolve("pjm", "load")[0]["compression_level"] == 9
+    assert registry.resolve("miso", "load")[0]["compression_level"] == 9
+    assert registry.resolve("miso", "price")[0] == DEFAULT_STORES[0]
+    assert registry.version == 1
+
+    # invalid documents are ignored
+    put_profiles(local_storage, 2, [{"datasets": ["*"], "partition_size": "year"}])
+    assert registry.resolve("pjm", "dayahead_price")[0]["compression_level"] == 3
+    assert registry.version == 1
+
+    # and are only re-read after the ttl
+    registry.ttl = 3600
+    put_profiles(local_storage, 3, [])
+    assert registry.resolve("pjm", "dayahead_price")[0]["compression_level"] == 3
+    registry.ttl = 0
+    assert registry.resolve("pjm", "dayahead_price")[0]["compression_level"] == 22
+    assert registry.version == 3
+
+    # falls back to the defaults once the document is deleted
+    put_profiles(local_storage, 4, profiles)
+    assert registry.resolve("pjm", "dayahead_price")[0]["compression_level"] == 3
+    local_storage.delete(["profiles.json"])
+    assert registry.resolve("pjm", "dayahead_price") == DEFAULT_STORES
+    assert registry.version is None
+
+
+@pytest.mark.parametrize(
+    "profile, error",
+    [
+        ({"datasets": ["*"], "dest_prefix": "x/"}, "Invalid profile setting"),
+        ({"datasets": ["*"], "compression": "gz"}, "only be overridden for athena"),
+        ({"datasets": ["*"], "compression_level": 99}, "Invalid compression level"),
+        ({"datasets": ["*"], "bucket_count": 4}, "Invalid profile setting"),
+        ({"compression_level": 3}, "without 'datasets'"),
+    ],
+)
+def test_validate_profiles(profile, error):
+    dataclient, athena = DEFAULT_STORES
+    document = {"version": 1, "stores": [{**dataclient, "profiles": [profile]}, athena]}
+    with pytest.raises(ValueError, match=error):
+        validate_profiles(document)
+
+    # the layout of the athena store's tables is set per store
+    bucketed = {**athena, "bucket_count": 4}
+    validate_profiles({"version": 1, "stores": [dataclient, bucketed]})
+    with pytest.raises(ValueError, match="only supported for athena"):
+        validate_profiles(
+            {"version": 1, "stores": [{**dataclient, "bucket_count": 4}, athena]}
+        )
+
+
+@pytest.mark.parametrize(
+    "stores, error",
+    [
+        ([DEFAULT_STORES[0]], "Expected a store for each"),
+        ([DEFAULT_STORES[0], {**DEFAULT_STORES[1], "dest_store": "x"}], "Expected"),
+        ([DEFAULT_STORES[0], DEFAULT_STORES[0]], "Expected a store for each"),
+        (
+            [DEFAULT_STORES[0], {**DEFAULT_STORES[1], "file_format": "csv"}],
+            "file_format",
+        ),
+        (
+            [DEFAULT_STORES[0], {**DEFAULT_STORES[1], "partition_size": "week"}],
+            "partition_size",
+        ),
+        (
+            [{**DEFAULT_STORES[0], "partition_size": "month"}, DEFAULT_STORES[1]],
+            "live stores only support",
+        ),
+        (
+            [DEFAULT_STORES[0], {**DEFAULT_STORES[1], "file_format": "arrow"}],
+            "has to be parquet",
+        ),
+    ],
+)
+def test_validate_profile_stores(stores, error):
+    with pytest.raises(ValueError, match=error):
+        validate_profiles({"version": 1, "stores": stores})
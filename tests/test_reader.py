@@ -0,0 +1,115 @@
+import json
+import os
+from datetime import datetime, timezone
+
+import pyarrow.compute as pc
+import pytest
+
+from lambdas import reader
+from lambdas.request_generator import RequestGeneratorEvent, generate_requests
+from lambdas.request_handler import lambda_handler
+
+
+COLL, DS = "pjm", "dayahead_price"
+
+
+@pytest.fixture()
+def local_test_data():
+    return [(COLL, DS, 10)]
+
+
+def convert(partition, fmt, dest_store, compression="zst"):
+    dest_prefix = f"test/{dest_store}/{partition}/{fmt}/{compression}/"
+    payload = {
+        "datasets": {COLL: [DS]},
+        "dest_prefix": dest_prefix,
+        "compression": compression,
+        "partition_size": partition,
+        "dest_store": dest_store,
+        "file_format": fmt,
+    }
+    job = RequestGeneratorEvent(**payload)
+    for event in generate_requests(COLL, DS, job):
+        lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
+    return dest_prefix
+
+
+@pytest.mark.parametrize(
+    "partition,fmt,dest_store,compression",
+    [
+        ("day", "parquet", "athena", "sz"),
+        ("hour", "parquet", "athena", "zst"),
+        ("month", "arrow", "dataclient", "zst"),
+        ("day", "arrow", "dataclient", "sz"),
+        ("day", "parquet", "dataclient", "gz"),
+    ],
+)
+def test_read(local_storage, partition, fmt, dest_store, compression):
+    dest_prefix = convert(partition, fmt, dest_store, compression)
+    start = datetime(2020, 1, 3, 12, tzinfo=timezone.utc)
+    end = datetime(2020, 1, 5, 6, tzinfo=timezone.utc)
+
+    table = reader.read(COLL, DS, start, end, dest_prefix=dest_prefix)
+    target_starts = table.column("target_start").to_pylist()
+    # test data has hourly rows
+    expected = list(range(int(start.timestamp()), int(end.timestamp()), 3600))
+    assert sorted(target_starts) == expected
+    assert table.column_names == ["target_start", "target_end", "node_id", "lmp"]
+
+    # column and predicate pushdown
+    table = reader.read(
+        COLL,
+        DS,
+        start,
+        end,
+        columns=["target_start", "lmp"],
+        dest_prefix=dest_prefix,
+        filter=pc.field("node_id") == 12,
+    )
+    assert table.column_names == ["target_start", "lmp"]
+    assert table.column("target_start").to_pylist() == expected[::24]  # starts at 12:00
+
+    # nothing to read
+    table = reader.read(COLL, DS, 0, 3600, dest_prefix=dest_prefix)
+    assert len(table) == 0
+
+
+def test_list_files(local_storage):
+    dest_prefix = convert("day", "parquet", "athena")
+    dataset_prefix = os.path.join(dest_prefix, COLL, DS, "")
+    start = int(datetime(2020, 1, 3, 12, tzinfo=timezone.utc).timestamp())
+    end = int(datetime(2020, 1, 5, tzinfo=timezone.utc).timestamp())
+
+    keys = reader.list_files(local_storage, dataset_prefix, start, end)
+    assert [k.rsplit("/", 2)[-2] for k in keys] == [
+        "day_partition=2020-01-03",
+        "day_partition=2020-01-04",
+    ]
+
+
+def test_read_with_cache(local_storage, tmp_path, monkeypatch):
+    dest_prefix = convert("day", "arrow", "dataclient")
+    cache = reader.FileCache(str(tmp_path / "cache"))
+    start = datetime(2020, 1, 3, tzinfo=timezone.utc)
+    end = datetime(2020, 1, 6, tzinfo=timezone.utc)
+
+    expected = reader.read(COLL, DS, start, end, dest_prefix=dest_prefix)
+    table = reader.read(COLL, DS, start, end, dest_prefix=dest_prefix, cache=cache)
+    assert table.equals(expected)
+    assert len(os.listdir(cache.directory)) == 3
+
+    # cached files aren't downloaded again
+    get = local_storage.get
+    with monkeypatch.context() as m:
+        m.setattr(local_storage, "get", lambda k: get(k) if "_manifest" in k else 1 / 0)
+        table = reader.read(COLL, DS, start, end, dest_prefix=dest_prefix, cache=cache)
+    assert table.equals(expected)
+
+    # least recently used files are evicted first
+    cache = reader.FileCache(str(tmp_path / "lru"), max_bytes=20)
+    paths = [cache.get(str(i), "", lambda: b"x" * 10) for i in range(3)]
+    for i, path in enumerate(paths):
+        os.utime(path, ns=(i, i))
+    cache.get("0", "", lambda: pytest.fail("cache miss"))
+    cache.evict()
+    assert [os.path.exists(p) for p in paths] == [True, False, True]
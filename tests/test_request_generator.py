@@ -1,14 +1,24 @@
+import json
+from datetime import datetime, timezone
+
 import pytest
 
+from lambdas import request_generator
 from lambdas.common import (
     SOURCE_PREFIX,
     extract_datetime,
     floor_dt,
+    get_storage,
     list_keys,
     refresh_clients,
 )
-from lambdas.request_generator import RequestGeneratorEvent, generate_requests
-from tests.aws_setup import mock_start, mock_stop, setup_resources
+from lambdas.planner import Calibration
+from lambdas.request_generator import (
+    RequestGeneratorEvent,
+    generate_requests,
+    plan_backfill,
+)
+from tests.aws_setup import insert_test_data, mock_start, mock_stop, setup_resources
 
 
 @pytest.fixture()
@@ -169,3 +179,187 @@ def test_generate_requests(patched_bucket):
         assert r["s3key_prefix"] == f"{SOURCE_PREFIX}{coll}/{ds}/"
         # check that all keys belong to the same partition
         assert len(set([key_func(k) for k in r["s3key_suffixes"]])) == 1
+
+
+def test_generate_requests_time_range(patched_bucket, monkeypatch):
+    coll, ds = "pjm", "realtime_price"
+    attrs = {"datasets": {coll: [ds]}, "dest_prefix": "test/", "compression": "zst"}
+    start, end = "2021-03-15T06:00:00", "2021-04-01"
+
+    with pytest.raises(Exception, match="Invalid time range"):
+        RequestGeneratorEvent(start=end, end=start, **attrs)
+
+    # only the year prefixes within the range are listed
+    storage = get_storage()
+    listed = []
+    for name in ("list", "list_sizes"):
+        list_fn = getattr(storage, name)
+        spy = lambda p, list_fn=list_fn, **kw: listed.append(p) or list_fn(p, **kw)
+        monkeypatch.setattr(storage, name, spy)
+
+    # the range is widened to whole days
+    event = RequestGeneratorEvent(partition_size="hour", start=start, end=end, **attrs)
+    requests = list(generate_requests(coll, ds, event))
+    assert len(requests) == 17
+    first = extract_datetime(requests[0]["s3key_suffixes"][0])
+    assert first == datetime(2021, 3, 15, tzinfo=timezone.utc)
+    assert any("year=2021" in p for p in listed)
+    assert not any("year=2020" in p for p in listed)
+
+    # the range is widened to whole months, so existing months aren't overwritten with
+    # partial data
+    event = RequestGeneratorEvent(partition_size="month", start=start, end=end, **attrs)
+    requests = list(generate_requests(coll, ds, event))
+    assert len(requests) == 1
+    assert len(requests[0]["s3key_suffixes"]) == 31
+
+    event = RequestGeneratorEvent(partition_size="month", end="2021-04-01T01", **attrs)
+    requests = list(generate_requests(coll, ds, event))
+    assert len(requests) == 16  # 2020-01 to 2021-04
+
+
+class FakeContext:
+    aws_request_id = "request-1"
+    invoked_function_arn = "arn:aws:lambda:us-east-1:123:function:generator"
+
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms.pop(0) if self.remaining_ms else 900_000
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = []
+
+    def send_message_batch(self, **kwargs):
+        self.calls.append(kwargs)
+        return {"Successful": kwargs["Entries"]}
+
+    def invoke(self, **kwargs):
+        self.calls.append(kwargs)
+
+
+def test_lambda_handler_checkpoints(local_storage, monkeypatch):
+    # conditional writes aren't supported by moto
+    insert_test_data("pjm", "dayahead_price", days=70, storage=local_storage)
+    insert_test_data("pjm", "realtime_price", days=100, storage=local_storage)
+
+    sqs, lmb = FakeClient(), FakeClient()
+    monkeypatch.setattr(request_generator, "get_sqs_client", lambda: sqs)
+    monkeypatch.setattr(request_generator, "get_lambda_client", lambda: lmb)
+    monkeypatch.setenv("SINGLE_JOB_SQS_URL", "single")
+    event = {
+        "datasets": {"pjm": ["dayahead_price", "realtime_price"]},
+        "dest_prefix": "test/",
+        "compression": "zst",
+        "dest_store": "athena",
+        "file_format": "parquet",
+    }
+    n_keys = len(list(list_keys("pjm", "dayahead_price"))) + len(
+        list(list_keys("pjm", "realtime_price"))
+    )
+
+    # runs out of time after 5 batches
+    context = FakeContext([900_000] * 5 + [1000])
+    request_generator.lambda_handler(event, context)
+    assert len(sqs.calls) == 5
+    checkpoint_key = json.loads(lmb.calls[0]["Payload"])["checkpoint_key"]
+    assert lmb.calls[0]["FunctionName"] == context.invoked_function_arn
+    assert checkpoint_key.endswith("request-1.json")
+
+    # a retry of the first invocation resumes from the checkpoint too
+    request_generator.lambda_handler(event, FakeContext([900_000, 1000]))
+    assert len(sqs.calls) == 6
+
+    request_generator.lambda_handler({"checkpoint_key": checkpoint_key}, context)
+    sent = [
+        json.loads(e["MessageBody"])["s3key_suffixes"][0]
+        for call in sqs.calls
+        for e in call["Entries"]
+    ]
+    # every partition is only enqueued once
+    assert len(sent) == n_keys
+    assert len(lmb.calls) == 2
+
+    # once done, further invocations are no-ops
+    request_generator.lambda_handler({"checkpoint_key": checkpoint_key}, context)
+    assert len(sent) == sum(len(call.get("Entries", [])) for call in sqs.calls)
+    checkpoint = request_generator.Checkpoint.load(checkpoint_key)
+    assert checkpoint.done
+
+    # and the checkpoint is deleted once it's no longer needed for retries
+    request_generator.delete_expired_checkpoints()
+    assert list(local_storage.list(request_generator.CHECKPOINT_PREFIX)) == [
+        checkpoint_key
+    ]
+    monkeypatch.setattr(request_generator, "CHECKPOINT_RETENTION_S", -1)
+    request_generator.delete_expired_checkpoints()
+    assert list(local_storage.list(request_generator.CHECKPOINT_PREFIX)) == []
+
+
+def test_lambda_handler_slow_batches(local_storage, monkeypatch):
+    insert_test_data("pjm", "dayahead_price", days=70, storage=local_storage)
+    sqs, lmb = FakeClient(), FakeClient()
+    monkeypatch.setattr(request_generator, "get_sqs_client", lambda: sqs)
+    monkeypatch.setattr(request_generator, "get_lambda_client", lambda: lmb)
+    monkeypatch.setenv("SINGLE_JOB_SQS_URL", "single")
+    event = {
+        "datasets": {"pjm": ["dayahead_price"]},
+        "dest_prefix": "test/",
+        "compression": "zst",
+    }
+
+    # the first batch (including the listing) took 50s, another one wouldn't leave
+    # enough time to checkpoint
+    remaining_ms = request_generator.CHECKPOINT_MARGIN_MS + 40_000
+    request_generator.lambda_handler(
+        event, FakeContext([900_000, 850_000, remaining_ms])
+    )
+    assert len(sqs.calls) == 2
+    assert len(lmb.calls) == 1
+
+
+def test_generate_requests_after(patched_bucket):
+    coll, ds = "pjm", "realtime_price"
+    attrs = {"datasets": {coll: [ds]}, "dest_prefix": "test/", "compression": "zst"}
+    event = RequestGeneratorEvent(partition_size="month", **attrs)
+    requests = list(generate_requests(coll, ds, event))
+
+    last = requests[13]
+    after = last["s3key_prefix"] + last["s3key_suffixes"][-1]
+    assert list(generate_requests(coll, ds, event, after=after)) == requests[14:]
+
+
+def test_plan_backfill(local_storage, monkeypatch):
+    insert_test_data("pjm", "dayahead_price", days=70, storage=local_storage)
+    sqs = FakeClient()
+    monkeypatch.setattr(request_generator, "get_sqs_client", lambda: sqs)
+    event = {
+        "datasets": {"pjm": ["dayahead_price"]},
+        "dest_prefix": "test/",
+        "compression": "zst",
+        "partition_size": "month",
+        "dry_run": True,
+    }
+
+    # nothing is enqueued or checkpointed
+    plan = request_generator.lambda_handler(event, FakeContext([900_000]))
+    assert sqs.calls == [] and list(local_storage.list("version5/s3dbconverter/")) == []
+    assert plan["memory_mb"] == request_generator.BATCH_JOB_MEMORY_MB
+    assert plan["calibration"]["samples"] == 0
+    [dataset] = plan["datasets"]
+    assert dataset["requests"] == 3
+    n_keys = len(list(list_keys("pjm", "dayahead_price")))
+    # a GET per source file, a PUT per dest file and manifest update
+    assert dataset["s3_gets"] == n_keys
+    assert dataset["s3_puts"] == 2 * 3
+    assert plan["exceeding_memory"] == []
+
+    # flags requests that won't fit in memory, i.e. more than ~15 source files here
+    file_size = local_storage.head(next(list_keys("pjm", "dayahead_price"))).size
+    memory_ratio = request_generator.BATCH_JOB_MEMORY_MB * 1024**2 / (15 * file_size)
+    calibration = Calibration(memory_ratio, seconds_per_mb=1.0, samples=1)
+    plan = plan_backfill(RequestGeneratorEvent(**event), calibration)
+    assert [r.source_keys for r in plan.exceeding_memory] == [31, 29]
@@ -1,18 +1,26 @@
+import gzip
 import io
 import json
 import re
+import time
+import zlib
 from datetime import datetime, timezone
 
 import boto3
 import pandas as pd
+import pyarrow as pa
 import pytest
+from pyarrow import csv, parquet as pq
 
+from lambdas import common, manifest, profiling, reader
 from lambdas.common import (
     SOURCE_BUCKET,
     SOURCE_PREFIX,
-    _s3_list,
     extract_datetime,
     floor_dt,
+    gen_metadata_key,
+    get_storage,
+    read_manifest,
     refresh_clients,
 )
 from lambdas.request_generator import RequestGeneratorEvent, generate_requests
@@ -28,6 +36,15 @@ def patched_bucket():
     mock_stop()
 
 
+@pytest.fixture()
+def local_test_data():
+    return [("pjm", "dayahead_price", 10)]
+
+
+class FakeContext:
+    aws_request_id = "request-1"
+
+
 # helper function to generate request handler events
 def generate_events(coll, ds, partition, fmt, dest_store, compression="zst"):
     payload = {
@@ -42,6 +59,12 @@ def generate_events(coll, ds, partition, fmt, dest_store, compression="zst"):
     return list(generate_requests(coll, ds, job))
 
 
+# lists the converted files of a dataset, excluding the manifest
+def list_dest_files(dest_prefix, coll, ds):
+    keys = get_storage().list(f"{dest_prefix}{coll}/{ds}/")
+    return [k for k in keys if "/_manifest" not in k]
+
+
 is_dataclient = lambda key: re.search(r"year=\d{4}")  # type: ignore
 is_athena = lambda key: re.search(r"dt=\d{4}")  # type: ignore
 
@@ -54,8 +77,8 @@ def test_handler_for_dataclient(patched_bucket):
     events = generate_events(coll, ds, "day", fmt, dest_store)
     for event in events:
         lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
-    source_files = list(_s3_list(SOURCE_BUCKET, f"{SOURCE_PREFIX}{coll}/{ds}"))
-    dest_files = list(_s3_list(SOURCE_BUCKET, f"{events[0]['dest_prefix']}{coll}/{ds}"))
+    source_files = list(get_storage().list(f"{SOURCE_PREFIX}{coll}/{ds}"))
+    dest_files = list_dest_files(events[0]["dest_prefix"], coll, ds)
     # source files are partitioned by day as well
     assert len(dest_files) == len(source_files) - 1  # 1 extra metadata file
     # check that dataclient-styled path is generated with the correct extension
@@ -65,8 +88,8 @@ def test_handler_for_dataclient(patched_bucket):
     events = generate_events(coll, ds, "hour", fmt, dest_store)
     for event in events:
         lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
-    source_files = list(_s3_list(SOURCE_BUCKET, f"{SOURCE_PREFIX}{coll}/{ds}"))
-    dest_files = list(_s3_list(SOURCE_BUCKET, f"{events[0]['dest_prefix']}{coll}/{ds}"))
+    source_files = list(get_storage().list(f"{SOURCE_PREFIX}{coll}/{ds}"))
+    dest_files = list_dest_files(events[0]["dest_prefix"], coll, ds)
     # there be 24x dest files because source files are partitioned by day
     assert len(dest_files) == (len(source_files) - 1) * 24  # 1 extra metadata file
     # check that dataclient-styled path is generated with the correct extension
@@ -76,8 +99,8 @@ def test_handler_for_dataclient(patched_bucket):
     events = generate_events(coll, ds, "month", fmt, dest_store)
     for event in events:
         lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
-    source_files = list(_s3_list(SOURCE_BUCKET, f"{SOURCE_PREFIX}{coll}/{ds}"))
-    dest_files = list(_s3_list(SOURCE_BUCKET, f"{events[0]['dest_prefix']}{coll}/{ds}"))
+    source_files = list(get_storage().list(f"{SOURCE_PREFIX}{coll}/{ds}"))
+    dest_files = list_dest_files(events[0]["dest_prefix"], coll, ds)
     assert len(dest_files) == 3  # data -> 2020-1-1 to 2020-3-2, so 3 months total
     # check that dataclient-styled path is generated with the correct extension
     assert all(reg.search(key) for key in dest_files)
@@ -86,8 +109,8 @@ def test_handler_for_dataclient(patched_bucket):
     events = generate_events(coll, ds, "year", fmt, dest_store)
     for event in events:
         lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
-    source_files = list(_s3_list(SOURCE_BUCKET, f"{SOURCE_PREFIX}{coll}/{ds}"))
-    dest_files = list(_s3_list(SOURCE_BUCKET, f"{events[0]['dest_prefix']}{coll}/{ds}"))
+    source_files = list(get_storage().list(f"{SOURCE_PREFIX}{coll}/{ds}"))
+    dest_files = list_dest_files(events[0]["dest_prefix"], coll, ds)
     assert len(dest_files) == 1
     # check that dataclient-styled path is generated with the correct extension
     assert all(reg.search(key) for key in dest_files)
@@ -102,8 +125,8 @@ def test_handler_for_athena(patched_bucket):
     events = generate_events(coll, ds, "day", fmt, dest_store)
     for event in events:
         lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
-    source_files = list(_s3_list(SOURCE_BUCKET, f"{SOURCE_PREFIX}{coll}/{ds}"))
-    dest_files = list(_s3_list(SOURCE_BUCKET, f"{events[0]['dest_prefix']}{coll}/{ds}"))
+    source_files = list(get_storage().list(f"{SOURCE_PREFIX}{coll}/{ds}"))
+    dest_files = list_dest_files(events[0]["dest_prefix"], coll, ds)
     # source files are partitioned by day as well
     assert len(dest_files) == len(source_files) - 1  # 1 extra metadata file
     # check that it is a valid parquet file containing the correct data
@@ -123,8 +146,8 @@ def test_handler_for_athena(patched_bucket):
     events = generate_events(coll, ds, "hour", fmt, dest_store)
     for event in events:
         lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
-    source_files = list(_s3_list(SOURCE_BUCKET, f"{SOURCE_PREFIX}{coll}/{ds}"))
-    dest_files = list(_s3_list(SOURCE_BUCKET, f"{events[0]['dest_prefix']}{coll}/{ds}"))
+    source_files = list(get_storage().list(f"{SOURCE_PREFIX}{coll}/{ds}"))
+    dest_files = list_dest_files(events[0]["dest_prefix"], coll, ds)
     # there be 24x dest files because source files are partitioned by day
     assert len(dest_files) == (len(source_files) - 1) * 24  # 1 extra metadata file
     # check that it is a valid parquet file containing the correct data
@@ -144,8 +167,8 @@ def test_handler_for_athena(patched_bucket):
     events = generate_events(coll, ds, "month", fmt, dest_store)
     for event in events:
         lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
-    source_files = list(_s3_list(SOURCE_BUCKET, f"{SOURCE_PREFIX}{coll}/{ds}"))
-    dest_files = list(_s3_list(SOURCE_BUCKET, f"{events[0]['dest_prefix']}{coll}/{ds}"))
+    source_files = list(get_storage().list(f"{SOURCE_PREFIX}{coll}/{ds}"))
+    dest_files = list_dest_files(events[0]["dest_prefix"], coll, ds)
     assert len(dest_files) == 3  # data -> 2020-1-1 to 2020-3-2, so 3 months total
     # check that it is a valid parquet file containing the correct data
     part_key = lambda ts: floor_dt(datetime.fromtimestamp(ts), "month").replace(
@@ -164,8 +187,8 @@ def test_handler_for_athena(patched_bucket):
     events = generate_events(coll, ds, "year", fmt, dest_store)
     for event in events:
         lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
-    source_files = list(_s3_list(SOURCE_BUCKET, f"{SOURCE_PREFIX}{coll}/{ds}"))
-    dest_files = list(_s3_list(SOURCE_BUCKET, f"{events[0]['dest_prefix']}{coll}/{ds}"))
+    source_files = list(get_storage().list(f"{SOURCE_PREFIX}{coll}/{ds}"))
+    dest_files = list_dest_files(events[0]["dest_prefix"], coll, ds)
     assert len(dest_files) == 1
     # check that it is a valid parquet file containing the correct data
     part_key = lambda ts: floor_dt(datetime.fromtimestamp(ts), "year").replace(
@@ -178,3 +201,384 @@ def test_handler_for_athena(patched_bucket):
         pk = set(map(part_key, df.target_start))
         assert len(pk) == 1
         assert pk.pop() == extract_datetime(key)
+
+
+def test_handler_partial_batch_failure(patched_bucket):
+    coll, ds = "pjm", "dayahead_price"
+    events = generate_events(coll, ds, "day", "arrow", "dataclient")[:3]
+    # the middle request references a source file that doesn't exist
+    events[1]["s3key_suffixes"] = ["year=2020/123.csv.gz"]
+    records = [
+        {"messageId": str(i), "body": json.dumps(e)} for i, e in enumerate(events)
+    ]
+
+    resp = lambda_handler({"Records": records}, None)
+    assert resp == {"batchItemFailures": [{"itemIdentifier": "1"}]}
+
+    # the other records in the batch are still converted
+    dest_files = list_dest_files(events[0]["dest_prefix"], coll, ds)
+    assert len(dest_files) == 2
+
+    # malformed records are reported as failures too, rather than failing the batch
+    resp = lambda_handler({"Records": [{"messageId": "a", "body": "not json"}]}, None)
+    assert resp == {"batchItemFailures": [{"itemIdentifier": "a"}]}
+
+
+def test_handler_with_local_storage(local_storage):
+    coll, ds = "pjm", "dayahead_price"
+    events = generate_events(coll, ds, "hour", "parquet", "athena")
+    for event in events:
+        lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
+
+    source_files = list(local_storage.list(f"{SOURCE_PREFIX}{coll}/{ds}/"))
+    dest_files = list_dest_files(events[0]["dest_prefix"], coll, ds)
+    assert len(dest_files) == (len(source_files) - 1) * 24  # 1 extra metadata file
+    df = pd.read_parquet(local_storage.fs_path(dest_files[0]), engine="pyarrow")
+    assert len(df) == 1
+
+
+def test_handler_manifest(local_storage):
+    coll, ds = "pjm", "dayahead_price"
+    events = generate_events(coll, ds, "hour", "arrow", "dataclient")
+    for event in events:
+        lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
+
+    dest_prefix = events[0]["dest_prefix"]
+    entries = read_manifest(coll, ds, dest_prefix)
+    dest_files = list_dest_files(dest_prefix, coll, ds)
+    assert sorted(entries.column("key").to_pylist()) == dest_files
+    for entry in entries.to_pylist():
+        assert entry["rows"] == 1
+        assert entry["min_target_start"] == entry["file_start"]
+        assert entry["max_target_start"] == entry["file_start"]
+        assert entry["min_release_date"] is None
+        assert len(entry["source_etags"]) == 1
+
+    # converting the same files again replaces the existing entries
+    lambda_handler({"Records": [{"body": json.dumps(events[0])}]}, None)
+    dataset_prefix = f"{dest_prefix}{coll}/{ds}/"
+    assert len(list(local_storage.list(f"{dataset_prefix}_manifest/"))) == 12
+    assert len(read_manifest(coll, ds, dest_prefix)) == len(entries)
+
+    # pending entries are merged into the manifest file
+    manifest.compact(local_storage, dataset_prefix)
+    assert list(local_storage.list(f"{dataset_prefix}_manifest/")) == []
+    assert len(read_manifest(coll, ds, dest_prefix)) == len(entries)
+
+
+def test_handler_skip_unchanged(local_storage):
+    coll, ds = "pjm", "dayahead_price"
+    events = generate_events(coll, ds, "hour", "arrow", "dataclient")
+    events = [{**e, "skip_unchanged": True} for e in events[:2]]
+    for event in events:
+        lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
+
+    dest_prefix = events[0]["dest_prefix"]
+    dest_files = list_dest_files(dest_prefix, coll, ds)
+    etags = {k: local_storage.head(k).etag for k in dest_files}
+    assert len(etags) == 48
+    n_entries = len(list(local_storage.list(f"{dest_prefix}{coll}/{ds}/_manifest/")))
+
+    # rewrite a source file, changing a single hour
+    source_key = f"{events[0]['s3key_prefix']}{events[0]['s3key_suffixes'][0]}"
+    with gzip.open(local_storage.get(source_key)) as f:
+        lines = f.read().decode().splitlines()
+    lines[1] = lines[1].replace("8.9", "9.9")
+    local_storage.put(source_key, gzip.compress("\n".join(lines).encode()))
+
+    for event in events:
+        lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
+
+    changed = [k for k in dest_files if local_storage.head(k).etag != etags[k]]
+    assert changed == dest_files[:1]
+    # only the changed file gets a new manifest entry
+    entries = local_storage.list(f"{dest_prefix}{coll}/{ds}/_manifest/")
+    assert len(list(entries)) == n_entries + 1
+
+
+def test_handler_live_latency(local_storage, capsys):
+    coll, ds = "pjm", "dayahead_price"
+    event = generate_events(coll, ds, "day", "arrow", "dataclient")[0]
+    key = f"{event.pop('s3key_prefix')}{event.pop('s3key_suffixes')[0]}"
+    event = {**event, "s3_key": key, "source_event_time": "2021-06-15T20:00:00.123Z"}
+    lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    latency = next(r for r in records if "LiveConversionLatencySeconds" in r)
+    expected = datetime.now(timezone.utc) - datetime(
+        2021, 6, 15, 20, 0, 0, 123000, tzinfo=timezone.utc
+    )
+    assert latency["LiveConversionLatencySeconds"] == pytest.approx(
+        expected.total_seconds(), abs=60
+    )
+
+
+def test_handler_from_converted_store(local_storage):
+    coll, ds = "pjm", "dayahead_price"
+    source_files = [
+        k for k in local_storage.list(f"{SOURCE_PREFIX}{coll}/{ds}/") if "csv" in k
+    ]
+    expected = pa.concat_tables(
+        csv.read_csv(gzip.open(local_storage.get(k))) for k in sorted(source_files)
+    )
+
+    # the converted store, which includes a manifest that mustn't be converted
+    events = generate_events(coll, ds, "day", "parquet", "athena", compression="sz")
+    for event in events:
+        lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
+    source_prefix = events[0]["dest_prefix"]
+
+    for partition, fmt, dest_store in [
+        ("month", "arrow", "dataclient"),
+        ("hour", "parquet", "athena"),
+    ]:
+        job = RequestGeneratorEvent(
+            datasets={coll: [ds]},
+            dest_prefix=f"test/transcoded/{partition}/",
+            compression="zst",
+            partition_size=partition,
+            dest_store=dest_store,
+            file_format=fmt,
+            source_prefix=source_prefix,
+        )
+        requests = list(generate_requests(coll, ds, job))
+        assert all(r["s3key_prefix"].startswith(source_prefix) for r in requests)
+        assert all(
+            k.endswith(".parquet") for r in requests for k in r["s3key_suffixes"]
+        )
+        for request in requests:
+            lambda_handler({"Records": [{"body": json.dumps(request)}]}, None)
+
+        dest_files = list_dest_files(job.dest_prefix, coll, ds)
+        assert len(dest_files) == (1 if partition == "month" else len(expected))
+        table = reader.read(coll, ds, 0, 2**31, dest_prefix=job.dest_prefix)
+        assert table.sort_by("target_start").to_pydict() == expected.to_pydict()
+
+    # dest partitions can't be smaller than the source's
+    job = RequestGeneratorEvent(
+        datasets={coll: [ds]},
+        dest_prefix="test/transcoded/day/",
+        compression="zst",
+        partition_size="day",
+        source_prefix="test/transcoded/month/",
+    )
+    with pytest.raises(ValueError, match="smaller 'day' partitions"):
+        list(generate_requests(coll, ds, job))
+
+
+def test_handler_dictionary_encode(local_storage):
+    coll, ds = "pjm", "node_price"
+    metadata = {
+        "type_map": {"target_start": "int", "node": "str", "zone": "str"},
+        "superkey": ["target_start", "node"],
+        "value_key": ["zone"],
+    }
+    local_storage.put(gen_metadata_key(coll, ds), json.dumps(metadata).encode())
+    lines = ["target_start,node,zone"]
+    lines += [f"{1577836800 + i * 60},node_{i},zone_{i % 3}" for i in range(1000)]
+    key = f"{SOURCE_PREFIX}{coll}/{ds}/year=2020/1577836800.csv.gz"
+    local_storage.put(key, gzip.compress("\n".join(lines).encode()))
+
+    event = generate_events(coll, ds, "day", "arrow", "dataclient")[0]
+    event["dictionary_encode"] = True
+    lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
+
+    dest_prefix = event["dest_prefix"]
+    table = reader.read(coll, ds, 0, 2**31, dest_prefix=dest_prefix)
+    # only the low-cardinality column is dictionary-encoded
+    assert table.schema.field("node").type == pa.string()
+    assert table.schema.field("zone").type == pa.dictionary(pa.int32(), pa.string())
+    assert table.column("zone").to_pylist()[:4] == [
+        "zone_0",
+        "zone_1",
+        "zone_2",
+        "zone_0",
+    ]
+    entry = read_manifest(coll, ds, dest_prefix).to_pylist()[0]
+    assert entry["schema_hash"] == manifest.schema_hash(table.schema)
+
+
+def test_handler_buckets(local_storage):
+    coll, ds = "pjm", "dayahead_price"
+    with pytest.raises(Exception, match="only supported for the athena"):
+        RequestGeneratorEvent(
+            datasets={coll: [ds]},
+            dest_prefix="test/",
+            compression="zst",
+            bucket_count=4,
+        )
+
+    job = RequestGeneratorEvent(
+        datasets={coll: [ds]},
+        dest_prefix="test/bucketed/",
+        compression="sz",
+        partition_size="month",
+        dest_store="athena",
+        file_format="parquet",
+        bucket_count=4,
+    )
+    events = list(generate_requests(coll, ds, job))
+    for event in events:
+        lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
+
+    # node ids are 0 to 23, bucketed by 'node_id' (the first non-time superkey)
+    dest_files = list_dest_files(job.dest_prefix, coll, ds)
+    assert len(dest_files) == len(events) * 4
+    for key in dest_files:
+        bucket = int(
+            re.search(r"/month_partition=[\d-]+/superkey_bucket=(\d)/", key)[1]
+        )
+        node_ids = pd.read_parquet(local_storage.fs_path(key)).node_id
+        assert set(node_ids % 4) == {bucket}
+
+    # all buckets of a partition are read
+    table = reader.read(
+        coll, ds, 1577836800 + 3600, 2**31, dest_prefix=job.dest_prefix
+    )
+    assert len(table) == 11 * 24 - 1
+
+    # rewrites with another bucket count, or without bucketing, replace all files of
+    # the partitions
+    for bucket_count, n_files in ((2, 2), (None, 1)):
+        for event in generate_requests(
+            coll, ds, job.copy(update={"bucket_count": bucket_count})
+        ):
+            lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
+        dest_files = list_dest_files(job.dest_prefix, coll, ds)
+        assert len(dest_files) == len(events) * n_files
+    assert not any("superkey_bucket" in k for k in dest_files)
+
+
+def test_superkey_buckets():
+    column = pa.chunked_array([["a", None], ["node_1", "a"]])
+    buckets = common.superkey_buckets(column, 16).to_pylist()
+    expected = [zlib.crc32(b"a") % 16, 0, zlib.crc32(b"node_1") % 16]
+    assert buckets == expected + expected[:1]
+
+    column = pa.chunked_array([[-17, 3, None]])
+    assert common.superkey_buckets(column, 16).to_pylist() == [1, 3, 0]
+
+
+def test_handler_rollups(local_storage):
+    coll, ds = "pjm", "dayahead_price"
+    with pytest.raises(Exception, match="can't be larger than the partition size"):
+        RequestGeneratorEvent(
+            datasets={coll: [ds]},
+            dest_prefix="test/",
+            compression="sz",
+            partition_size="hour",
+            dest_store="athena",
+            file_format="parquet",
+            rollups=[{"period": "day"}],
+        )
+
+    job = RequestGeneratorEvent(
+        datasets={coll: [ds]},
+        dest_prefix="test/rollups/",
+        compression="sz",
+        partition_size="month",
+        dest_store="athena",
+        file_format="parquet",
+        rollups=[{"period": "day", "aggregations": ["max", "count"]}],
+    )
+    events = list(generate_requests(coll, ds, job))
+    assert events[0]["rollups"] == [{"period": "day", "aggregations": ["max", "count"]}]
+    for event in events:
+        lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
+
+    # a rollup file per partition, next to the dataset's files, with its own manifest
+    rollup_ds = "dayahead_price_rollup_day"
+    dest_files = list_dest_files(job.dest_prefix, coll, rollup_ds)
+    assert len(dest_files) == len(list_dest_files(job.dest_prefix, coll, ds))
+    assert len(read_manifest(coll, rollup_ds, job.dest_prefix)) == len(dest_files)
+
+    df = pd.read_parquet(local_storage.fs_path(sorted(dest_files)[0]))
+    assert list(df.columns) == ["node_id", "target_start", "lmp_max", "lmp_count"]
+    # one row per node (hour of the day) and day, there are 11 days of test data
+    assert len(df) == 11 * 24
+    assert set(df.target_start % 86400) == {0}
+    assert set(df.lmp_count) == {1}
+
+
+def test_rollup_table(local_storage):
+    day = 1577836800
+    table = pa.table(
+        {
+            "target_start": [day, day + 3600, day + 3600, day, day + 3600, day + 86400],
+            "release_date": [day, day, day - 1, day, day, day],
+            "node_id": [1, 1, 1, 2, 2, 1],
+            "lmp": [1.0, 3.0, 9.0, 5.0, None, 7.0],
+        }
+    )
+    rollup = common.rollup_table(
+        table, "pjm", "dayahead_price", "day", common.ROLLUP_AGGREGATIONS
+    )
+    assert rollup.to_pydict() == {
+        "node_id": [1, 1, 2],
+        "target_start": [day, day + 86400, day],
+        "lmp_min": [1.0, 7.0, 5.0],
+        "lmp_max": [9.0, 7.0, 5.0],
+        "lmp_mean": [13 / 3, 7.0, 5.0],
+        "lmp_count": [3, 1, 1],
+        # the latest release of the last interval, nulls are skipped
+        "lmp_last": [3.0, 7.0, 5.0],
+    }
+
+
+def test_handler_row_group_size(local_storage):
+    coll, ds = "pjm", "dayahead_price"
+    events = generate_events(coll, ds, "month", "parquet", "athena", compression="sz")
+    for event in events:
+        event["row_group_size"] = 100
+        lambda_handler({"Records": [{"body": json.dumps(event)}]}, None)
+
+    key = list_dest_files(events[0]["dest_prefix"], coll, ds)[0]
+    metadata = pq.read_metadata(local_storage.fs_path(key))
+    assert metadata.num_rows == 11 * 24
+    assert metadata.num_row_groups == 3
+
+
+def test_handler_profile(local_storage, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_INTERVAL_S", 0.001)
+    coll, ds = "pjm", "dayahead_price"
+    job = RequestGeneratorEvent(
+        datasets={coll: [ds]},
+        dest_prefix="test/profiled/",
+        compression="zst",
+        partition_size="month",
+        profile=True,
+    )
+    event = list(generate_requests(coll, ds, job))[0]
+    assert event["profile"]
+    # malformed records in the batch are left out of the profile
+    records = [{"body": json.dumps(event)}, {"messageId": "a", "body": "not json"}]
+    resp = lambda_handler({"Records": records}, FakeContext())
+    assert resp == {"batchItemFailures": [{"itemIdentifier": "a"}]}
+
+    keys = list(local_storage.list(profiling.PROFILE_PREFIX))
+    assert [k.rsplit("/", 1)[-1] for k in keys] == [
+        "request-1.folded",
+        "request-1.json",
+    ]
+
+    # stacks of all threads in the collapsed format, i.e. '<frame>;<frame> <count>'
+    folded = local_storage.get(keys[0]).read().decode().splitlines()
+    stacks = [line.rsplit(" ", 1) for line in folded]
+    assert all(count.isdigit() for _, count in stacks)
+    assert any("lambda_handler (request_handler.py" in s for s, _ in stacks)
+    summary = json.load(local_storage.get(keys[1]))
+    assert summary["samples"] == len(summary["arrow_allocated_bytes"]) > 0
+    # calibrates the estimates of backfill dry runs
+    [request] = summary["requests"]
+    assert request["source_keys"] == len(event["s3key_suffixes"])
+    assert request["source_bytes"] > 0
+    assert request["file_format"] == "arrow" and not request["stage_to_disk"]
+
+
+def test_sampling_profiler():
+    with profiling.SamplingProfiler(interval=0.001) as profiler:
+        pa.array(range(100_000))
+        time.sleep(0.05)
+    assert profiler.duration >= 0.05
+    assert sum(profiler.stacks.values()) >= len(profiler.memory) > 10
+    assert any("test_sampling_profiler" in s for s in profiler.stacks)
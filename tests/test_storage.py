@@ -0,0 +1,124 @@
+import os
+
+import boto3
+import pytest
+from boto3.s3.transfer import TransferConfig
+
+from lambdas.common import SOURCE_BUCKET, refresh_clients
+from lambdas.storage import (
+    DeleteFailed,
+    LocalStorage,
+    PreconditionFailed,
+    S3Storage,
+    storage_from_uri,
+)
+from tests.aws_setup import mock_start, mock_stop, setup_resources
+
+
+@pytest.fixture()
+def patched_bucket():
+    mock_start()
+    refresh_clients()
+    yield setup_resources()
+    mock_stop()
+
+
+def test_s3_storage_get(patched_bucket):
+    key = "test/large_object.bin"
+    data = os.urandom(1000)
+    boto3.client("s3").put_object(Bucket=SOURCE_BUCKET, Key=key, Body=data)
+
+    # object is smaller than the threshold, fetched with a single request
+    config = TransferConfig(multipart_threshold=2000, multipart_chunksize=100)
+    storage = S3Storage(SOURCE_BUCKET, download_config=config)
+    assert storage.get(key).read() == data
+
+    # object is exactly the threshold
+    config = TransferConfig(multipart_threshold=1000, multipart_chunksize=100)
+    storage = S3Storage(SOURCE_BUCKET, download_config=config)
+    assert storage.get(key).read() == data
+
+    # object is larger than the threshold, remaining bytes are fetched in ranges that
+    # don't divide the object size evenly
+    config = TransferConfig(multipart_threshold=64, multipart_chunksize=90)
+    storage = S3Storage(SOURCE_BUCKET, download_config=config)
+    assert storage.get(key).read() == data
+
+
+def test_local_storage(tmp_path):
+    storage = storage_from_uri(f"file://{tmp_path}")
+    assert isinstance(storage, LocalStorage)
+
+    storage.put("a/b/2.csv", b"2")
+    storage.put("a/b/1.csv", b"1")
+    storage.put("a/c/3.csv", b"3")
+    storage.copy("a/c/3.csv", "d/3.csv")
+
+    assert storage.get("d/3.csv").read() == b"3"
+    # same semantics as S3 listings
+    assert list(storage.list("a/")) == ["a/b/1.csv", "a/b/2.csv", "a/c/3.csv"]
+    assert list(storage.list("a/b")) == ["a/b/1.csv", "a/b/2.csv"]
+    assert list(storage.list("")) == [*storage.list("a/"), "d/3.csv"]
+    assert list(storage.list("", dirs_only=True)) == ["a/", "d/"]
+    assert list(storage.list("a/", dirs_only=True)) == ["a/b/", "a/c/"]
+    assert list(storage.list("x/")) == []
+    assert list(storage.list_sizes("a/b")) == [("a/b/1.csv", 1), ("a/b/2.csv", 1)]
+
+    # conditional writes return the new etag, which the next write is conditional on
+    etag = storage.put("e.json", b"1", if_none_match=True)
+    assert etag == storage.head("e.json").etag
+    with pytest.raises(PreconditionFailed):
+        storage.put("e.json", b"2", if_none_match=True)
+    storage.put("e.json", b"22", if_match=etag)
+    with pytest.raises(PreconditionFailed):
+        storage.put("e.json", b"3", if_match=etag)
+
+    # dated prefixes are deleted before a date
+    for date in ("2021-06-01", "2021-06-02", "2021-06-03"):
+        storage.put(f"f/{date}/1.json", b"1")
+    storage.delete_dated("f/", "2021-06-02")
+    assert list(storage.list("f/", dirs_only=True)) == [
+        "f/2021-06-02/",
+        "f/2021-06-03/",
+    ]
+
+
+def test_object_metadata(patched_bucket, tmp_path):
+    for storage in (S3Storage(SOURCE_BUCKET), LocalStorage(str(tmp_path))):
+        assert storage.head("test/a.bin") is None
+
+        storage.put("test/a.bin", b"abc", metadata={"fingerprint": "123"})
+        info = storage.head("test/a.bin")
+        assert info.size == 3
+        assert info.etag == storage.get_object("test/a.bin").etag
+        assert info.metadata == {"fingerprint": "123"}
+
+        # metadata is copied along with the object, and replaced by a put
+        storage.copy("test/a.bin", "test/b.bin")
+        assert storage.head("test/b.bin").metadata == {"fingerprint": "123"}
+        storage.put("test/b.bin", b"abc")
+        assert storage.head("test/b.bin").metadata == {}
+
+        # metadata isn't listed as objects
+        assert list(storage.list("test/")) == ["test/a.bin", "test/b.bin"]
+        if isinstance(storage, LocalStorage):
+            assert list(storage.list("")) == ["test/a.bin", "test/b.bin"]
+        storage.delete(["test/a.bin", "test/b.bin"])
+        assert list(storage.list("test/")) == []
+
+
+def test_s3_storage_delete_errors(patched_bucket, monkeypatch):
+    storage = S3Storage(SOURCE_BUCKET)
+    storage.put("test/a.bin", b"a")
+    storage.delete(["test/a.bin", "test/missing.bin"])
+    assert list(storage.list("test/")) == []
+
+    # quiet deletes report failed keys in the response, eg. without s3:DeleteObject
+    def delete_objects(**kwargs):
+        key = kwargs["Delete"]["Objects"][0]["Key"]
+        return {"Errors": [{"Key": key, "Code": "AccessDenied", "Message": "denied"}]}
+
+    storage.put("test/a.bin", b"a")
+    monkeypatch.setattr(storage.client, "delete_objects", delete_objects)
+    with pytest.raises(DeleteFailed, match="test/a.bin: AccessDenied"):
+        storage.delete(["test/a.bin"])
@@ -0,0 +1,79 @@
+import json
+import time
+from types import SimpleNamespace
+
+import boto3
+import pytest
+
+from lambdas.common import SOURCE_BUCKET, refresh_clients
+from lambdas.storage import S3Storage
+from lambdas.throttle import MIN_RATE_FRACTION, S3RateLimiter, TokenBucket
+from tests.aws_setup import mock_start, mock_stop
+
+
+@pytest.fixture()
+def patched_bucket():
+    mock_start()
+    refresh_clients()
+    boto3.client("s3").create_bucket(Bucket=SOURCE_BUCKET)
+    yield
+    mock_stop()
+
+
+def test_token_bucket():
+    bucket = TokenBucket(100)
+    # bursts of up to a second's worth of requests don't wait
+    assert sum(bucket.acquire() for _ in range(100)) == 0
+
+    start = time.monotonic()
+    for _ in range(10):
+        bucket.acquire()
+    assert time.monotonic() - start == pytest.approx(0.1, abs=0.05)
+
+    # the rate is halved on throttles, down to a minimum
+    bucket.throttled()
+    assert bucket.rate == 50
+    for _ in range(10):
+        bucket.throttled()
+    assert bucket.rate == 100 * MIN_RATE_FRACTION
+
+    # and recovers gradually
+    bucket.succeeded()
+    assert 100 * MIN_RATE_FRACTION < bucket.rate < 100
+    for _ in range(100):
+        bucket.succeeded()
+    assert bucket.rate == 100
+
+
+def test_rate_limiter(patched_bucket, capsys):
+    limiter = S3RateLimiter(read_rate=20, write_rate=10)
+    storage = S3Storage(SOURCE_BUCKET, rate_limiter=limiter)
+
+    # writes to the same prefix are limited
+    start = time.monotonic()
+    for i in range(15):
+        storage.put(f"a/{i}", b"data")
+    assert time.monotonic() - start > 0.4
+    assert limiter.bucket(f"{SOURCE_BUCKET}/a", write=True).tokens < 1
+
+    # while other prefixes and reads have their own buckets
+    start = time.monotonic()
+    storage.put("b/0", b"data")
+    assert storage.get("a/0").read() == b"data"
+    assert time.monotonic() - start < 0.1
+
+    # throttled responses slow down the prefix
+    response = (SimpleNamespace(status_code=503), {"Error": {"Code": "SlowDown"}})
+    request = {"context": {"rate_limit": (f"{SOURCE_BUCKET}/b", True)}}
+    limiter._after_attempt(request_dict=request, response=response)
+    assert limiter.bucket(f"{SOURCE_BUCKET}/b", write=True).rate == 5
+
+    limiter.emit_metrics()
+    record = json.loads(capsys.readouterr().out)
+    assert record["S3Requests"] == 17
+    assert record["S3SlowDowns"] == 1
+    assert record["S3ThrottleWaitSeconds"] > 0.4
+    names = [m["Name"] for m in record["_aws"]["CloudWatchMetrics"][0]["Metrics"]]
+    assert set(names) == {"S3Requests", "S3SlowDowns", "S3ThrottleWaitSeconds"}
+    # metrics are reset once emitted
+    assert not limiter.metrics